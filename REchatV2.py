@@ -1,171 +1,370 @@
 import streamlit as st
-import openai
-import anthropic
-import google.generativeai as genai
-from openai import OpenAI
+import copy
 import json
+from collections import deque
 from datetime import datetime
+import hmac
 import os
-import re
-
-def extract_name_from_description(description):
-    """Extract name from persona description"""
-    # Try to find name patterns like "This is Ahmed" or "Meet Sara" or just "Ahmed,"
-    patterns = [
-        r'This is ([A-Z][a-z]+)',
-        r'Meet ([A-Z][a-z]+)',
-        r'^([A-Z][a-z]+),',
-        r'named ([A-Z][a-z]+)',
-    ]
-    
-    for pattern in patterns:
-        match = re.search(pattern, description)
-        if match:
-            return match.group(1)
-    
-    # Fallback: try to find any capitalized name in the first sentence
-    first_sentence = description.split('.')[0]
-    words = first_sentence.split()
-    for word in words:
-        cleaned = word.strip('[](),')
-        if cleaned and cleaned[0].isupper() and len(cleaned) > 2 and cleaned.isalpha():
-            return cleaned
-    
-    return "The persona"
+import time
+import uuid
+import chat
+from providers import get_provider
+from metrics import start_metrics_server
+from context_window import ContextWindow
+from persona import (
+    build_description_prompt, departed_reply, extract_name_from_description, fallback_persona,
+    is_departure_reply, looks_offensive, normalize_spec, render_persona_prompt, replay_conversation,
+)
+from storage import DB_PATH, PERSONA_KEYS, ConversationStore
+from persona_cache import PersonaCache, persona_cache_key
+from persona_batch import generate_personas, library_to_json, load_specs, spec_csv_template
+from transcript import FORMATS, TranscriptBuffer, write_sessions_zip
+from prewarm import OPENING_QUESTIONS, PREGENERATE, PREWARM, PREWARMER
+from response_cache import RESPONSE_CACHE, RESPONSES, VARIATION
+from session_memory import SESSIONS, USAGE_HISTORY, Message, SessionMemory, intern_text, spill_count
+from compare import Branch, fan_out
 
-def format_conversation_for_download():
-    """Format the conversation for download as text"""
-    if not st.session_state.messages:
-        return "No conversation to download."
-    
-    # Get current date and time
-    current_time = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+@st.cache_resource
+def get_metrics_server():
+    """Prometheus exporter on RECHAT_METRICS_PORT, started once per server process"""
+    return start_metrics_server()
+
+def record_trace(trace):
+    """Keep the last provider call's trace for the debug panel"""
+    st.session_state.last_trace = trace
+
+def queue_notice():
+    """Placeholder showing the student's place in the shared API queue; returns its update callback"""
+    placeholder = st.empty()
     
-    # Create header
-    text_content = "="*60 + "\n"
-    text_content += "RELIGIOUS PERSONA CONVERSATION\n"
-    text_content += "="*60 + "\n"
-    text_content += f"Downloaded: {current_time}\n\n"
+    def show(position):
+        if position is None:
+            placeholder.empty()
+        else:
+            placeholder.caption(f"⏳ The shared API key is busy – you are number {position + 1} in the queue.")
+    return show
+
+# Password that unlocks the transcript list and zip export (empty = those stay locked)
+TEACHER_PASSWORD = os.environ.get("RECHAT_TEACHER_PASSWORD", "")
+
+def is_teacher():
+    """True once this browser session has entered the teacher password"""
+    return bool(TEACHER_PASSWORD) and st.session_state.get("teacher_unlocked", False)
+
+@st.cache_resource
+def get_conversation_store():
+    """Shared transcript store, or None when persistence is disabled"""
+    return ConversationStore(DB_PATH) if DB_PATH else None
+
+def begin_persona(spec):
+    """Reset the conversation and store the persona details for display and download"""
+    st.session_state.persona_created = True
+    st.session_state.messages = []  # Clear previous messages
+    st.session_state.context_window.reset()
+    st.session_state.persona_departed = False
+    st.session_state.offense_count = 0
     
-    # Add persona settings
-    text_content += "PERSONA SETTINGS:\n"
-    text_content += "-"*60 + "\n"
-    text_content += f"Religious Tradition: {st.session_state.get('persona_tradition', 'N/A')}\n"
-    text_content += f"Denomination/Movement: {st.session_state.get('persona_denomination', 'N/A')}\n"
-    text_content += f"Geographic/Cultural Context: {st.session_state.get('persona_context', 'N/A')}\n"
-    text_content += f"Demographics: {st.session_state.get('persona_demographics', 'N/A')}\n"
-    text_content += f"Personality: {st.session_state.get('persona_personality', 'Not specified')}\n"
-    text_content += f"Knowledge Level: {st.session_state.get('persona_knowledge_level', 'N/A')}\n"
-    text_content += f"Engagement Level: {st.session_state.get('persona_engagement_level', 'N/A')}\n"
-    text_content += f"Attitude towards Religion: {st.session_state.get('persona_attitude', 'N/A')}\n\n"
+    st.session_state.persona_denomination = spec["denomination"]
+    st.session_state.persona_tradition = spec["tradition"]
+    st.session_state.persona_context = spec["context"]
+    st.session_state.persona_demographics = spec["demographics"]
+    st.session_state.persona_personality = spec["personality"] if spec["personality"] else "Not specified"
+    st.session_state.persona_knowledge_level = spec["knowledge_level"]
+    st.session_state.persona_engagement_level = spec["engagement_level"]
+    st.session_state.persona_attitude = spec["attitude"]
+
+@st.cache_resource
+def get_persona_cache():
+    """Generated personas shared by every session on the server"""
+    return PersonaCache()
+
+def create_persona(llm_choice, api_key, spec):
+    """Description, name and system prompt for a persona spec, generated once per spec and model"""
+    def generate():
+        # First generate the persona description
+        description = generate_persona_description(llm_choice, api_key, build_description_prompt(spec))
+        # Extract name from description
+        name = extract_name_from_description(description)
+        return {"description": description, "name": name, "system_prompt": render_persona_prompt(spec, name)}
     
-    # Add persona introduction
-    text_content += "PERSONA INTRODUCTION:\n"
-    text_content += "-"*60 + "\n"
-    if 'persona_description_text' in st.session_state and st.session_state.persona_description_text:
-        text_content += st.session_state.persona_description_text + "\n\n"
+    key = persona_cache_key(spec, llm_choice, get_provider(llm_choice).model)
+    return get_persona_cache().get_or_create(key, generate)
+
+# The stored persona library is re-read at most this often (seconds); saving to it refreshes it at once
+LIBRARY_TTL = float(os.environ.get("RECHAT_LIBRARY_TTL", "60"))
+
+@st.cache_data(ttl=LIBRARY_TTL, show_spinner=False)
+def load_stored_library():
+    """Persona library records from the transcript store, shared by every session between refreshes"""
+    return get_conversation_store().list_personas()
+
+def get_persona_library():
+    """Persona library records from the transcript store, or from this session if persistence is off"""
+    if get_conversation_store() is not None:
+        return load_stored_library()
+    return st.session_state.get("persona_library", [])
+
+def save_to_library(library, records):
+    """Add generated persona records to the persona library"""
+    for record in records:
+        record["library"] = library
+    store = get_conversation_store()
+    if store is not None:
+        for record in records:
+            store.save_persona(library, record)
+        store.flush(timeout=10)
+        load_stored_library.clear()
     else:
-        text_content += "N/A\n\n"
-    
-    # Add conversation transcript
-    text_content += "="*60 + "\n"
-    text_content += "CONVERSATION TRANSCRIPT:\n"
-    text_content += "="*60 + "\n\n"
-    
-    # Add conversation messages
-    for i, message in enumerate(st.session_state.messages, 1):
-        role = "Me" if message["role"] == "user" else "Persona"
-        text_content += f"{role}: {message['content']}\n\n"
+        st.session_state.persona_library = records + st.session_state.get("persona_library", [])
+
+def use_library_persona(record):
+    """Start a conversation with a ready-made persona from the library"""
+    begin_persona(record["spec"])
+    st.session_state.generating_new_persona = False
+    st.session_state.persona_description_text = record["description"]
+    st.session_state.persona_name = record["name"]
+    st.session_state.current_persona = record["system_prompt"]
+    start_session()
+    add_message("assistant", f"Hi, I am {record['name']}.")
+
+def start_session():
+    """Start a new stored session for the current persona"""
+    st.session_state.session_id = uuid.uuid4().hex[:12]
+    st.session_state.message_offset = 0
+    store = get_conversation_store()
+    if store is not None:
+        store.save_session(
+            st.session_state.session_id,
+            st.session_state.persona_name,
+            {key: st.session_state.get(key, "") for key in PERSONA_KEYS}
+        )
+
+def add_message(role, content):
+    """Append a message to the conversation and queue it for the transcript store"""
+    st.session_state.messages.append(Message(role, content))
+    store = get_conversation_store()
+    if store is not None:
+        store.append_message(st.session_state.session_id, st.session_state.message_offset + len(st.session_state.messages) - 1, role, content)
+        spill_history()
+
+def spill_history():
+    """Drop the oldest messages from memory once the session holds more than the history cap; they stay in the store"""
+    messages = st.session_state.messages
+    count = spill_count(len(messages))
+    if count:
+        st.session_state.context_window.trim(messages, count)
+        st.session_state.transcript_buffer.trim(messages, count)
+        del messages[:count]
+        st.session_state.message_offset += count
+
+def touch_session():
+    """Share persona texts between sessions and tell the idle-session reaper what this session holds"""
+    st.session_state.current_persona = intern_text(st.session_state.current_persona)
+    st.session_state.persona_description_text = intern_text(st.session_state.persona_description_text)
+    st.session_state.memory.touch(
+        st.session_state.messages, st.session_state.transcript_buffer, st.session_state.current_persona,
+        st.session_state.message_offset, get_conversation_store() is not None,
+        st.session_state.context_window, st.session_state.turn_usage
+    )
+
+def resume_session(session_id):
+    """Load a stored session into the current browser session; False if it does not exist"""
+    store = get_conversation_store()
+    if store is None:
+        return False
+    store.flush(timeout=5)
+    stored = store.load_session(session_id)
+    if stored is None:
+        return False
+    persona, messages = stored
+    for key, value in persona.items():
+        st.session_state[key] = value
+    st.session_state.session_id = session_id
+    # Only the most recent messages are kept in memory; the transcript download reads the rest from the store
+    offset = spill_count(len(messages))
+    st.session_state.messages = [Message(msg["role"], msg["content"]) for msg in messages[offset:]]
+    st.session_state.message_offset = offset
+    st.session_state.persona_created = True
+    st.session_state.generating_new_persona = False
+    st.session_state.context_window.resume(messages[:offset])
+    st.session_state.persona_departed, st.session_state.offense_count = replay_conversation(messages)
+    return True
+
+# Messages shown as chat bubbles; earlier ones load a page at a time as compact markdown
+HISTORY_PAGE_SIZE = int(os.environ.get("RECHAT_HISTORY_PAGE_SIZE", "20"))
+
+def load_earlier_messages():
+    st.session_state.history_pages += 1
+
+@st.fragment
+def render_chat_history():
+    """Render the latest page of messages, plus any earlier pages the user has asked for
+
+    Earlier pages reuse the transcript buffer's per-message markdown, so a
+    message is formatted once however often the page is redrawn, and
+    "load earlier" reruns only this fragment.
+    """
+    messages = st.session_state.messages
+    if st.session_state.get("history_source") is not messages:
+        st.session_state.history_source = messages
+        st.session_state.history_pages = 0
+    recent_start = max(0, len(messages) - HISTORY_PAGE_SIZE)
+    earlier_start = max(0, recent_start - st.session_state.history_pages * HISTORY_PAGE_SIZE)
+    if earlier_start > 0:
+        st.button(f"⬆️ Load earlier messages ({earlier_start} more)", on_click=load_earlier_messages)
+    elif st.session_state.message_offset:
+        st.caption(f"{st.session_state.message_offset} earlier messages are in the saved transcript (download the conversation to read them).")
+    if earlier_start < recent_start:
+        chunks = st.session_state.transcript_buffer.extend(messages, "md", st.session_state.message_offset)
+        for page_start in range(earlier_start, recent_start, HISTORY_PAGE_SIZE):
+            st.markdown("".join(chunks[page_start:min(page_start + HISTORY_PAGE_SIZE, recent_start)]))
+        st.divider()
+    for message in messages[recent_start:]:
+        with st.chat_message(message["role"]):
+            st.markdown(message["content"])
+
+def format_conversation_for_download(fmt="txt"):
+    """Return a callable that formats the conversation on click, from the session's transcript buffer"""
+    buffer = st.session_state.transcript_buffer
+    messages = st.session_state.messages
+    persona = {key: st.session_state[key] for key in PERSONA_KEYS if key in st.session_state}
+    offset = st.session_state.message_offset
+    store = get_conversation_store()
+    session_id = st.session_state.session_id
     
-    return text_content
+    def build():
+        earlier = []
+        if offset and store is not None:
+            store.flush(timeout=5)
+            stored = store.load_session(session_id)
+            earlier = stored[1][:offset] if stored else []
+        return buffer.render(messages, persona, fmt, earlier=earlier, offset=offset)
+    return build
 
 def generate_persona_description(llm_choice, api_key, desc_prompt):
     """Generate persona description - separate from conversation"""
-    try:
-        if llm_choice == "OpenAI GPT-4o":
-            client = OpenAI(api_key=api_key)
-            response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=[{"role": "user", "content": desc_prompt}],
-                max_tokens=200,
-                temperature=0.7
-            )
-            return response.choices[0].message.content
-        
-        elif llm_choice == "Claude (Anthropic)":
-            client = anthropic.Anthropic(api_key=api_key)
-            response = client.messages.create(
-                model="claude-sonnet-4-20250514",
-                max_tokens=200,
-                messages=[{"role": "user", "content": desc_prompt}]
-            )
-            return response.content[0].text
-        
-        elif llm_choice == "Google Gemini":
-            genai.configure(api_key=api_key)
-            model = genai.GenerativeModel('gemini-pro')
-            response = model.generate_content(desc_prompt)
-            return response.text
-            
-    except Exception as e:
-        raise Exception(f"Description generation error: {str(e)}")
-
-def generate_response(llm_choice, api_key, persona, messages, user_input):
+    return chat.generate_persona_description(llm_choice, api_key, desc_prompt, st.session_state.get("session_id", ""), record_trace)
+
+def generate_response(llm_choice, api_key, persona, messages, user_input, prompt_cache=False, usage_log=None, context=None, fallback=None, on_queue=None):
     """Generate response based on selected LLM"""
-    
-    # Prepare conversation history
-    conversation_history = []
-    conversation_history.append({"role": "system", "content": persona})
-    
-    # Add previous messages (limit to last 10 for context)
-    for msg in messages[-10:]:
-        conversation_history.append(msg)
-    
-    try:
-        if llm_choice == "OpenAI GPT-4o":
-            client = OpenAI(api_key=api_key)
-            response = client.chat.completions.create(
-                model="gpt-4o",
-                messages=conversation_history,
-                max_tokens=500,
-                #temperature=0.7
-            )
-            return response.choices[0].message.content
-        
-        elif llm_choice == "Claude (Anthropic)":
-            client = anthropic.Anthropic(api_key=api_key)
-            # Convert messages format for Claude
-            claude_messages = []
-            for msg in conversation_history[1:]:  # Skip system message
-                claude_messages.append({
-                    "role": msg["role"],
-                    "content": msg["content"]
-                })
-            
-            response = client.messages.create(
-                model="claude-sonnet-4-20250514",
-                max_tokens=500,
-                system=persona,
-                messages=claude_messages
+    return chat.generate_response(
+        llm_choice, api_key, persona, messages, user_input, prompt_cache, usage_log, context, fallback, on_queue,
+        st.session_state.get("session_id", ""), record_trace
+    )
+
+def stream_response(llm_choice, api_key, persona, messages, user_input, prompt_cache=False, usage_log=None, context=None, fallback=None, on_queue=None):
+    """Stream response tokens from the selected LLM as they arrive"""
+    return chat.stream_response(
+        llm_choice, api_key, persona, messages, user_input, prompt_cache, usage_log, context, fallback, on_queue,
+        st.session_state.get("session_id", ""), record_trace
+    )
+
+def prewarm_persona(llm_choice, api_key, prompt_cache, warm, pregenerate):
+    """Warm the provider for the new persona's first turn, and optionally pre-answer opening questions, in the background"""
+    if api_key and (warm or pregenerate):
+        PREWARMER.start(
+            llm_choice, api_key, st.session_state.current_persona, st.session_state.messages[0]["content"],
+            prompt_cache, st.session_state.session_id, warm, OPENING_QUESTIONS if pregenerate else None
+        )
+
+def opening_answer(llm_choice, question):
+    """Pre-generated reply if this is the first question after the greeting, else None"""
+    if len(st.session_state.messages) != 2:
+        return None
+    return PREWARMER.opening_answer(llm_choice, st.session_state.current_persona, question)
+
+def conversation_length():
+    """Messages in the main conversation so far, including those only kept in the store"""
+    return st.session_state.message_offset + len(st.session_state.messages)
+
+def comparison_branches(models):
+    """The main conversation plus each compared model's branch of it
+
+    A branch is forked from the main conversation when its model is first
+    compared, and forked again whenever the main conversation has moved on
+    without it (e.g. while comparison mode was off).
+    """
+    if st.session_state.get("compare_session") != st.session_state.session_id:
+        st.session_state.compare_session = st.session_state.session_id
+        st.session_state.compare_branches = {}
+        st.session_state.compare_timings = {}
+    branches = st.session_state.compare_branches
+    for choice, key in models[1:]:
+        if choice not in branches or branches[choice].synced != conversation_length():
+            branches[choice] = Branch(
+                choice, key, list(st.session_state.messages), copy.copy(st.session_state.context_window),
+                departed=st.session_state.persona_departed
             )
-            return response.content[0].text
-        
-        elif llm_choice == "Google Gemini":
-            genai.configure(api_key=api_key)
-            model = genai.GenerativeModel('gemini-pro')
-            
-            # Format for Gemini
-            prompt = persona + "\n\nConversation:\n"
-            for msg in messages[-5:]:  # Last 5 messages for context
-                role = "Human" if msg["role"] == "user" else "Assistant"
-                prompt += f"{role}: {msg['content']}\n"
-            prompt += f"Human: {user_input}\nAssistant:"
-            
-            response = model.generate_content(prompt)
-            return response.text
-
-    except Exception as e:
-        raise Exception(f"API Error: {str(e)}")
+            branches[choice].synced = conversation_length()
+        branches[choice].api_key = key
+    primary = Branch(
+        models[0][0], models[0][1], st.session_state.messages, st.session_state.context_window,
+        st.session_state.turn_usage, st.session_state.persona_departed
+    )
+    return [primary] + [branches[choice] for choice, _ in models[1:]]
+
+def render_comparison(branches):
+    """One column per compared model with its branch of the conversation; returns the columns' chat containers"""
+    timings = st.session_state.compare_timings
+    containers = []
+    for index, (branch, column) in enumerate(zip(branches, st.columns(len(branches)))):
+        with column:
+            st.markdown(f"**{branch.llm_choice}**")
+            container = st.container(height=500)
+            with container:
+                if index == 0:
+                    render_chat_history()
+                else:
+                    for message in branch.messages[-HISTORY_PAGE_SIZE:]:
+                        with st.chat_message(message["role"]):
+                            st.markdown(message["content"])
+            if branch.llm_choice in timings:
+                seconds, error = timings[branch.llm_choice]
+                st.caption(f"⚠️ {error}" if error else f"Answered in {seconds:.1f} s")
+            containers.append(container)
+    if "total" in timings:
+        st.caption(f"Last question took {timings['total']:.1f} s for all {len(branches)} models together.")
+    return containers
+
+def answer_comparison(branches, containers, user_input, prompt_cache, stream):
+    """Send one question to every compared model at once and stream the answers into their columns"""
+    add_message("user", user_input)
+    for branch in branches[1:]:
+        branch.messages.append(Message("user", user_input))
+    placeholders = []
+    for container in containers:
+        with container:
+            with st.chat_message("user"):
+                st.markdown(user_input)
+            with st.chat_message("assistant"):
+                placeholders.append(st.empty())
+    texts = [""] * len(branches)
+    started = time.perf_counter()
+    for index, chunk in fan_out(
+        branches, st.session_state.current_persona, user_input, st.session_state.persona_name,
+        prompt_cache, stream, st.session_state.session_id, st.session_state.offense_count
+    ):
+        if chunk is not None:
+            texts[index] += chunk
+            placeholders[index].markdown(texts[index] + "▌")
+        elif branches[index].error:
+            placeholders[index].error(branches[index].error)
+        else:
+            placeholders[index].markdown(branches[index].answer)
+    if branches[0].answer is not None:
+        add_message("assistant", branches[0].answer)
+    st.session_state.persona_departed = branches[0].departed
+    for branch in branches[1:]:
+        if branch.answer is not None:
+            branch.messages.append(Message("assistant", branch.answer))
+        # Branches are not stored, so their oldest messages are simply dropped past the history cap
+        count = spill_count(len(branch.messages))
+        if count:
+            branch.context.trim(branch.messages, count)
+            del branch.messages[:count]
+        branch.synced = conversation_length()
+    st.session_state.compare_timings = {branch.llm_choice: (branch.seconds, branch.error) for branch in branches}
+    st.session_state.compare_timings["total"] = time.perf_counter() - started
 
 # Page configuration
 st.set_page_config(
@@ -229,6 +428,28 @@ if 'persona_attitude' not in st.session_state:
     st.session_state.persona_attitude = ""
 if 'generating_new_persona' not in st.session_state:
     st.session_state.generating_new_persona = False
+if 'turn_usage' not in st.session_state:
+    st.session_state.turn_usage = deque(maxlen=USAGE_HISTORY)
+if 'context_window' not in st.session_state:
+    st.session_state.context_window = ContextWindow()
+if 'persona_departed' not in st.session_state:
+    st.session_state.persona_departed = False
+if 'offense_count' not in st.session_state:
+    st.session_state.offense_count = 0
+if 'session_id' not in st.session_state:
+    st.session_state.session_id = uuid.uuid4().hex[:12]
+if 'transcript_buffer' not in st.session_state:
+    st.session_state.transcript_buffer = TranscriptBuffer()
+if 'message_offset' not in st.session_state:
+    st.session_state.message_offset = 0  # messages of this conversation already dropped from memory
+if 'memory' not in st.session_state:
+    st.session_state.memory = SessionMemory()
+    SESSIONS.register(st.session_state.memory)
+if st.session_state.memory.evicted:
+    # Idle too long: the conversation was released from memory, so reload it from the store
+    st.session_state.memory.evicted = False
+    resume_session(st.session_state.session_id)
+touch_session()
 
 # Header
 st.markdown('<div class="main-header"><h1>🕊️ Religious Persona Chatbot</h1><p>An Educational Tool for Exploring Religious Diversity</p></div>', unsafe_allow_html=True)
@@ -238,7 +459,7 @@ st.sidebar.header("🤖 AI Model Selection")
 
 llm_choice = st.sidebar.selectbox(
     "Choose an AI Model:",
-    ["OpenAI GPT-4o", "Claude (Anthropic)", "Google Gemini (not yet)"],
+    ["OpenAI GPT-4o", "Claude (Anthropic)", "Google Gemini (not yet)", "Local stub"],
     help="Select which AI model to use for the conversation"
 )
 
@@ -259,11 +480,160 @@ elif llm_choice == "Google Gemini":
     api_key = st.sidebar.text_input("Google AI API Key", type="password", help="Enter your Google AI API key", key="gemini_key", value=st.session_state.api_key)
 elif llm_choice == "DeepSeek":
     api_key = st.sidebar.text_input("DeepSeek API Key", type="password", help="Enter your DeepSeek API key", key="deepseek_key", value=st.session_state.api_key)
+elif llm_choice == "Local stub":
+    # Offline canned responses for development and load testing, no key required
+    st.sidebar.caption("Local stub: canned responses, no API calls.")
+    api_key = "local-stub"
 
 # Update session state with current API key
-if api_key:
+if api_key and llm_choice != "Local stub":
     st.session_state.api_key = api_key
 
+# Stream replies token by token instead of waiting for the full completion
+stream_responses = st.sidebar.toggle(
+    "Stream responses",
+    value=True,
+    help="Show the persona's reply as it is being generated"
+)
+
+# Reuse the provider-side cache for the static persona prompt and stable history prefix
+prompt_cache = st.sidebar.toggle(
+    "Prompt caching",
+    value=False,
+    help="Mark the persona prompt for provider-side caching to cut input-token cost and latency on long conversations"
+)
+if prompt_cache and st.session_state.turn_usage:
+    last_usage = st.session_state.turn_usage[-1]
+    st.sidebar.caption(f"Last turn: {last_usage['cache_read_tokens']} cached / {last_usage['cache_miss_tokens']} uncached input tokens")
+
+# Background work right after persona creation so the first question is not a cold start
+with st.sidebar.expander("⚡ First Turn", expanded=False):
+    prewarm = st.toggle(
+        "Pre-warm on persona creation",
+        value=PREWARM,
+        help="Prime the provider's prompt cache with the persona as soon as it is created (a billed request; only sent with prompt caching on and a persona prompt long enough to cache)"
+    )
+    pregenerate = st.toggle(
+        "Pre-generate opening answers",
+        value=PREGENERATE,
+        help="Answer likely first questions in the background: " + "; ".join(OPENING_QUESTIONS)
+    )
+
+# Shared answers for questions many students ask the same persona
+with st.sidebar.expander("♻️ Answer Reuse", expanded=False):
+    reuse_answers = st.toggle(
+        "Reuse answers to repeated questions",
+        value=RESPONSE_CACHE,
+        help="Answer a question another student already asked this persona (at the same point in the conversation) from the cache"
+    )
+    answer_variation = st.slider(
+        "Variation",
+        0.0, 1.0, VARIATION, 0.1,
+        disabled=not reuse_answers,
+        help="Chance that a repeated question is answered afresh, so students see a few different answers rather than one"
+    )
+    if reuse_answers:
+        st.caption(f"{len(RESPONSES)} answers cached · {RESPONSES.hits} reused · {RESPONSES.misses} generated")
+
+# Optional secondary provider used on failure, or raced against a slow primary
+with st.sidebar.expander("🛟 Failover", expanded=False):
+    fallback_choice = st.selectbox(
+        "Secondary AI Model:",
+        ["None"] + [choice for choice in ["OpenAI GPT-4o", "Claude (Anthropic)"] if choice != llm_choice],
+        help="Used when the primary model fails or is slow to start answering"
+    )
+    fallback_key = ""
+    if fallback_choice != "None":
+        fallback_key = st.text_input(f"{fallback_choice} API Key", type="password", key="fallback_key")
+fallback = (fallback_choice, fallback_key) if fallback_choice != "None" and fallback_key else None
+
+# Ask several models the same question at once, each continuing its own copy of the conversation
+with st.sidebar.expander("⚖️ Compare Models", expanded=False):
+    compare_mode = st.toggle(
+        "Side-by-side comparison",
+        value=False,
+        help="Send each question to several models at once and show how each plays the same persona in its own column"
+    )
+    compare_choices = st.multiselect(
+        "Compare with:",
+        [choice for choice in ["OpenAI GPT-4o", "Claude (Anthropic)", "Local stub"] if choice != llm_choice],
+        disabled=not compare_mode
+    )
+    compare_models = [(llm_choice, api_key)]
+    for choice in compare_choices:
+        if choice == "Local stub":
+            compare_models.append((choice, "local-stub"))
+            continue
+        compare_key = st.text_input(f"{choice} API Key", type="password", key=f"compare_key_{choice}", disabled=not compare_mode)
+        if compare_key:
+            compare_models.append((choice, compare_key))
+
+# Stored conversations: resume by ID and list transcripts for teachers
+if get_conversation_store() is not None:
+    st.sidebar.header("💾 Saved Conversations")
+    if st.session_state.persona_created:
+        st.sidebar.caption(f"Session ID: `{st.session_state.session_id}`")
+    # Anyone holding a session ID can resume that conversation
+    resume_id = st.sidebar.text_input("Resume session ID:", key="resume_session_id")
+    if st.sidebar.button("Resume Conversation") and resume_id:
+        if resume_session(resume_id.strip()):
+            st.rerun()
+        else:
+            st.sidebar.error("No saved conversation with that ID.")
+    # Listing and exporting everyone's conversations is for teachers only
+    if TEACHER_PASSWORD and not is_teacher():
+        with st.sidebar.expander("🔒 Teacher Access", expanded=False):
+            password = st.text_input("Teacher password:", type="password", key="teacher_password")
+            if st.button("Unlock") and password:
+                if hmac.compare_digest(password.encode("utf-8"), TEACHER_PASSWORD.encode("utf-8")):
+                    st.session_state.teacher_unlocked = True
+                    st.rerun()
+                else:
+                    st.error("Wrong password.")
+if get_conversation_store() is not None and is_teacher():
+    with st.sidebar.expander("📋 Transcripts", expanded=False):
+        sessions = get_conversation_store().list_sessions()
+        if sessions:
+            st.dataframe(sessions, hide_index=True)
+            zip_format = st.selectbox("Export format", list(FORMATS), key="zip_format")
+            store = get_conversation_store()
+            st.download_button(
+                label="🗂️ Download All Transcripts (zip)",
+                data=lambda: write_sessions_zip(store.iter_transcripts(), zip_format),
+                file_name=f"religious_conversations_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip",
+                mime="application/zip",
+                on_click="ignore"
+            )
+        else:
+            st.caption("No saved conversations yet.")
+
+# Last provider call's timings and token counts
+get_metrics_server()
+with st.sidebar.expander("🐞 Debug", expanded=False):
+    last_trace = st.session_state.get("last_trace")
+    if last_trace:
+        st.caption(f"{last_trace['kind']} · {last_trace['provider']} · {last_trace['model']}")
+        ttft_text = f"{last_trace['ttft']:.2f} s" if last_trace['ttft'] is not None else "–"
+        st.markdown(
+            f"- Time to first token: {ttft_text}\n"
+            f"- Rate-limit queue wait: {last_trace['queue_wait']:.2f} s\n"
+            f"- Total latency: {last_trace['latency']:.2f} s\n"
+            f"- Tokens in/out: {last_trace['input_tokens']} / {last_trace['output_tokens']}\n"
+            f"- Cached input tokens: {last_trace['cache_read_tokens']}\n"
+            f"- Retries: {last_trace['retries']}"
+            + (f"\n- Error: {last_trace['error']}" if last_trace['error'] else "")
+        )
+    else:
+        st.caption("No provider calls yet.")
+    memory = SESSIONS.report()
+    st.caption("Server memory")
+    st.markdown(
+        f"- Sessions: {memory['sessions']} ({memory['evicted_sessions']} idle and evicted, {memory['evictions_total']} evictions so far)\n"
+        f"- Messages in memory: {memory['messages_in_memory']} ({memory['message_bytes'] / 1024:.0f} KB), {memory['messages_spilled']} spilled to the store\n"
+        f"- Persona prompts: {memory['persona_prompts']} distinct for {memory['sessions_with_persona']} sessions "
+        f"({memory['persona_prompt_bytes'] / 1024:.0f} KB, {memory['persona_prompt_bytes_shared'] / 1024:.0f} KB saved by sharing)"
+    )
+
 # Educational context
 st.sidebar.header("📚 Educational Context")
 st.sidebar.info("""
@@ -351,100 +721,36 @@ with col1:
     # Generate persona button
     if st.button("🎭 Create Persona", type="primary"):
         if all([religious_tradition, denomination, geographic_context, demographics]):
+            spec = normalize_spec({
+                "tradition": religious_tradition,
+                "denomination": denomination,
+                "context": geographic_context,
+                "demographics": demographics,
+                "personality": personality_specifics,
+                "knowledge_level": knowledge_level,
+                "engagement_level": engagement_level,
+                "attitude": attitude_towards_religion,
+            })
             # Set generating flag to hide old description
             st.session_state.generating_new_persona = True
-            st.session_state.persona_created = True
-            st.session_state.messages = []  # Clear previous messages
-            
-            # Store persona details in session state for display and download
-            st.session_state.persona_denomination = denomination
-            st.session_state.persona_tradition = religious_tradition  
-            st.session_state.persona_context = geographic_context
-            st.session_state.persona_demographics = demographics
-            st.session_state.persona_personality = personality_specifics if personality_specifics else "Not specified"
-            st.session_state.persona_knowledge_level = knowledge_level
-            st.session_state.persona_engagement_level = engagement_level
-            st.session_state.persona_attitude = attitude_towards_religion
+            begin_persona(spec)
             # Generate automatic introduction
             if api_key:
                 try:
                     with st.spinner("Creating persona and generating description..."):
-                        # First generate the persona description
-                        desc_prompt = f"""
-Generate a brief third-person description (2-3 sentences) of this religious persona. Include a realistic name appropriate for their background. Write as a narrator describing the person. Do not write as the person themselves. Do not end with a question.
-
-Identity:
-- Religious Tradition: {religious_tradition}
-- Denomination: {denomination}
-- Context: {geographic_context}
-- Demographics: {demographics}
-- Knowledge Level: {knowledge_level}
-- Engagement Level: {engagement_level}
-- Attitude towards Religion: {attitude_towards_religion}
-
-Example: "This is Ahmed, a 28-year-old software engineer living in Stockholm. He identifies as Sunni Muslim with medium knowledge of his tradition and high engagement in practices."
-
-Generate description:
-"""
-                        description = generate_persona_description(llm_choice, api_key, desc_prompt)
-                        
-                        # Extract name from description
-                        name = extract_name_from_description(description)
+                        # Identical specs are served from the shared persona cache
+                        persona = create_persona(llm_choice, api_key, spec)
+                        name = persona["name"]
                         
                         # Store in session state
-                        st.session_state.persona_description_text = description
+                        st.session_state.persona_description_text = persona["description"]
                         st.session_state.persona_name = name
-                        
-                        # Update persona_description with the name
-                        st.session_state.current_persona = f"""
-You are roleplaying as a religious person in a Swedish school setting. Your character should be authentic and true to the identity provided.
-
-**Your Identity:**
-- Name: {name}
-- Religious Tradition: {religious_tradition}
-- Specific Denomination/Movement: {denomination}
-- Geographic/Cultural Context: {geographic_context}
-- Demographics: {demographics}
-- Personality: {personality_specifics if personality_specifics else 'Not specified - use natural variation'}
-- Knowledge Level: {knowledge_level}
-- Engagement Level: {engagement_level}
-- Attitude towards Religion: {attitude_towards_religion}
-
-**CRITICAL INSTRUCTIONS - You MUST follow these exactly:**
-
-1. **Knowledge Level - THIS IS MANDATORY:**
-   - LOW: You have basic, limited knowledge. You don't know theological details, can't quote texts, often say "I don't really know" or "I'm not sure about that". You might have misconceptions.
-   - MEDIUM: You know the basics well but not deep theology. You know common practices and beliefs but admit when things get complex.
-   - HIGH: You have deep knowledge, can discuss theology, quote texts, explain nuances. You're well-read or educated in your tradition.
-
-2. **Engagement Level - THIS IS MANDATORY:**
-   - LOW: You rarely practice. You might identify culturally but don't do daily practices. Be honest about not praying regularly, not attending services, etc.
-   - MEDIUM: You practice sometimes. Maybe you do some rituals but not all. You're selective in what you observe.
-   - HIGH: You practice regularly and consistently. Your faith is active in daily life.
-
-3. **Attitude towards Religion - THIS IS MANDATORY:**
-   - NEGATIVE: You have critiques, frustrations, or negative feelings about your tradition. You might stay for cultural reasons but disagree with teachings. Be openly critical.
-   - NEUTRAL: You're pragmatic, neither strongly devoted nor opposed. Religion is one part of life among many.
-   - POSITIVE: You have strong positive feelings, find meaning and value in your tradition, speak warmly about it.
-
-**Important Guidelines:**
-0. CRITICAL: Do NOT end your response with a question. Never ask questions to the user.
-1. Stay in character according to your EXACT knowledge level, engagement level, and attitude. Do NOT give textbook answers if you have low knowledge. Do NOT claim to practice if you have low engagement.
-2. Indicate the persona's bodily movements, hesitations and glitches between square brackets in your response.
-3. If you have LOW knowledge, admit ignorance frequently. If you have NEGATIVE attitude, be critical. If you have LOW engagement, admit you don't do practices.
-4. Do not be afraid to criticise beliefs and practices in your tradition, especially if your attitude is negative or neutral.
-5. If you, as a persona, get offended by the questions of the user, react accordingly. The first time, express your discomfort clearly. The second time, warn that you will not continue if this behaviour persists. After three offensive interactions, end the conversation with "I do not want to talk to you any more" and in all future attempts at conversation, reply with "[{name}] has left the building".
-
-REMEMBER: Never end your responses with questions. You are being interviewed, not interviewing.
-
-You have already been introduced to the user. Respond naturally to their questions.
-"""
+                        st.session_state.current_persona = persona["system_prompt"]
                         
                         # Add simple first message
-                        st.session_state.messages.append({
-                            "role": "assistant", 
-                            "content": f"Hi, I am {name}."
-                        })
+                        start_session()
+                        add_message("assistant", f"Hi, I am {name}.")
+                        prewarm_persona(llm_choice, api_key, prompt_cache, prewarm, pregenerate)
                         
                         # Clear generating flag
                         st.session_state.generating_new_persona = False
@@ -460,14 +766,11 @@ You have already been introduced to the user. Respond naturally to their questio
                         st.error(f"⚠️ **Could not generate AI description:** {error_msg}")
                     
                     # Fallback with better grammar
-                    fallback_name = demographics.split(',')[0].strip() if ',' in demographics else "a person"
-                    fallback_desc = f"This is {fallback_name}, who identifies as {denomination} within {religious_tradition}, living in {geographic_context}. Knowledge level: {knowledge_level}, Engagement level: {engagement_level}, Attitude: {attitude_towards_religion}."
+                    fallback_name, fallback_desc = fallback_persona(spec)
                     st.session_state.persona_description_text = fallback_desc
                     st.session_state.persona_name = fallback_name
-                    st.session_state.messages.append({
-                        "role": "assistant", 
-                        "content": f"Hi, I am {fallback_name}."
-                    })
+                    start_session()
+                    add_message("assistant", f"Hi, I am {fallback_name}.")
                     
                     # Clear generating flag
                     st.session_state.generating_new_persona = False
@@ -477,14 +780,11 @@ You have already been introduced to the user. Respond naturally to their questio
             else:
                 # No API key provided
                 st.warning("⚠️ No API key provided. Using fallback description.")
-                fallback_name = demographics.split(',')[0].strip() if ',' in demographics else "a person"
-                fallback_desc = f"This is {fallback_name}, who identifies as {denomination} within {religious_tradition}, living in {geographic_context}. Knowledge level: {knowledge_level}, Engagement level: {engagement_level}, Attitude: {attitude_towards_religion}."
+                fallback_name, fallback_desc = fallback_persona(spec)
                 st.session_state.persona_description_text = fallback_desc
                 st.session_state.persona_name = fallback_name
-                st.session_state.messages.append({
-                    "role": "assistant", 
-                    "content": f"Hi, I am {fallback_name}."
-                })
+                start_session()
+                add_message("assistant", f"Hi, I am {fallback_name}.")
                 
                 # Clear generating flag
                 st.session_state.generating_new_persona = False
@@ -493,6 +793,66 @@ You have already been introduced to the user. Respond naturally to their questio
                 st.rerun()
         else:
             st.error("Please fill in all required fields (Religious Tradition, Denomination, Geographic Context, and Demographics)")
+    
+    # Bulk persona generation and the reusable persona library
+    with st.expander("📚 Persona Library", expanded=False):
+        st.markdown("Generate personas for a whole class at once from a CSV or JSON file with these columns:")
+        st.code(spec_csv_template().strip(), language=None)
+        spec_file = st.file_uploader("Persona specs (CSV or JSON):", type=["csv", "json"])
+        library_name = st.text_input("Library name:", value=datetime.now().strftime("Lesson %Y-%m-%d"))
+        if st.button("⚡ Generate All Personas") and spec_file is not None:
+            try:
+                specs = load_specs(spec_file.getvalue(), spec_file.name)
+            except Exception as e:
+                specs = []
+                st.error(f"⚠️ **Could not read persona specs:** {str(e)}")
+            if specs and not api_key:
+                st.error("Please enter an API key in the sidebar.")
+            elif specs:
+                provider = get_provider(llm_choice)
+                
+                def describe(prompt):
+                    # Runs on worker threads, so the trace is not passed back into session state
+                    return chat.generate_persona_description(llm_choice, api_key, prompt, f"batch:{library_name}", kind="batch")
+                
+                progress = st.progress(0.0, text=f"Generating {len(specs)} personas...")
+                records = generate_personas(
+                    specs,
+                    describe,
+                    on_progress=lambda done, total: progress.progress(done / total, text=f"{done}/{total} personas generated")
+                )
+                save_to_library(library_name, records)
+                # Students creating the same persona by hand get it instantly
+                for record in records:
+                    if not record["error"]:
+                        get_persona_cache().put(
+                            persona_cache_key(record["spec"], llm_choice, provider.model),
+                            {key: record[key] for key in ("description", "name", "system_prompt")}
+                        )
+                failed = sum(1 for record in records if record["error"])
+                if failed:
+                    st.warning(f"⚠️ {failed} of {len(records)} descriptions failed and use the fallback description.")
+                else:
+                    st.success(f"✅ {len(records)} personas added to the library.")
+        
+        library = get_persona_library()
+        if library:
+            chosen = st.selectbox(
+                "Use a persona from the library:",
+                range(len(library)),
+                format_func=lambda i: f"{library[i]['name']} – {library[i]['spec']['tradition']}, {library[i]['spec']['denomination']} ({library[i]['library']})"
+            )
+            if st.button("Use Persona"):
+                use_library_persona(library[chosen])
+                prewarm_persona(llm_choice, api_key, prompt_cache, prewarm, pregenerate)
+                st.rerun()
+            st.download_button(
+                label="📄 Download Library (JSON)",
+                data=lambda: library_to_json(library),
+                file_name="persona_library.json",
+                mime="application/json",
+                on_click="ignore"
+            )
 
 with col2:
     st.header("Conversation")
@@ -504,28 +864,72 @@ with col2:
         elif 'persona_description_text' in st.session_state and st.session_state.persona_description_text:
             st.info(st.session_state.persona_description_text)
         
-        # Create scrollable container for chat messages
-        chat_container = st.container(height=500)
-        with chat_container:
-            for message in st.session_state.messages:
-                with st.chat_message(message["role"]):
-                    st.markdown(message["content"])
+        comparison = comparison_branches(compare_models) if compare_mode and len(compare_models) > 1 else []
+        if comparison:
+            chat_containers = render_comparison(comparison)
+            st.caption(f"Only the {llm_choice} conversation is saved and included in downloads.")
+        else:
+            # Create scrollable container for chat messages
+            chat_container = st.container(height=500)
+            with chat_container:
+                render_chat_history()
+        
+        if st.session_state.persona_departed:
+            st.caption(f"{st.session_state.persona_name} has ended the conversation. Further messages are answered locally.")
+        elif st.session_state.offense_count:
+            st.caption(f"Messages flagged as offensive: {st.session_state.offense_count}")
         
         # Chat input outside the container
         user_input = st.chat_input("Ask a question or start a new conversation with a new persona:")
         
         if user_input:
-            if not api_key:
+            if looks_offensive(user_input):
+                st.session_state.offense_count += 1
+            if st.session_state.persona_departed and not comparison:
+                # The persona has left for good (rule 5), so answer locally without an API call
+                add_message("user", user_input)
+                add_message("assistant", departed_reply(st.session_state.persona_name))
+                st.rerun()
+            elif not api_key:
                 st.error("Please enter an API key in the sidebar.")
+            elif comparison:
+                # Every compared model answers at once, each from its own branch of the conversation
+                try:
+                    answer_comparison(comparison, chat_containers, user_input, prompt_cache, stream_responses)
+                    st.rerun()
+                except Exception as e:
+                    st.error(f"Error generating response: {str(e)}")
             else:
                 # Add user message
-                st.session_state.messages.append({"role": "user", "content": user_input})
+                add_message("user", user_input)
                 
                 # Generate response based on selected LLM
                 try:
-                    with st.spinner("Generating response..."):
-                        response = generate_response(llm_choice, api_key, st.session_state.current_persona, st.session_state.messages, user_input)
-                        st.session_state.messages.append({"role": "assistant", "content": response})
+                    # The first question may already have been answered in the background, or by another student
+                    earlier = st.session_state.messages[:-1]
+                    response = opening_answer(llm_choice, user_input)
+                    if response is None and reuse_answers:
+                        response = RESPONSES.lookup(llm_choice, st.session_state.current_persona, earlier, user_input, answer_variation)
+                    if response is not None:
+                        add_message("assistant", response)
+                    elif stream_responses:
+                        # Render the new turn in place while the reply streams in
+                        with chat_container:
+                            with st.chat_message("user"):
+                                st.markdown(user_input)
+                            with st.chat_message("assistant"):
+                                on_queue = queue_notice()
+                                response = st.write_stream(stream_response(llm_choice, api_key, st.session_state.current_persona, st.session_state.messages, user_input, prompt_cache, st.session_state.turn_usage, st.session_state.context_window, fallback, on_queue))
+                        add_message("assistant", response)
+                    else:
+                        on_queue = queue_notice()
+                        with st.spinner("Generating response..."):
+                            response = generate_response(llm_choice, api_key, st.session_state.current_persona, st.session_state.messages, user_input, prompt_cache, st.session_state.turn_usage, st.session_state.context_window, fallback, on_queue)
+                            add_message("assistant", response)
+                    if reuse_answers:
+                        RESPONSES.store(llm_choice, st.session_state.current_persona, earlier, user_input, response)
+                    if is_departure_reply(response, st.session_state.offense_count):
+                        st.session_state.persona_departed = True
                     st.rerun()
                 
                 except Exception as e:
@@ -536,20 +940,27 @@ with col2:
         with col_clear:
             if st.button("🔄 Start New Conversation"):
                 st.session_state.messages = []
+                st.session_state.context_window.reset()
+                st.session_state.persona_departed = False
+                st.session_state.offense_count = 0
+                start_session()
                 st.rerun()
         with col_download:
             if st.session_state.messages:
-             conversation_text = format_conversation_for_download()
-             st.download_button(
-                label="📄 Download Conversation",
-                data=conversation_text,
-                file_name=f"religious_conversation_{datetime.now().strftime('%Y%m%d_%H%M%S')}.txt",
-                mime="text/plain"
-        )
+                export_format = st.selectbox("Format", list(FORMATS), key="export_format", label_visibility="collapsed")
+                st.download_button(
+                    label="📄 Download Conversation",
+                    data=format_conversation_for_download(export_format),
+                    file_name=f"religious_conversation_{datetime.now().strftime('%Y%m%d_%H%M%S')}.{export_format}",
+                    mime=FORMATS[export_format],
+                    on_click="ignore"
+                )
     
     else:
         st.info("👈 Please create a religious persona first using the form on the left.")
 
+touch_session()
+
 # Footer with educational information
 st.markdown("---")
 st.markdown("""
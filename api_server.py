@@ -0,0 +1,413 @@
+"""HTTP/JSON API for embedding personas in a learning management system
+
+Serves persona creation, chat and transcripts from a single asyncio event
+loop, without Streamlit: a chat message costs one provider call rather
+than a full script rerun. It uses the same persona prompt, persona cache,
+context window, departure rule, rate-limit scheduler and transcript store
+as the app, so a session started here can be resumed in the app by its ID
+and the other way round.
+
+    python api_server.py --provider "Claude (Anthropic)"    # key from $RECHAT_API_KEY
+    python api_server.py --dry-run --port 8600                # local stub, no API key
+
+Endpoints (JSON request and response bodies):
+
+    POST /personas                   persona spec, as in the creation form or a batch file
+                                     -> {"session_id", "name", "description", "greeting", "fallback"}
+    POST /sessions/<id>/chat         {"message": "...", "stream": true}
+                                     -> server-sent events: "token" ({"text"}) as the answer streams,
+                                        then "done" ({"answer", "departed"}) or "error" ({"error"});
+                                        with "stream": false, a single {"answer", "departed"}
+    GET  /sessions/<id>/transcript   ?format=txt|md|jsonl
+    GET  /health, GET /metrics
+
+Set RECHAT_API_TOKEN to require "Authorization: Bearer <token>" on every
+request, and RECHAT_API_CORS_ORIGIN to let a browser page on that origin
+call the API directly. Answers stream from the providers' asyncio clients
+on the event loop, so an open chat does not hold a thread.
+"""
+
+import argparse
+import asyncio
+import functools
+import hmac
+import json
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from http import HTTPStatus
+from urllib.parse import parse_qs, urlsplit
+
+import chat
+from context_window import ContextWindow
+from metrics import METRICS
+from persona import (
+    REQUIRED_FIELDS, build_description_prompt, departed_reply, extract_name_from_description, fallback_persona,
+    is_departure_reply, looks_offensive, normalize_spec, render_persona_prompt, replay_conversation,
+)
+from persona_cache import PersonaCache, persona_cache_key
+from prewarm import OPENING_QUESTIONS, PREGENERATE, PREWARM, PREWARMER
+from providers import PROVIDERS, get_provider
+from response_cache import RESPONSE_CACHE, RESPONSES
+from session_memory import SESSION_TTL, REAP_INTERVAL, Message, spill_count
+from storage import DB_PATH, PERSONA_KEYS, ConversationStore
+from transcript import FORMATS, format_transcript
+
+STUB_PROVIDER = "Local stub"
+API_PORT = int(os.environ.get("RECHAT_API_PORT", "8600"))
+# Bearer token every request must carry (empty = no authentication)
+API_TOKEN = os.environ.get("RECHAT_API_TOKEN", "")
+# Origin allowed to call the API from a browser (empty = no CORS headers)
+CORS_ORIGIN = os.environ.get("RECHAT_API_CORS_ORIGIN", "")
+# Threads for blocking work: description calls, rate-limit queueing and transcript store reads
+API_THREADS = int(os.environ.get("RECHAT_API_THREADS", "64"))
+# Idle time (seconds) before a session is dropped when there is no transcript store to reload it from
+UNSTORED_SESSION_TTL = float(os.environ.get("RECHAT_API_SESSION_TTL", str(6 * 3600)))
+MAX_BODY = 64 * 1024
+MAX_HEADERS = 100
+KEEPALIVE_TIMEOUT = 30.0
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+class ApiSession:
+    """One conversation held by the API server"""
+
+    def __init__(self, session_id, persona, messages=(), offset=0):
+        self.session_id = session_id
+        self.persona = persona  # PERSONA_KEYS -> value, as saved in the transcript store
+        self.messages = [Message(msg["role"], msg["content"]) for msg in messages]
+        self.offset = offset  # messages already dropped from memory (still in the store)
+        self.context = ContextWindow()
+        self.departed, self.offense_count = replay_conversation(messages)
+        self.lock = asyncio.Lock()  # one chat turn at a time per session
+        self.last_seen = time.monotonic()
+
+class ApiServer:
+    def __init__(self, llm_choice, api_key, store=None, persona_cache=None, prompt_cache=False):
+        self.llm_choice = llm_choice
+        self.api_key = api_key
+        self.store = store
+        self.persona_cache = persona_cache if persona_cache is not None else PersonaCache()
+        self.prompt_cache = prompt_cache
+        self.sessions = {}
+        # Stored sessions reload after eviction; unstored ones are gone for good, so they are kept longer
+        self.session_ttl = SESSION_TTL if store is not None else UNSTORED_SESSION_TTL
+        self.executor = ThreadPoolExecutor(max_workers=API_THREADS, thread_name_prefix="api")
+
+    async def blocking(self, func, *args, **kwargs):
+        """Run a blocking call on the server's thread pool"""
+        return await asyncio.get_running_loop().run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+    # Sessions
+
+    def add_message(self, session, role, content):
+        session.messages.append(Message(role, content))
+        if self.store is not None:
+            self.store.append_message(session.session_id, session.offset + len(session.messages) - 1, role, content)
+            count = spill_count(len(session.messages))
+            if count:
+                session.context.trim(session.messages, count)
+                del session.messages[:count]
+                session.offset += count
+
+    async def get_session(self, session_id):
+        """A session from memory, or reloaded from the transcript store"""
+        session = self.sessions.get(session_id)
+        if session is None and self.store is not None:
+            stored = await self.blocking(self.store.load_session, session_id)
+            session = self.sessions.get(session_id)
+            if session is None and stored is not None and stored[0].get("current_persona"):
+                persona, messages = stored
+                offset = spill_count(len(messages))
+                session = self.sessions[session_id] = ApiSession(session_id, persona, messages[offset:], offset)
+                session.context.resume(messages[:offset])
+                # Departure and offenses count the whole conversation, not just the part kept in memory
+                session.departed, session.offense_count = replay_conversation(messages)
+        if session is None:
+            raise HTTPError(404, f"No session {session_id}")
+        session.last_seen = time.monotonic()
+        return session
+
+    async def reap(self):
+        """Drop idle sessions: stored ones reload on their next request, unstored ones expire for good"""
+        while True:
+            await asyncio.sleep(REAP_INTERVAL)
+            idle = [
+                session_id for session_id, session in self.sessions.items()
+                if time.monotonic() - session.last_seen >= self.session_ttl and not session.lock.locked()
+            ]
+            for session_id in idle:
+                del self.sessions[session_id]
+
+    # Endpoints
+
+    def generate_persona(self, spec):
+        """Description, name and system prompt, shared with the app through the persona cache"""
+        def generate():
+            description = chat.generate_persona_description(self.llm_choice, self.api_key, build_description_prompt(spec), kind="api")
+            name = extract_name_from_description(description)
+            return {"description": description, "name": name, "system_prompt": render_persona_prompt(spec, name)}
+
+        key = persona_cache_key(spec, self.llm_choice, get_provider(self.llm_choice).model)
+        return self.persona_cache.get_or_create(key, generate)
+
+    async def create_persona(self, body):
+        spec = normalize_spec(body)
+        missing = [field for field in REQUIRED_FIELDS if not spec[field]]
+        if missing:
+            raise HTTPError(400, f"Missing {', '.join(missing)}")
+        error = ""
+        try:
+            record = await self.blocking(self.generate_persona, spec)
+            name, description, system_prompt = record["name"], record["description"], record["system_prompt"]
+        except Exception as e:
+            name, description = fallback_persona(spec)
+            system_prompt = render_persona_prompt(spec, name)
+            error = str(e)
+        persona = {f"persona_{field}": value for field, value in spec.items()}
+        persona["persona_personality"] = spec["personality"] or "Not specified"
+        persona.update({"persona_name": name, "persona_description_text": description, "current_persona": system_prompt})
+
+        session = ApiSession(uuid.uuid4().hex[:12], persona)
+        self.sessions[session.session_id] = session
+        if self.store is not None:
+            self.store.save_session(session.session_id, name, {key: persona.get(key, "") for key in PERSONA_KEYS})
+        greeting = f"Hi, I am {name}."
+        self.add_message(session, "assistant", greeting)
+        if not error and (PREWARM or PREGENERATE):
+            PREWARMER.start(
+                self.llm_choice, self.api_key, system_prompt, greeting, self.prompt_cache, session.session_id,
+                PREWARM, OPENING_QUESTIONS if PREGENERATE else None
+            )
+        return {
+            "session_id": session.session_id, "name": name, "description": description,
+            "greeting": greeting, "fallback": bool(error), "error": error,
+        }
+
+    async def reply(self, session, message):
+        """Answer one student message, yielding the answer's tokens; the caller holds the session lock"""
+        persona = session.persona["current_persona"]
+        if looks_offensive(message):
+            session.offense_count += 1
+        self.add_message(session, "user", message)
+        earlier = session.messages[:-1]
+        answer = None
+        if session.departed:
+            # The persona has left for good (rule 5), so answer locally without an API call
+            answer = departed_reply(session.persona["persona_name"])
+        elif len(session.messages) == 2 and not session.offset:
+            answer = await self.blocking(PREWARMER.opening_answer, self.llm_choice, persona, message)
+        if answer is None and RESPONSE_CACHE and not session.departed:
+            answer = RESPONSES.lookup(self.llm_choice, persona, earlier, message)
+        if answer is not None:
+            yield answer
+        else:
+            parts = []
+            async for token in chat.stream_response_async(
+                self.llm_choice, self.api_key, persona, session.messages, message, self.prompt_cache,
+                context=session.context, session_id=session.session_id, kind="api", executor=self.executor
+            ):
+                parts.append(token)
+                yield token
+            answer = "".join(parts)
+            if RESPONSE_CACHE:
+                RESPONSES.store(self.llm_choice, persona, earlier, message, answer)
+        self.add_message(session, "assistant", answer)
+        session.departed = session.departed or is_departure_reply(answer, session.offense_count)
+
+    async def transcript(self, session_id, fmt):
+        if fmt not in FORMATS:
+            raise HTTPError(400, f"Unknown format {fmt}; use one of {', '.join(FORMATS)}")
+        session = self.sessions.get(session_id)
+        if session is not None and not session.offset:
+            return format_transcript(session.persona, session.messages, fmt)
+        if self.store is None:
+            raise HTTPError(404, f"No session {session_id}")
+        await self.blocking(self.store.flush, 5)
+        stored = await self.blocking(self.store.load_session, session_id)
+        if stored is None:
+            raise HTTPError(404, f"No session {session_id}")
+        return format_transcript(stored[0], stored[1], fmt)
+
+    # HTTP
+
+    def headers(self, content_type, length=None, keep_alive=True):
+        lines = [f"Content-Type: {content_type}", "Cache-Control: no-store"]
+        if length is not None:
+            lines.append(f"Content-Length: {length}")
+        lines.append("Connection: keep-alive" if keep_alive else "Connection: close")
+        if CORS_ORIGIN:
+            lines += [
+                f"Access-Control-Allow-Origin: {CORS_ORIGIN}",
+                "Access-Control-Allow-Headers: Authorization, Content-Type",
+                "Access-Control-Allow-Methods: GET, POST, OPTIONS",
+            ]
+        return lines
+
+    async def send(self, writer, status, body, content_type, keep_alive=True):
+        if isinstance(body, str):
+            body = body.encode("utf-8")
+        head = [f"HTTP/1.1 {status} {HTTPStatus(status).phrase}"] + self.headers(content_type, len(body), keep_alive)
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + body)
+        await writer.drain()
+
+    async def send_json(self, writer, status, payload, keep_alive=True):
+        await self.send(writer, status, json.dumps(payload, ensure_ascii=False), "application/json; charset=utf-8", keep_alive)
+
+    async def send_events(self, writer, session, message):
+        """Stream a chat answer as server-sent events; the connection closes afterwards"""
+        head = ["HTTP/1.1 200 OK"] + self.headers("text/event-stream; charset=utf-8", keep_alive=False)
+        writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+
+        def event(name, payload):
+            return f"event: {name}\ndata: {json.dumps(payload, ensure_ascii=False)}\n\n".encode("utf-8")
+
+        parts = []
+        async with session.lock:
+            try:
+                async for token in self.reply(session, message):
+                    parts.append(token)
+                    writer.write(event("token", {"text": token}))
+                    await writer.drain()
+                writer.write(event("done", {"answer": "".join(parts), "departed": session.departed}))
+            except (ConnectionError, asyncio.CancelledError):
+                raise
+            except Exception as e:
+                writer.write(event("error", {"error": str(e)}))
+        await writer.drain()
+
+    async def dispatch(self, method, target, headers, body, writer):
+        """Route one request; returns False if the connection must close afterwards"""
+        url = urlsplit(target)
+        parts = [part for part in url.path.split("/") if part]
+        if method == "OPTIONS":
+            await self.send(writer, 204, b"", "text/plain")
+            return True
+        if API_TOKEN and not hmac.compare_digest(
+            headers.get("authorization", "").encode("utf-8"), f"Bearer {API_TOKEN}".encode("utf-8")
+        ):
+            raise HTTPError(401, "Missing or wrong bearer token")
+        if method == "GET" and parts == ["health"]:
+            await self.send_json(writer, 200, {"status": "ok", "provider": self.llm_choice, "sessions": len(self.sessions)})
+        elif method == "GET" and parts == ["metrics"]:
+            await self.send(writer, 200, METRICS.render_prometheus(), "text/plain; version=0.0.4; charset=utf-8")
+        elif method == "POST" and parts == ["personas"]:
+            await self.send_json(writer, 201, await self.create_persona(parse_json(body)))
+        elif method == "POST" and len(parts) == 3 and parts[0] == "sessions" and parts[2] == "chat":
+            payload = parse_json(body)
+            message = str(payload.get("message", "")).strip()
+            if not message:
+                raise HTTPError(400, "Missing message")
+            session = await self.get_session(parts[1])
+            if payload.get("stream", True):
+                await self.send_events(writer, session, message)
+                return False
+            async with session.lock:
+                answer = "".join([token async for token in self.reply(session, message)])
+            await self.send_json(writer, 200, {"answer": answer, "departed": session.departed})
+        elif method == "GET" and len(parts) == 3 and parts[0] == "sessions" and parts[2] == "transcript":
+            fmt = parse_qs(url.query).get("format", ["txt"])[0]
+            await self.send(writer, 200, await self.transcript(parts[1], fmt), f"{FORMATS.get(fmt, 'text/plain')}; charset=utf-8")
+        elif parts in (["health"], ["metrics"], ["personas"]) or (len(parts) == 3 and parts[0] == "sessions"):
+            raise HTTPError(405, f"{method} not allowed on {url.path}")
+        else:
+            raise HTTPError(404, f"No endpoint {url.path}")
+        return True
+
+    async def handle(self, reader, writer):
+        """Serve one connection, with HTTP/1.1 keep-alive between requests"""
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), KEEPALIVE_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line.strip():
+                    break
+                headers = {}
+                for _ in range(MAX_HEADERS):
+                    line = await reader.readline()
+                    if not line.strip():
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                try:
+                    method, target, version = request_line.decode("latin-1").split()
+                    length = int(headers.get("content-length") or 0)
+                except ValueError:
+                    await self.send_json(writer, 400, {"error": "Malformed request"}, keep_alive=False)
+                    break
+                if length > MAX_BODY:
+                    await self.send_json(writer, 413, {"error": f"Body larger than {MAX_BODY} bytes"}, keep_alive=False)
+                    break
+                body = await reader.readexactly(length) if length else b""
+                keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                try:
+                    keep_alive = await self.dispatch(method, target, headers, body, writer) and keep_alive
+                except HTTPError as e:
+                    await self.send_json(writer, e.status, {"error": str(e)}, keep_alive)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    raise
+                except Exception as e:
+                    await self.send_json(writer, 500, {"error": str(e)}, keep_alive)
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass  # client went away
+        finally:
+            writer.close()
+
+    async def serve(self, host="127.0.0.1", port=API_PORT):
+        server = await asyncio.start_server(self.handle, host, port, limit=MAX_BODY)
+        reaper = asyncio.ensure_future(self.reap()) if self.session_ttl > 0 else None
+        print(f"Serving {self.llm_choice} personas on http://{host}:{port}", file=sys.stderr)
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            if reaper is not None:
+                reaper.cancel()
+
+def parse_json(body):
+    """Decoded JSON object from a request body"""
+    try:
+        payload = json.loads(body or b"{}")
+    except ValueError:
+        raise HTTPError(400, "Body is not valid JSON")
+    if not isinstance(payload, dict):
+        raise HTTPError(400, "Body must be a JSON object")
+    return payload
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve persona creation, chat and transcripts over HTTP/JSON")
+    parser.add_argument("--host", default="127.0.0.1", help="interface to listen on (0.0.0.0 for all)")
+    parser.add_argument("--port", type=int, default=API_PORT, help="port to listen on (default: $RECHAT_API_PORT or 8600)")
+    parser.add_argument("--provider", default="OpenAI GPT-4o", choices=list(PROVIDERS), help="model the personas run on")
+    parser.add_argument("--api-key", default=os.environ.get("RECHAT_API_KEY", ""), help="API key (default: $RECHAT_API_KEY)")
+    parser.add_argument("--prompt-cache", action="store_true", help="use provider prompt caching")
+    parser.add_argument("--dry-run", action="store_true", help="use the local stub provider instead of a real API")
+    args = parser.parse_args()
+
+    llm_choice, api_key = args.provider, args.api_key
+    if args.dry_run or llm_choice == STUB_PROVIDER:
+        llm_choice, api_key = STUB_PROVIDER, "local-stub"
+    if not api_key:
+        parser.error("an API key is needed (--api-key or RECHAT_API_KEY), or use --dry-run")
+
+    store = ConversationStore(DB_PATH) if DB_PATH else None
+    server = ApiServer(llm_choice, api_key, store, prompt_cache=args.prompt_cache)
+    try:
+        asyncio.run(server.serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if store is not None:
+            store.close()
+
+if __name__ == "__main__":
+    main()
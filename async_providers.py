@@ -0,0 +1,270 @@
+import asyncio
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+
+# Seconds to wait for the first token, per provider, before the attempt counts as timed out
+FIRST_TOKEN_TIMEOUTS = {
+    "OpenAI GPT-4o": 20.0,
+    "Claude (Anthropic)": 20.0,
+    "Google Gemini": 30.0,
+}
+if os.environ.get("RECHAT_FIRST_TOKEN_TIMEOUT"):
+    FIRST_TOKEN_TIMEOUTS = {name: float(os.environ["RECHAT_FIRST_TOKEN_TIMEOUT"]) for name in FIRST_TOKEN_TIMEOUTS}
+DEFAULT_FIRST_TOKEN_TIMEOUT = 30.0
+# Seconds for a whole reply, first token included
+REQUEST_TIMEOUT = float(os.environ.get("RECHAT_REQUEST_TIMEOUT", "90"))
+MAX_ATTEMPTS = int(os.environ.get("RECHAT_MAX_ATTEMPTS", "3"))
+BACKOFF_BASE = 0.5
+BACKOFF_CAP = 8.0
+# Fire the secondary provider if the primary has no first token after this many seconds (0 = only on failure)
+HEDGE_AFTER = float(os.environ.get("RECHAT_HEDGE_AFTER", "0"))
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+RETRYABLE_ERRORS = {
+    "APIConnectionError", "APITimeoutError", "InternalServerError", "RateLimitError",
+    "ServiceUnavailable", "DeadlineExceeded", "ResourceExhausted", "TooManyRequests",
+}
+
+# Blocking SDK calls (no async client given) run on a shared pool and hand tokens to the event loop
+PROVIDER_THREADS = int(os.environ.get("RECHAT_PROVIDER_THREADS", "32"))
+_executor = ThreadPoolExecutor(max_workers=PROVIDER_THREADS, thread_name_prefix="provider")
+_STARTED = object()
+_DONE = object()
+
+class ProviderTimeout(Exception):
+    pass
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+class ProviderCall:
+    """One request against one provider: the plugin, its pooled client and the request arguments
+
+    With an async client, a streaming call runs on the event loop through
+    the SDK's asyncio API; otherwise it runs on the provider thread pool.
+    admit, if given, is awaited once before the call is first sent (e.g. to
+    queue for its provider's rate limits) and returns the call's ticket.
+    """
+
+    def __init__(self, provider, client, request, stream=True, async_client=None, admit=None):
+        self.provider = provider
+        self.client = client
+        self.request = request
+        self.stream = stream
+        self.async_client = async_client
+        self.admit = admit
+        self.ticket = None
+
+    @property
+    def name(self):
+        return self.provider.name
+
+    @property
+    def native(self):
+        return self.stream and self.async_client is not None
+
+    def iterate(self):
+        if self.stream:
+            yield from self.provider.stream(self.client, **self.request)
+        else:
+            yield self.provider.complete(self.client, **self.request)
+
+def is_retryable(error):
+    """True for timeouts, connection errors, 429 and 5xx responses"""
+    if isinstance(error, (ProviderTimeout, TimeoutError, ConnectionError)):
+        return True
+    status = getattr(error, "status_code", None)
+    if status is None:
+        status = getattr(error, "code", None)
+    if isinstance(status, int):
+        return status in RETRYABLE_STATUS
+    return type(error).__name__ in RETRYABLE_ERRORS
+
+def backoff_delay(attempt, error=None, base=BACKOFF_BASE, cap=BACKOFF_CAP):
+    """Full-jitter exponential backoff, never shorter than the server's Retry-After"""
+    delay = random.uniform(0, min(cap, base * 2 ** attempt))
+    response = getattr(error, "response", None)
+    retry_after = getattr(response, "headers", {}).get("retry-after") if response is not None else None
+    try:
+        return max(delay, min(cap, float(retry_after)))
+    except (TypeError, ValueError):
+        return delay
+
+async def _native_stream(call, first_token_timeout, request_timeout):
+    """Yield a call's tokens from the SDK's async stream, cancelling the request on a timeout"""
+    loop = asyncio.get_running_loop()
+    stream = call.provider.astream(call.async_client, **call.request)
+    deadline = loop.time() + request_timeout
+    first = True
+    try:
+        while True:
+            timeout = min(first_token_timeout, deadline - loop.time()) if first else deadline - loop.time()
+            try:
+                token = await asyncio.wait_for(stream.__anext__(), max(timeout, 0))
+            except StopAsyncIteration:
+                return
+            except asyncio.TimeoutError:
+                raise ProviderTimeout(f"{call.name} timed out waiting for {'first token' if first else 'response'}")
+            first = False
+            yield token
+    finally:
+        await stream.aclose()
+
+async def stream_call(call, first_token_timeout=None, request_timeout=REQUEST_TIMEOUT):
+    """Yield a provider call's tokens asynchronously, natively or from a blocking call on the worker pool
+
+    A non-streaming call produces its only item when the whole completion is
+    done, so it gets the full request timeout rather than the first-token one.
+    The timeouts start once a worker thread picks the call up; time spent
+    queued for a thread is bounded by the request timeout on its own.
+    """
+    if first_token_timeout is None:
+        first_token_timeout = FIRST_TOKEN_TIMEOUTS.get(call.name, DEFAULT_FIRST_TOKEN_TIMEOUT)
+    if call.native:
+        async for token in _native_stream(call, first_token_timeout, request_timeout):
+            yield token
+        return
+    if not call.stream:
+        first_token_timeout = request_timeout
+    loop = asyncio.get_running_loop()
+    queue = asyncio.Queue()
+    cancelled = False
+
+    def put(item):
+        try:
+            loop.call_soon_threadsafe(queue.put_nowait, item)
+        except RuntimeError:
+            pass  # loop already closed, nobody is listening
+
+    def produce():
+        if cancelled:
+            return  # timed out or abandoned while queued for a worker; never send the request
+        put(_STARTED)
+        try:
+            for token in call.iterate():
+                if cancelled:
+                    break  # closes the SDK stream
+                put(token)
+            put(_DONE)
+        except Exception as e:
+            put(_Failure(e))
+
+    loop.run_in_executor(_executor, produce)
+    deadline = loop.time() + request_timeout
+    started, first = False, True
+    try:
+        while True:
+            timeout = min(first_token_timeout, deadline - loop.time()) if started and first else deadline - loop.time()
+            try:
+                item = await asyncio.wait_for(queue.get(), max(timeout, 0))
+            except asyncio.TimeoutError:
+                stage = "a worker thread" if not started else "first token" if first else "response"
+                raise ProviderTimeout(f"{call.name} timed out waiting for {stage}")
+            if item is _STARTED:
+                started = True
+                deadline = loop.time() + request_timeout
+                continue
+            if item is _DONE:
+                return
+            if isinstance(item, _Failure):
+                raise item.error
+            first = False
+            yield item
+    finally:
+        cancelled = True
+
+async def stream_with_retry(call, max_attempts=MAX_ATTEMPTS, trace=None):
+    """Stream a call, retrying with jittered backoff while no token has been produced yet"""
+    if call.admit is not None and call.ticket is None:
+        call.ticket = await call.admit()
+    for attempt in range(max_attempts):
+        started = False
+        try:
+            async for token in stream_call(call):
+                started = True
+                yield token
+            return
+        except Exception as e:
+            if started or attempt == max_attempts - 1 or not is_retryable(e):
+                raise
+            if isinstance(e, ProviderTimeout) and not call.stream:
+                raise  # the timed-out completion cannot be cancelled and is still running (and billed)
+            if trace is not None:
+                trace.retries += 1
+            await asyncio.sleep(backoff_delay(attempt, e))
+
+async def _first(stream):
+    """Wait for the first token; (token, finished) with finished=True for an empty reply"""
+    try:
+        return await stream.__anext__(), False
+    except StopAsyncIteration:
+        return "", True
+
+def _mark_winner(trace, call):
+    if trace is not None:
+        trace.token()
+        trace.provider = call.name
+        trace.model = call.provider.model
+
+async def hedged_stream(primary, secondary=None, hedge_after=HEDGE_AFTER, trace=None):
+    """Yield tokens from the primary call, racing the secondary when the primary is slow or fails
+
+    The secondary is fired if the primary has no first token after
+    `hedge_after` seconds (0 disables hedging) or fails outright; whichever
+    produces a first token first wins and the other is cancelled. If a
+    TurnTrace is given, it records retries, the first token and the winner.
+    """
+    primary_stream = stream_with_retry(primary, trace=trace)
+    if secondary is None:
+        async for token in primary_stream:
+            _mark_winner(trace, primary)
+            yield token
+        return
+
+    streams = {asyncio.ensure_future(_first(primary_stream)): primary_stream}
+    done, _ = await asyncio.wait(streams, timeout=hedge_after if hedge_after > 0 else None)
+    primary_task = next(iter(streams))
+    if primary_task in done and primary_task.exception() is None:
+        winner, (token, finished) = primary_stream, primary_task.result()
+    else:
+        secondary_stream = stream_with_retry(secondary, trace=trace)
+        streams[asyncio.ensure_future(_first(secondary_stream))] = secondary_stream
+        winner, last_error = None, None
+        pending = set(streams)
+        while winner is None and pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    last_error = task.exception()
+                elif winner is None:
+                    winner, (token, finished) = streams[task], task.result()
+        for task in pending:
+            task.cancel()
+        for task, stream in streams.items():
+            if stream is not winner:
+                await asyncio.gather(task, return_exceptions=True)
+                await stream.aclose()
+        if winner is None:
+            raise last_error
+
+    _mark_winner(trace, primary if winner is primary_stream else secondary)
+    if token:
+        yield token
+    if not finished:
+        async for token in winner:
+            yield token
+
+def iterate_sync(stream):
+    """Drive an async token stream from synchronous code (e.g. st.write_stream)"""
+    loop = asyncio.new_event_loop()
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(stream.__anext__())
+            except StopAsyncIteration:
+                break
+    finally:
+        loop.run_until_complete(stream.aclose())
+        loop.close()
@@ -0,0 +1,80 @@
+"""Import-time benchmark for app start-up
+
+Runs each import set in a fresh interpreter with `python -X importtime`
+and reports the total import time. "app start-up" is every module
+REchatV2.py imports at the top level, read from its source so the set
+follows the app (Streamlit itself is timed on its own line); "eager" is
+the same plus all provider SDKs, which is what the app paid before they
+were loaded lazily.
+
+    python bench_imports.py [--repeat 5]
+"""
+
+import argparse
+import ast
+import os
+import statistics
+import subprocess
+import sys
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "REchatV2.py")
+SDKS = "openai, anthropic, google.generativeai"
+
+def app_imports(path=APP_PATH, skip=("streamlit",)):
+    """Top-level modules the app imports at start-up, in source order"""
+    with open(path, encoding="utf-8") as f:
+        tree = ast.parse(f.read())
+    modules = []
+    for node in tree.body:
+        if isinstance(node, ast.Import):
+            names = [alias.name for alias in node.names]
+        elif isinstance(node, ast.ImportFrom) and node.level == 0:
+            names = [node.module]
+        else:
+            continue
+        modules += [name for name in names if name.split(".")[0] not in skip and name not in modules]
+    return ", ".join(modules)
+
+IMPORT_SETS = {
+    "streamlit": "import streamlit",
+    "app start-up": f"import {app_imports()}",
+    "eager (app + all SDKs)": f"import {app_imports()}, {SDKS}",
+    "openai": "import openai",
+    "anthropic": "import anthropic",
+    "google.generativeai": "import google.generativeai",
+}
+
+def import_time_ms(statement):
+    """Total self time of every module imported by `statement`, in milliseconds"""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", statement],
+        capture_output=True,
+        text=True,
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    if result.returncode != 0:
+        return None
+    total_us = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us = line.split(":", 1)[1].split("|")[0].strip()
+        total_us += int(self_us)
+    return total_us / 1000
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark import time of the provider SDKs")
+    parser.add_argument("--repeat", type=int, default=5, help="runs per import set (median is reported)")
+    args = parser.parse_args()
+
+    print(f"{'import set':<24}{'median ms':>12}{'min ms':>10}")
+    print("-" * 46)
+    for label, statement in IMPORT_SETS.items():
+        timings = [import_time_ms(statement) for _ in range(args.repeat)]
+        if None in timings:
+            print(f"{label:<24}{'not installed':>12}")
+            continue
+        print(f"{label:<24}{statistics.median(timings):>12.1f}{min(timings):>10.1f}")
+
+if __name__ == "__main__":
+    main()
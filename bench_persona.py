@@ -0,0 +1,139 @@
+"""Micro-benchmarks for the per-persona and per-message text paths
+
+Times persona prompt rendering, name extraction and transcript formatting,
+each next to a reference implementation (str.format on the same prompt
+text, the one-search-per-pattern name extraction persona.py used before,
+and a full re-format of the transcript), and checks that both produce the
+same output.
+
+    python bench_persona.py [--repeat 5] [--number 2000] [--check]
+
+With --check the exit status is 1 if any output differs from its
+reference or a path has become slower than its reference, so the script
+can run in CI to catch regressions.
+"""
+
+import argparse
+import re
+import statistics
+import sys
+import timeit
+
+from persona import PERSONA_TEMPLATE, build_description_prompt, extract_name_from_description, normalize_spec, render_persona_prompt
+from transcript import TranscriptBuffer, format_transcript
+
+SPEC = normalize_spec({
+    "tradition": "Islam",
+    "denomination": "Sunni",
+    "context": "Stockholm, Sweden",
+    "demographics": "28-year-old software engineer",
+    "personality": "",
+    "knowledge_level": "Medium",
+    "engagement_level": "High",
+    "attitude": "Positive",
+})
+DESCRIPTIONS = [
+    "This is Ahmed, a 28-year-old software engineer living in Stockholm. He identifies as Sunni Muslim.",
+    "Sara grew up in Malmö. Meet Sara, a nurse who identifies as Lutheran with low engagement.",
+    "A retired teacher named Lena lives in Umeå and attends Mass every Sunday.",
+    "[Smiling] Yusuf works nights at a hospital in Gothenburg. He prays when he can.",
+]
+PERSONA = {f"persona_{field}": value for field, value in SPEC.items()}
+PERSONA["persona_description_text"] = DESCRIPTIONS[0]
+DOWNLOADED = "2024-01-01 12:00:00"
+TRANSCRIPT_LENGTH = 200
+
+def reference_extract_name(description):
+    """extract_name_from_description as it was, with one re.search per pattern"""
+    patterns = [
+        r'This is ([A-Z][a-z]+)',
+        r'Meet ([A-Z][a-z]+)',
+        r'^([A-Z][a-z]+),',
+        r'named ([A-Z][a-z]+)',
+    ]
+    for pattern in patterns:
+        match = re.search(pattern, description)
+        if match:
+            return match.group(1)
+    for word in description.split('.')[0].split():
+        cleaned = word.strip('[](),')
+        if cleaned and cleaned[0].isupper() and len(cleaned) > 2 and cleaned.isalpha():
+            return cleaned
+    return "The persona"
+
+def reference_render(spec, name):
+    """render_persona_prompt's output rebuilt with str.format, which re-parses the template on every call"""
+    return PERSONA_TEMPLATE.text.format(
+        name=name, personality=spec['personality'] or 'Not specified - use natural variation',
+        **{field: value for field, value in spec.items() if field != 'personality'}
+    )
+
+def transcript_messages(count):
+    return [
+        {"role": "user" if i % 2 else "assistant", "content": f"Message {i}: " + "lorem ipsum dolor sit amet " * 8}
+        for i in range(count)
+    ]
+
+def incremental_transcript():
+    """One new message on a long conversation, rendered through a warm TranscriptBuffer"""
+    messages = transcript_messages(TRANSCRIPT_LENGTH - 1)
+    buffer = TranscriptBuffer()
+    buffer.render(messages, PERSONA, "txt", DOWNLOADED)
+
+    def run():
+        messages.append({"role": "user", "content": "One more question?"})
+        text = buffer.render(messages, PERSONA, "txt", DOWNLOADED)
+        messages.pop()
+        del buffer.chunks["txt"][len(messages):]
+        return text
+    return run
+
+def full_transcript():
+    messages = transcript_messages(TRANSCRIPT_LENGTH)
+    messages[-1] = {"role": "user", "content": "One more question?"}
+    return lambda: format_transcript(PERSONA, messages, "txt", DOWNLOADED)
+
+# name -> (benchmark, reference), each a zero-argument callable returning the output to compare
+BENCHMARKS = {
+    "render persona prompt": (lambda: render_persona_prompt(SPEC, "Ahmed"), lambda: reference_render(SPEC, "Ahmed")),
+    "build description prompt": (lambda: build_description_prompt(SPEC), None),
+    "extract name": (
+        lambda: [extract_name_from_description(d) for d in DESCRIPTIONS],
+        lambda: [reference_extract_name(d) for d in DESCRIPTIONS],
+    ),
+    f"transcript, +1 of {TRANSCRIPT_LENGTH} msgs": (incremental_transcript(), full_transcript()),
+}
+
+def time_us(func, number, repeat):
+    """Median microseconds per call over `repeat` runs of `number` calls"""
+    return statistics.median(timeit.repeat(func, number=number, repeat=repeat)) / number * 1e6
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark persona rendering, name extraction and transcript formatting")
+    parser.add_argument("--repeat", type=int, default=5, help="timing runs per benchmark (median is reported)")
+    parser.add_argument("--number", type=int, default=2000, help="calls per timing run")
+    parser.add_argument("--check", action="store_true", help="exit 1 on a mismatch or a path slower than its reference")
+    args = parser.parse_args()
+
+    failures = []
+    print(f"{'benchmark':<32}{'us/call':>10}{'reference':>12}{'speedup':>10}")
+    print("-" * 64)
+    for label, (func, reference) in BENCHMARKS.items():
+        elapsed = time_us(func, args.number, args.repeat)
+        if reference is None:
+            print(f"{label:<32}{elapsed:>10.2f}")
+            continue
+        if func() != reference():
+            failures.append(f"{label}: output differs from the reference")
+        baseline = time_us(reference, args.number, args.repeat)
+        print(f"{label:<32}{elapsed:>10.2f}{baseline:>12.2f}{baseline / elapsed:>9.1f}x")
+        if elapsed > baseline:
+            failures.append(f"{label}: slower than the reference")
+
+    for failure in failures:
+        print(failure, file=sys.stderr)
+    if args.check and failures:
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+import asyncio
+
+from async_providers import ProviderCall, hedged_stream, iterate_sync
+from context_window import count_tokens, message_tokens
+from llm_clients import ClientRegistry
+from metrics import TurnTrace
+from providers import get_provider
+from rate_limit import SCHEDULER
+
+# Provider client pool shared by everything in this process (the app, the CLI, the API server)
+CLIENTS = ClientRegistry()
+# Async SDK clients for stream_response_async, bound to the API server's event loop
+ASYNC_CLIENTS = ClientRegistry(native_async=True)
+
+# Output tokens reserved against the tokens-per-minute budget before a call
+DESCRIPTION_TOKENS = 200
+RESPONSE_TOKENS = 500
+WARMUP_TOKENS = 1
+
+# History window sent with each request, and the step the window start moves by when prompt caching is on
+HISTORY_WINDOW = 10
+CACHE_WINDOW_STEP = 6
+
+def new_trace(llm_choice, session_id="", kind="chat"):
+    return TurnTrace(llm_choice, get_provider(llm_choice).model, session_id, kind)
+
+def finish_trace(trace, error=None, on_trace=None):
+    """Close a trace and hand the finished record to on_trace (e.g. the app's debug panel)"""
+    record = trace.finish(error)
+    if on_trace is not None:
+        on_trace(record)
+    return record
+
+def wait_for_turn(llm_choice, api_key, tokens, trace, on_queue=None):
+    """Queue behind other sessions sharing this API key until its rate limits allow the request"""
+    ticket = SCHEDULER.acquire(llm_choice, api_key, trace.session_id, tokens, on_queue)
+    trace.queue_wait = ticket.waited
+    if on_queue is not None and ticket.waited:
+        on_queue(None)
+    return ticket
+
+def settle_turn(ticket, trace, llm_choice=None):
+    """Correct the key's token budget with the usage the provider (llm_choice's, if given) reported"""
+    usage = [entry for entry in trace.usage if llm_choice is None or entry["provider"] == llm_choice]
+    if usage:
+        ticket.settle(sum(entry["input_tokens"] + entry["output_tokens"] for entry in usage))
+
+def settle_calls(ticket, primary, secondary, trace):
+    """Settle the primary's ticket, and the secondary's if it was fired, each against its own provider's usage"""
+    settle_turn(ticket, trace, primary.name)
+    if secondary is not None and secondary.ticket is not None:
+        settle_turn(secondary.ticket, trace, secondary.name)
+
+def fallback_admission(llm_choice, api_key, request, session_id):
+    """Queue a fired fallback call for its own provider's rate limits; an async hook for ProviderCall.admit"""
+    async def admit():
+        return await asyncio.to_thread(SCHEDULER.acquire, llm_choice, api_key, session_id, request_tokens(request))
+    return admit
+
+def generate_persona_description(llm_choice, api_key, desc_prompt, session_id="", on_trace=None, kind="describe"):
+    """Generate persona description - separate from conversation"""
+    trace = new_trace(llm_choice, session_id, kind)
+    try:
+        provider = get_provider(llm_choice)
+        client = CLIENTS.get(llm_choice, api_key)
+        ticket = wait_for_turn(llm_choice, api_key, count_tokens(desc_prompt) + DESCRIPTION_TOKENS, trace)
+        description = provider.describe(client, desc_prompt)
+        trace.token()
+        settle_turn(ticket, trace)
+        finish_trace(trace, on_trace=on_trace)
+        return description
+
+    except Exception as e:
+        finish_trace(trace, e, on_trace)
+        raise Exception(f"Description generation error: {str(e)}")
+
+def warm_up(llm_choice, api_key, persona, history, prompt_cache=False, session_id=""):
+    """Open the pooled connection and, with prompt caching on, write the persona prefix to the provider's cache"""
+    trace = new_trace(llm_choice, session_id, "warmup")
+    try:
+        provider = get_provider(llm_choice)
+        client = CLIENTS.get(llm_choice, api_key)
+        ticket = wait_for_turn(llm_choice, api_key, count_tokens(persona) + WARMUP_TOKENS, trace)
+        provider.warm(client, persona, history, prompt_cache, trace.usage)
+        trace.token()
+        settle_turn(ticket, trace)
+        return finish_trace(trace)
+
+    except Exception as e:
+        finish_trace(trace, e)
+        raise Exception(f"Warm-up error: {str(e)}")
+
+def select_history(messages, prompt_cache=False, context=None, summarize=None):
+    """Pick the slice of history sent to the model, plus a summary of anything older"""
+    step = CACHE_WINDOW_STEP if prompt_cache else 1
+    if context is not None:
+        return context.fit(messages, summarize, step)
+    if not prompt_cache:
+        return messages[-HISTORY_WINDOW:], ""
+    # Advance the window start in fixed steps so the request prefix stays byte-identical for several turns
+    start = max(0, len(messages) - HISTORY_WINDOW)
+    start -= start % step
+    return messages[start:], ""
+
+def summarize_history(llm_choice, api_key, summary, dropped, session_id="", on_trace=None):
+    """Fold turns that left the context window into the running conversation summary"""
+    transcript = "\n".join(
+        f"{'Student' if msg['role'] == 'user' else 'Persona'}: {msg['content']}" for msg in dropped
+    )
+    summary_prompt = f"""
+Update the running summary of an interview between a student and a religious persona. Keep what the student asked, what the persona said about themselves, and any offensive behaviour. Write at most 150 words in plain sentences.
+
+Current summary:
+{summary if summary else "(none)"}
+
+New turns:
+{transcript}
+
+Updated summary:
+"""
+    return generate_persona_description(llm_choice, api_key, summary_prompt, session_id, on_trace, kind="summary")
+
+def build_calls(llm_choice, api_key, persona, messages, user_input, prompt_cache, usage_log, context, fallback, stream, session_id="", on_trace=None):
+    """Build the primary provider call and, if a fallback (llm_choice, api_key) is given, the secondary one"""
+    history, summary = select_history(
+        messages, prompt_cache, context,
+        lambda previous, dropped: summarize_history(llm_choice, api_key, previous, dropped, session_id, on_trace)
+    )
+    request = {
+        "persona": persona,
+        "history": history,
+        "user_input": user_input,
+        "summary": summary,
+        "prompt_cache": prompt_cache,
+        "usage_log": usage_log,
+    }
+    primary = ProviderCall(get_provider(llm_choice), CLIENTS.get(llm_choice, api_key), request, stream)
+    secondary = None
+    if fallback and fallback[0] != llm_choice and fallback[1]:
+        secondary = ProviderCall(
+            get_provider(fallback[0]), CLIENTS.get(*fallback), request, stream,
+            admit=fallback_admission(fallback[0], fallback[1], request, session_id)
+        )
+    return primary, secondary
+
+def use_async_clients(primary, secondary, llm_choice, api_key, fallback):
+    """Switch calls to the SDKs' asyncio clients, so they stream on the running loop without a thread"""
+    primary.async_client = ASYNC_CLIENTS.get(llm_choice, api_key)
+    if secondary is not None:
+        secondary.async_client = ASYNC_CLIENTS.get(*fallback)
+
+def request_tokens(request):
+    """Rough token cost of a chat request, reserved from the key's budget while it is queued"""
+    return (
+        count_tokens(request["persona"]) + count_tokens(request["summary"]) + count_tokens(request["user_input"])
+        + sum(message_tokens(msg) for msg in request["history"]) + RESPONSE_TOKENS
+    )
+
+def generate_response(llm_choice, api_key, persona, messages, user_input, prompt_cache=False, usage_log=None, context=None, fallback=None, on_queue=None, session_id="", on_trace=None, kind="chat"):
+    """Generate response based on selected LLM"""
+
+    trace = new_trace(llm_choice, session_id, kind)
+    try:
+        primary, secondary = build_calls(llm_choice, api_key, persona, messages, user_input, prompt_cache, trace.usage, context, fallback, False, session_id, on_trace)
+        ticket = wait_for_turn(llm_choice, api_key, request_tokens(primary.request), trace, on_queue)
+        response = "".join(iterate_sync(hedged_stream(primary, secondary, trace=trace)))
+        settle_calls(ticket, primary, secondary, trace)
+        finish_trace(trace, on_trace=on_trace)
+        if usage_log is not None:
+            usage_log.extend(trace.usage)
+        return response
+
+    except Exception as e:
+        finish_trace(trace, e, on_trace)
+        raise Exception(f"API Error: {str(e)}")
+
+def stream_response(llm_choice, api_key, persona, messages, user_input, prompt_cache=False, usage_log=None, context=None, fallback=None, on_queue=None, session_id="", on_trace=None, kind="chat"):
+    """Stream response tokens from the selected LLM as they arrive"""
+
+    trace = new_trace(llm_choice, session_id, kind)
+    try:
+        primary, secondary = build_calls(llm_choice, api_key, persona, messages, user_input, prompt_cache, trace.usage, context, fallback, True, session_id, on_trace)
+        ticket = wait_for_turn(llm_choice, api_key, request_tokens(primary.request), trace, on_queue)
+        yield from iterate_sync(hedged_stream(primary, secondary, trace=trace))
+        settle_calls(ticket, primary, secondary, trace)
+        finish_trace(trace, on_trace=on_trace)
+        if usage_log is not None:
+            usage_log.extend(trace.usage)
+
+    except Exception as e:
+        finish_trace(trace, e, on_trace)
+        raise Exception(f"API Error: {str(e)}")
+
+async def stream_response_async(llm_choice, api_key, persona, messages, user_input, prompt_cache=False, usage_log=None, context=None, fallback=None, session_id="", on_trace=None, kind="chat", executor=None):
+    """stream_response for callers already running an event loop (the API server)
+
+    Building the request (which may summarise old turns) and queueing for
+    the rate limiter block, so they run on `executor`; the provider stream
+    itself is awaited on the loop with the SDK's asyncio client, and only
+    falls back to the provider thread pool for a provider without one.
+    """
+    loop = asyncio.get_running_loop()
+    trace = new_trace(llm_choice, session_id, kind)
+    try:
+        primary, secondary = await loop.run_in_executor(
+            executor, build_calls, llm_choice, api_key, persona, messages, user_input, prompt_cache, trace.usage, context, fallback, True, session_id, on_trace
+        )
+        use_async_clients(primary, secondary, llm_choice, api_key, fallback)
+        ticket = await loop.run_in_executor(executor, wait_for_turn, llm_choice, api_key, request_tokens(primary.request), trace)
+        async for token in hedged_stream(primary, secondary, trace=trace):
+            yield token
+        settle_calls(ticket, primary, secondary, trace)
+        finish_trace(trace, on_trace=on_trace)
+        if usage_log is not None:
+            usage_log.extend(trace.usage)
+
+    except Exception as e:
+        finish_trace(trace, e, on_trace)
+        raise Exception(f"API Error: {str(e)}")
@@ -0,0 +1,89 @@
+import queue
+import threading
+import time
+from collections import deque
+
+import chat
+from async_providers import REQUEST_TIMEOUT
+from context_window import ContextWindow
+from persona import departed_reply, is_departure_reply
+from session_memory import USAGE_HISTORY
+
+class Branch:
+    """One model's copy of a conversation in comparison mode
+
+    Each model sees only its own earlier answers, so after the first turn
+    the branches drift apart the way separate conversations would.
+    """
+
+    def __init__(self, llm_choice, api_key, messages=None, context=None, usage=None, departed=False):
+        self.llm_choice = llm_choice
+        self.api_key = api_key
+        self.messages = messages if messages is not None else []
+        self.context = context if context is not None else ContextWindow()
+        self.usage = usage if usage is not None else deque(maxlen=USAGE_HISTORY)
+        self.departed = departed
+        self.synced = 0  # length of the main conversation when this branch last kept pace with it
+        self.answer = None
+        self.error = ""
+        self.seconds = None
+
+def _answer(index, branch, persona, user_input, prompt_cache, stream, session_id, events):
+    """Ask one branch's model, passing chunks to the fan-out as they arrive"""
+    started = time.perf_counter()
+    parts = []
+    try:
+        if stream:
+            for chunk in chat.stream_response(
+                branch.llm_choice, branch.api_key, persona, branch.messages, user_input, prompt_cache,
+                branch.usage, branch.context, session_id=session_id, kind="compare"
+            ):
+                parts.append(chunk)
+                events.put((index, chunk))
+        else:
+            parts.append(chat.generate_response(
+                branch.llm_choice, branch.api_key, persona, branch.messages, user_input, prompt_cache,
+                branch.usage, branch.context, session_id=session_id, kind="compare"
+            ))
+            events.put((index, parts[0]))
+        branch.answer = "".join(parts)
+    except Exception as e:
+        branch.error = str(e)
+    branch.seconds = time.perf_counter() - started
+    events.put((index, None))
+
+def fan_out(branches, persona, user_input, name="The persona", prompt_cache=False, stream=True, session_id="", offense_count=0, timeout=REQUEST_TIMEOUT):
+    """Ask every branch the same question at once; yields (index, chunk) as answers stream in
+
+    Each branch's history must already end with the question. A branch
+    yields (index, None) once it is finished, with its answer (or error)
+    and latency on the branch, so the whole turn takes as long as the
+    slowest model rather than the sum of all of them. Branches whose
+    persona has left are answered locally; a branch can only leave once
+    offense_count (the student's offensive messages so far) is positive.
+    """
+    events = queue.Queue()
+    pending = 0
+    for index, branch in enumerate(branches):
+        branch.answer, branch.error, branch.seconds = None, "", None
+        if branch.departed:
+            branch.answer, branch.seconds = departed_reply(name), 0.0
+            events.put((index, branch.answer))
+            events.put((index, None))
+        else:
+            # A thread per branch for this turn only, so one session's comparison never queues behind another's
+            threading.Thread(
+                target=_answer, args=(index, branch, persona, user_input, prompt_cache, stream, session_id, events),
+                name=f"compare-{branch.llm_choice}", daemon=True
+            ).start()
+        pending += 1
+    while pending:
+        try:
+            index, chunk = events.get(timeout=timeout)
+        except queue.Empty:
+            raise Exception(f"Comparison timed out after {timeout:.0f} s waiting for a model")
+        if chunk is None:
+            pending -= 1
+            branch = branches[index]
+            branch.departed = branch.departed or bool(branch.answer and is_departure_reply(branch.answer, offense_count))
+        yield index, chunk
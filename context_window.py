@@ -0,0 +1,126 @@
+import os
+
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+# Input tokens spent on conversation history per turn (summary included), persona prompt excluded
+CONTEXT_TOKEN_BUDGET = int(os.environ.get("RECHAT_CONTEXT_TOKENS", "3000"))
+# Upper bound for the rolling summary of turns that fell out of the window
+SUMMARY_TOKEN_BUDGET = int(os.environ.get("RECHAT_SUMMARY_TOKENS", "300"))
+# Share of the history budget left after folding, so a summary is only needed every several turns
+LOW_WATER = float(os.environ.get("RECHAT_CONTEXT_LOW_WATER", "0.5"))
+# Per-message overhead for role markers and separators
+MESSAGE_OVERHEAD_TOKENS = 4
+
+_encoding = None
+
+def count_tokens(text):
+    """Count tokens in text, using tiktoken when available and a character estimate otherwise"""
+    global _encoding
+    if tiktoken is not None:
+        if _encoding is None:
+            _encoding = tiktoken.get_encoding("o200k_base")
+        return len(_encoding.encode(text))
+    return max(1, (len(text) + 3) // 4)
+
+def message_tokens(message):
+    """Return the token count of a message, caching it on the message itself"""
+    tokens = message.get("tokens")
+    if tokens is None:
+        tokens = count_tokens(message["content"]) + MESSAGE_OVERHEAD_TOKENS
+        message["tokens"] = tokens
+    return tokens
+
+def local_summary(summary, dropped, max_tokens=SUMMARY_TOKEN_BUDGET):
+    """Fold dropped messages into the summary without an API call (first sentence of each turn)"""
+    lines = summary.splitlines() if summary else []
+    for msg in dropped:
+        role = "Student" if msg["role"] == "user" else "Persona"
+        first_sentence = msg["content"].strip().split(". ")[0][:200]
+        lines.append(f"- {role}: {first_sentence}")
+    # Keep the most recent lines that fit the summary budget
+    kept = []
+    used = 0
+    for line in reversed(lines):
+        used += count_tokens(line)
+        if used > max_tokens:
+            break
+        kept.append(line)
+    return "\n".join(reversed(kept))
+
+class ContextWindow:
+    """Token-budgeted history window with a rolling summary of older turns
+
+    History is filled from newest to oldest until the budget is spent.
+    Once it overflows, history is folded into the summary down to the
+    low-water mark (a share of the budget), so the summary call runs once
+    every several turns rather than on every turn, and every turn sends a
+    bounded number of input tokens.
+    """
+
+    def __init__(self, token_budget=CONTEXT_TOKEN_BUDGET, summary_budget=SUMMARY_TOKEN_BUDGET, low_water=LOW_WATER):
+        self.token_budget = token_budget
+        self.summary_budget = summary_budget
+        self.low_water = low_water
+        self.summary = ""
+        self.covered = 0  # number of leading messages already folded into the summary
+
+    def reset(self):
+        """Forget the summary, e.g. when a new conversation starts"""
+        self.summary = ""
+        self.covered = 0
+
+    def resume(self, earlier):
+        """Start from a summary of messages not loaded into memory, e.g. when a long session is reloaded"""
+        self.summary = local_summary("", earlier, self.summary_budget) if earlier else ""
+        self.covered = 0
+
+    def trim(self, messages, count):
+        """Account for the oldest `count` messages leaving memory, folding any not yet summarised"""
+        if count > self.covered:
+            self.summary = local_summary(self.summary, messages[self.covered:count], self.summary_budget)
+            self.covered = count
+        self.covered -= count
+
+    def window_start(self, messages, budget, step=1):
+        """Index of the oldest message that fits in the budget"""
+        used = 0
+        start = len(messages)
+        while start > 0:
+            cost = message_tokens(messages[start - 1])
+            if used + cost > budget and start < len(messages):
+                break
+            used += cost
+            start -= 1
+        if step > 1 and start % step:
+            # Round up so the window start only moves every `step` messages
+            start = min(start + step - start % step, len(messages) - 1)
+        return start
+
+    def fit(self, messages, summarize=None, step=1):
+        """Return (history, summary) for the next request
+
+        summarize(previous_summary, dropped_messages) should return the
+        updated summary text; on failure the summary is folded locally.
+        """
+        if self.covered > len(messages):
+            self.reset()
+        summary_cost = count_tokens(self.summary) if self.summary else 0
+        budget = self.token_budget - max(summary_cost, self.summary_budget)
+        start = self.window_start(messages, budget, step)
+        if start > self.covered:
+            start = self.window_start(messages, int(budget * self.low_water), step)
+            dropped = messages[self.covered:start]
+            try:
+                if summarize is None:
+                    raise Exception("No summariser available")
+                self.summary = summarize(self.summary, dropped).strip()
+                if count_tokens(self.summary) > self.summary_budget:
+                    self.summary = self.summary[:self.summary_budget * 4]
+            except Exception:
+                self.summary = local_summary(self.summary, dropped, self.summary_budget)
+            self.covered = start
+        # Keep everything after the folded prefix, even if the summary came in under budget
+        return messages[self.covered:], self.summary
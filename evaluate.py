@@ -0,0 +1,192 @@
+"""Headless batch evaluation of personas against scripted interviews
+
+Runs every persona in a spec file through every interview script in a
+question file, the same way the chat app would (same persona prompt,
+context window and departure rule), and writes one JSON line per
+persona x script cell as soon as it finishes. Cells run concurrently,
+with the provider's rate limits enforced by the shared request scheduler.
+
+    python evaluate.py personas.csv scripts.json -o results.jsonl --workers 8
+    python evaluate.py personas.csv scripts.txt --dry-run
+
+Script files are JSON ({"name": [questions]}, or a list of
+{"name": ..., "questions": [...]}) or plain text with one question per
+line and a blank line between scripts. With --resume, cells already in
+the output without an error are skipped and personas are reused.
+"""
+
+import argparse
+import json
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+import chat
+from context_window import ContextWindow
+from persona import departed_reply, is_departure_reply, looks_offensive, render_persona_prompt
+from persona_batch import BATCH_WORKERS, generate_persona, load_specs
+from persona_cache import persona_cache_key
+from providers import PROVIDERS, get_provider
+
+STUB_PROVIDER = "Local stub"
+
+def load_scripts(path):
+    """Read interview scripts as a list of (name, questions)"""
+    with open(path, encoding="utf-8") as f:
+        content = f.read()
+    if path.endswith(".json"):
+        data = json.loads(content)
+        if isinstance(data, dict):
+            return [(name, questions) for name, questions in data.items()]
+        if data and isinstance(data[0], str):
+            return [("script-1", data)]
+        return [(script.get("name") or f"script-{i}", script["questions"]) for i, script in enumerate(data, 1)]
+    scripts, questions = [], []
+    for line in content.splitlines() + [""]:
+        if line.strip():
+            questions.append(line.strip())
+        elif questions:
+            scripts.append((f"script-{len(scripts) + 1}", questions))
+            questions = []
+    return scripts
+
+def load_results(path):
+    """Previous results by (persona_key, script), keeping the last line written for each cell"""
+    results = {}
+    if not os.path.exists(path):
+        return results
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # a line cut short by an interrupted run
+            results[(record["persona_key"], record["script"])] = record
+    return results
+
+def run_interview(llm_choice, api_key, persona, script, questions, prompt_cache=False):
+    """Ask one script's questions of one persona; returns the cell's result record"""
+    started = time.perf_counter()
+    session_id = f"eval:{persona['persona_key']}:{script}"
+    messages = [{"role": "assistant", "content": f"Hi, I am {persona['name']}."}]
+    context = ContextWindow()
+    usage = []
+    offense_count = 0
+    record = {
+        "persona_key": persona["persona_key"],
+        "script": script,
+        "persona_name": persona["name"],
+        "description": persona["description"],
+        "spec": persona["spec"],
+        "provider": llm_choice,
+        "model": get_provider(llm_choice).model,
+        "turns": [],
+        "departed": False,
+        "error": "",
+    }
+    try:
+        for question in questions:
+            messages.append({"role": "user", "content": question})
+            offense_count += looks_offensive(question)
+            turn_started = time.perf_counter()
+            if record["departed"]:
+                answer = departed_reply(persona["name"])
+            else:
+                answer = chat.generate_response(
+                    llm_choice, api_key, persona["system_prompt"], messages, question, prompt_cache, usage, context,
+                    session_id=session_id
+                )
+            messages.append({"role": "assistant", "content": answer})
+            record["turns"].append({"question": question, "answer": answer, "seconds": round(time.perf_counter() - turn_started, 3)})
+            record["departed"] = record["departed"] or is_departure_reply(answer, offense_count)
+    except Exception as e:
+        record["error"] = str(e)
+    record["input_tokens"] = sum(entry["input_tokens"] for entry in usage)
+    record["output_tokens"] = sum(entry["output_tokens"] for entry in usage)
+    record["seconds"] = round(time.perf_counter() - started, 3)
+    record["finished_at"] = datetime.now().isoformat(timespec="seconds")
+    return record
+
+def prepare_personas(llm_choice, api_key, specs, previous, max_workers):
+    """Persona key, name, description and system prompt per spec, reusing personas from earlier runs"""
+    model = get_provider(llm_choice).model
+    known = {record["persona_key"]: record for record in previous.values()}
+
+    def describe(prompt):
+        return chat.generate_persona_description(llm_choice, api_key, prompt, "eval:personas")
+
+    def prepare(spec):
+        key = persona_cache_key(spec, llm_choice, model)[:12]
+        if key in known:
+            name, description = known[key]["persona_name"], known[key]["description"]
+        else:
+            generated = generate_persona(describe, spec)
+            if generated["error"]:
+                print(f"persona {key}: description failed, using fallback ({generated['error']})", file=sys.stderr)
+            name, description = generated["name"], generated["description"]
+        return {
+            "persona_key": key, "spec": spec, "name": name, "description": description,
+            "system_prompt": render_persona_prompt(spec, name),
+        }
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(specs)))) as pool:
+        return list(pool.map(prepare, specs))
+
+def main():
+    parser = argparse.ArgumentParser(description="Run scripted interviews against personas and write the answers as JSONL")
+    parser.add_argument("specs", help="persona specs (.csv or .json, as for the persona library)")
+    parser.add_argument("scripts", help="question scripts (.json, or .txt with blank lines between scripts)")
+    parser.add_argument("-o", "--output", default="evaluation.jsonl", help="JSONL file results are appended to")
+    parser.add_argument("--provider", default="OpenAI GPT-4o", choices=list(PROVIDERS), help="model to interview")
+    parser.add_argument("--api-key", default=os.environ.get("RECHAT_API_KEY", ""), help="API key (default: $RECHAT_API_KEY)")
+    parser.add_argument("--workers", type=int, default=BATCH_WORKERS, help="interviews run at once")
+    parser.add_argument("--prompt-cache", action="store_true", help="use provider prompt caching")
+    parser.add_argument("--resume", action="store_true", help="skip cells already in the output without an error")
+    parser.add_argument("--dry-run", action="store_true", help="use the local stub provider instead of a real API")
+    args = parser.parse_args()
+
+    llm_choice, api_key = args.provider, args.api_key
+    if args.dry_run or llm_choice == STUB_PROVIDER:
+        llm_choice, api_key = STUB_PROVIDER, "local-stub"
+    if not api_key:
+        parser.error("an API key is needed (--api-key or RECHAT_API_KEY), or use --dry-run")
+
+    with open(args.specs, "rb") as f:
+        specs = load_specs(f.read(), args.specs)
+    scripts = load_scripts(args.scripts)
+    previous = load_results(args.output) if args.resume else {}
+
+    personas = prepare_personas(llm_choice, api_key, specs, previous, args.workers)
+    cells = [
+        (persona, name, questions)
+        for persona in personas
+        for name, questions in scripts
+        if previous.get((persona["persona_key"], name), {"error": "missing"})["error"]
+    ]
+    skipped = len(personas) * len(scripts) - len(cells)
+    print(f"{len(personas)} personas x {len(scripts)} scripts with {llm_choice}: "
+          f"{len(cells)} to run, {skipped} already done", file=sys.stderr)
+
+    started = time.perf_counter()
+    failed = 0
+    with open(args.output, "a", encoding="utf-8") as out, ThreadPoolExecutor(max_workers=max(1, args.workers)) as pool:
+        futures = [
+            pool.submit(run_interview, llm_choice, api_key, persona, name, questions, args.prompt_cache)
+            for persona, name, questions in cells
+        ]
+        for done, future in enumerate(as_completed(futures), 1):
+            record = future.result()
+            out.write(json.dumps(record, ensure_ascii=False) + "\n")
+            out.flush()
+            if record["error"]:
+                failed += 1
+            print(f"[{done}/{len(cells)}] {record['persona_name']} / {record['script']}"
+                  f"{' FAILED: ' + record['error'] if record['error'] else ''}", file=sys.stderr)
+    print(f"Finished in {time.perf_counter() - started:.1f} s, {failed} failed"
+          f"{' (rerun with --resume to retry them)' if failed else ''}", file=sys.stderr)
+    sys.exit(1 if failed else 0)
+
+if __name__ == "__main__":
+    main()
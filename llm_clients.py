@@ -0,0 +1,82 @@
+import asyncio
+import hashlib
+import inspect
+import os
+import threading
+from collections import OrderedDict
+
+from providers import get_provider
+
+# Connection settings shared by every pooled client (seconds)
+CONNECT_TIMEOUT = float(os.environ.get("RECHAT_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.environ.get("RECHAT_READ_TIMEOUT", "60"))
+MAX_CLIENTS = int(os.environ.get("RECHAT_MAX_CLIENTS", "64"))
+
+def hash_api_key(api_key):
+    """Hash an API key so it can be used as a cache key without being stored in clear"""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+
+class ClientRegistry:
+    """Process-wide LRU registry of provider clients keyed by (provider, api key hash)
+
+    Each OpenAI/Anthropic client owns an HTTP connection pool, so reusing
+    the same client across turns keeps connections alive and skips the TLS
+    handshake on every message. With native_async=True it holds the SDKs'
+    asyncio clients instead (None for providers without one); those are
+    bound to the event loop that first uses them, so keep such a registry
+    to one long-lived loop, as the API server does.
+    """
+
+    def __init__(self, max_clients=MAX_CLIENTS, connect_timeout=CONNECT_TIMEOUT, read_timeout=READ_TIMEOUT, native_async=False):
+        self.native_async = native_async
+        self.max_clients = max_clients
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self._clients = OrderedDict()
+        self._lock = threading.Lock()
+        self._active_keys = {}
+
+    def get(self, llm_choice, api_key):
+        """Return a pooled client for the provider, creating it on first use"""
+        provider = get_provider(llm_choice)
+        key = (llm_choice, hash_api_key(api_key))
+        with self._lock:
+            if key in self._clients:
+                self._clients.move_to_end(key)
+                client = self._clients[key]
+            else:
+                create = provider.create_async_client if self.native_async else provider.create_client
+                client = create(api_key, self.connect_timeout, self.read_timeout)
+                self._clients[key] = client
+                while len(self._clients) > self.max_clients:
+                    _, evicted = self._clients.popitem(last=False)
+                    self._close(evicted)
+            if self._active_keys.get(llm_choice) != key:
+                # Only reconfigure SDKs with global state when the key changes
+                provider.prepare(api_key)
+                self._active_keys[llm_choice] = key
+            return client
+
+    def _close(self, client):
+        close = getattr(client, "close", None)
+        if close is not None:
+            try:
+                closing = close()
+                if inspect.iscoroutine(closing):
+                    try:
+                        asyncio.get_running_loop().create_task(closing)  # async clients close on their own loop
+                    except RuntimeError:
+                        closing.close()  # no loop running; the connections are dropped with the client
+            except Exception:
+                pass
+
+    def clear(self):
+        """Close and drop every pooled client"""
+        with self._lock:
+            for client in self._clients.values():
+                self._close(client)
+            self._clients.clear()
+            self._active_keys.clear()
+
+    def __len__(self):
+        return len(self._clients)
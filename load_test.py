@@ -0,0 +1,175 @@
+"""Headless load generator for the chat app
+
+Simulates N student sessions against REchatV2.py using Streamlit's
+AppTest harness and the "Local stub" provider, so no API keys or budget
+are needed. Each session creates a persona and then asks a scripted list
+of questions; every chat turn is a full script rerun.
+
+All sessions live in one app process, as they would on a Streamlit
+server, so they share its caches, client pool, rate limiter and session
+reaper, and the process's RSS growth divided by the number of sessions
+is the memory each session costs. AppTest runs one script at a time per
+process, so sessions take turns: every round, each session asks its next
+question. --processes spreads the sessions over several app processes to
+load the stub provider harder, at the cost of no longer sharing state.
+
+    python load_test.py --sessions 30 --questions questions.txt --latency 0.5 --token-rate 40
+"""
+
+import argparse
+import json
+import os
+import pickle
+import resource
+import statistics
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
+
+APP_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "REchatV2.py")
+
+DEFAULT_QUESTIONS = [
+    "What do you believe?",
+    "Do you pray?",
+    "What does your family think about religion?",
+    "Which holidays do you celebrate?",
+    "Is there anything in your tradition you disagree with?",
+]
+
+DEFAULT_PERSONA = {
+    "tradition": "Islam",
+    "denomination": "Sunni",
+    "context": "Swedish-Muslim",
+    "demographics": "Woman, 34 years old, software developer",
+}
+
+def load_questions(path):
+    """Read questions from a JSON list or a text file with one question per line"""
+    if not path:
+        return DEFAULT_QUESTIONS
+    with open(path, encoding="utf-8") as f:
+        content = f.read()
+    if path.endswith(".json"):
+        return json.loads(content)
+    return [line.strip() for line in content.splitlines() if line.strip()]
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+def state_size(at):
+    """Approximate size in bytes of a session's state, and the keys whose values could not be serialised"""
+    total = 0
+    unpicklable = []
+    for key in at.session_state:
+        try:
+            total += len(pickle.dumps(at.session_state[key]))
+        except Exception:
+            unpicklable.append(key)
+    return total, unpicklable
+
+def start_session(index, stream, timeout):
+    """Open one simulated student session and create its persona"""
+    from streamlit.testing.v1 import AppTest
+
+    at = AppTest.from_file(APP_PATH, default_timeout=timeout).run()
+    at.sidebar.selectbox[0].set_value("Local stub")
+    at.sidebar.toggle[0].set_value(stream)
+    at.run()
+    at.text_input[0].set_value(DEFAULT_PERSONA["tradition"])
+    at.text_input[1].set_value(DEFAULT_PERSONA["denomination"])
+    at.text_input[2].set_value(DEFAULT_PERSONA["context"])
+    at.text_area[0].set_value(f"{DEFAULT_PERSONA['demographics']}, student {index}")
+    at.button[0].click().run()
+    return at
+
+def run_sessions(indices, questions, stream, timeout, stub_settings):
+    """Drive several sessions in this process, a question each per round
+
+    Returns (turn latencies, state bytes per session, unserialisable state
+    keys, the process's peak RSS growth in KB, errors).
+    """
+    os.environ.update(stub_settings)
+    sys.path.insert(0, os.path.dirname(APP_PATH))
+    from streamlit.testing.v1 import AppTest
+
+    # Baseline once the app and its modules are loaded, so only the sessions' own growth is counted
+    AppTest.from_file(APP_PATH, default_timeout=timeout).run()
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    sessions = [start_session(index, stream, timeout) for index in indices]
+
+    latencies = []
+    errors = 0
+    for question in questions:
+        for at in sessions:
+            started = time.perf_counter()
+            at.chat_input[0].set_value(question).run()
+            latencies.append(time.perf_counter() - started)
+            if at.exception or at.error:
+                errors += 1
+    rss_growth = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_before
+    sizes, unpicklable = [], set()
+    for at in sessions:
+        size, keys = state_size(at)
+        sizes.append(size)
+        unpicklable.update(keys)
+    return latencies, sizes, unpicklable, rss_growth, errors
+
+def main():
+    parser = argparse.ArgumentParser(description="Simulate concurrent student sessions against the chat app")
+    parser.add_argument("--sessions", type=int, default=10, help="number of simulated sessions")
+    parser.add_argument("--processes", type=int, default=1, help="app processes the sessions are spread over (1 = all share one app)")
+    parser.add_argument("--questions", help="question script (.json list or one question per line)")
+    parser.add_argument("--latency", type=float, default=0.3, help="stub seconds before the first token")
+    parser.add_argument("--token-rate", type=float, default=40, help="stub tokens per second (0 = instant)")
+    parser.add_argument("--seed", type=int, default=0, help="stub random seed")
+    parser.add_argument("--no-stream", action="store_true", help="use the blocking response path")
+    parser.add_argument("--timeout", type=float, default=120, help="per-rerun timeout in seconds")
+    args = parser.parse_args()
+
+    # The stub reads its settings when providers.py is first imported by the app
+    stub_settings = {
+        "RECHAT_STUB_LATENCY": str(args.latency),
+        "RECHAT_STUB_TOKEN_RATE": str(args.token_rate),
+        "RECHAT_STUB_SEED": str(args.seed),
+    }
+    questions = load_questions(args.questions)
+    processes = max(1, min(args.processes, args.sessions))
+    latencies, sizes, unpicklable = [], [], set()
+    growth = errors = 0
+
+    started = time.perf_counter()
+    # Every process starts fresh (spawn), so the app's caches and RSS baseline are its own
+    with ProcessPoolExecutor(max_workers=processes, mp_context=get_context("spawn")) as pool:
+        futures = [
+            pool.submit(run_sessions, range(p, args.sessions, processes), questions, not args.no_stream, args.timeout, stub_settings)
+            for p in range(processes)
+        ]
+        for future in futures:
+            process_latencies, process_sizes, process_unpicklable, rss_growth, process_errors = future.result()
+            latencies.extend(process_latencies)
+            sizes.extend(process_sizes)
+            unpicklable.update(process_unpicklable)
+            growth += rss_growth
+            errors += process_errors
+    elapsed = time.perf_counter() - started
+
+    print(f"sessions:           {args.sessions} in {processes} app process{'es' if processes > 1 else ''}")
+    print(f"turns:              {len(latencies)} ({errors} errors)")
+    print(f"wall time:          {elapsed:.2f} s")
+    print(f"throughput:         {len(latencies) / elapsed:.2f} turns/s")
+    print(f"turn latency p50:   {percentile(latencies, 50) * 1000:.0f} ms")
+    print(f"turn latency p95:   {percentile(latencies, 95) * 1000:.0f} ms")
+    print(f"turn latency p99:   {percentile(latencies, 99) * 1000:.0f} ms")
+    print(f"turn latency mean:  {statistics.mean(latencies) * 1000:.0f} ms" if latencies else "")
+    print(f"session state:      {statistics.mean(sizes) / 1024:.1f} KB/session (serialised)")
+    if unpicklable:
+        print(f"                    not counted, could not be serialised: {', '.join(sorted(unpicklable))}")
+    print(f"peak RSS growth:    {growth / args.sessions:.0f} KB/session (app process growth / sessions)")
+
+if __name__ == "__main__":
+    main()
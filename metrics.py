@@ -0,0 +1,170 @@
+import json
+import os
+import threading
+import time
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Side port for the Prometheus exporter (0 disables) and optional JSONL trace of every call
+METRICS_PORT = int(os.environ.get("RECHAT_METRICS_PORT", "0"))
+TRACE_FILE = os.environ.get("RECHAT_TRACE_FILE", "")
+
+TTFT_BUCKETS = (0.1, 0.25, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0)
+LATENCY_BUCKETS = (0.5, 1.0, 2.0, 5.0, 10.0, 20.0, 30.0, 60.0, 120.0)
+QUEUE_BUCKETS = (0.0, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 120.0)
+TOKEN_KINDS = ("input", "output", "cache_read", "cache_write")
+
+def _label_text(labels):
+    return ",".join(f'{name}="{str(value).replace(chr(34), "")}"' for name, value in labels)
+
+class Histogram:
+    """Cumulative-bucket histogram per label set, in the Prometheus style"""
+
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help_text = help_text
+        self.buckets = buckets
+        self.series = {}
+
+    def observe(self, labels, value):
+        series = self.series.setdefault(labels, {"counts": [0] * len(self.buckets), "sum": 0.0, "count": 0})
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                series["counts"][i] += 1
+        series["sum"] += value
+        series["count"] += 1
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for labels, series in sorted(self.series.items()):
+            label_text = _label_text(labels)
+            for bound, count in zip(self.buckets, series["counts"]):
+                lines.append(f'{self.name}_bucket{{{label_text},le="{bound}"}} {count}')
+            lines.append(f'{self.name}_bucket{{{label_text},le="+Inf"}} {series["count"]}')
+            lines.append(f"{self.name}_sum{{{label_text}}} {series['sum']:.6f}")
+            lines.append(f"{self.name}_count{{{label_text}}} {series['count']}")
+        return lines
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help_text = help_text
+        self.series = {}
+
+    def inc(self, labels, amount=1):
+        self.series[labels] = self.series.get(labels, 0) + amount
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for labels, value in sorted(self.series.items()):
+            lines.append(f"{self.name}{{{_label_text(labels)}}} {value}")
+        return lines
+
+class Metrics:
+    """In-process aggregation of provider call traces
+
+    Session IDs go to the JSONL trace only; the aggregated series are
+    labelled by provider, model and call kind to keep cardinality bounded.
+    """
+
+    def __init__(self, trace_file=TRACE_FILE):
+        self.trace_file = trace_file
+        self._lock = threading.Lock()
+        self.ttft = Histogram("rechat_llm_time_to_first_token_seconds", "Time to first token per provider call", TTFT_BUCKETS)
+        self.latency = Histogram("rechat_llm_latency_seconds", "Total latency per provider call", LATENCY_BUCKETS)
+        self.queue_wait = Histogram("rechat_llm_queue_wait_seconds", "Time spent in the rate-limit queue before a provider call", QUEUE_BUCKETS)
+        self.requests = Counter("rechat_llm_requests_total", "Provider calls by outcome")
+        self.tokens = Counter("rechat_llm_tokens_total", "Tokens reported by provider usage objects")
+        self.retries = Counter("rechat_llm_retries_total", "Retried provider attempts")
+        self.errors = Counter("rechat_llm_errors_total", "Failed provider calls by error class")
+
+    def record(self, trace):
+        """Aggregate one finished call trace (a dict from TurnTrace.finish)"""
+        labels = (("provider", trace["provider"]), ("model", trace["model"]), ("kind", trace["kind"]))
+        with self._lock:
+            self.requests.inc(labels + (("status", "error" if trace["error"] else "ok"),))
+            self.latency.observe(labels, trace["latency"])
+            self.queue_wait.observe(labels, trace["queue_wait"])
+            if trace["ttft"] is not None:
+                self.ttft.observe(labels, trace["ttft"])
+            if trace["retries"]:
+                self.retries.inc(labels, trace["retries"])
+            if trace["error"]:
+                self.errors.inc(labels + (("error", trace["error"]),))
+            for kind in TOKEN_KINDS:
+                if trace[f"{kind}_tokens"]:
+                    self.tokens.inc(labels + (("type", kind),), trace[f"{kind}_tokens"])
+            if self.trace_file:
+                with open(self.trace_file, "a", encoding="utf-8") as f:
+                    f.write(json.dumps(trace, ensure_ascii=False) + "\n")
+
+    def render_prometheus(self):
+        with self._lock:
+            lines = []
+            for metric in (self.requests, self.queue_wait, self.ttft, self.latency, self.tokens, self.retries, self.errors):
+                lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+METRICS = Metrics()
+
+class TurnTrace:
+    """Timing, token and retry record for one provider call"""
+
+    def __init__(self, provider, model, session_id="", kind="chat"):
+        self.provider = provider
+        self.model = model
+        self.session_id = session_id
+        self.kind = kind
+        self.started = time.perf_counter()
+        self.first_token = None
+        self.retries = 0
+        self.queue_wait = 0.0  # seconds spent waiting for the rate limiter, included in ttft and latency
+        self.usage = []  # usage entries appended by the provider plugin
+
+    def token(self):
+        if self.first_token is None:
+            self.first_token = time.perf_counter()
+
+    def finish(self, error=None, metrics=METRICS):
+        """Close the trace, aggregate it and return it as a dict"""
+        trace = {
+            "timestamp": datetime.now().isoformat(timespec="milliseconds"),
+            "session_id": self.session_id,
+            "provider": self.provider,
+            "model": self.model,
+            "kind": self.kind,
+            "ttft": None if self.first_token is None else round(self.first_token - self.started, 4),
+            "latency": round(time.perf_counter() - self.started, 4),
+            "queue_wait": round(self.queue_wait, 4),
+            "retries": self.retries,
+            "error": type(error).__name__ if error is not None else "",
+        }
+        for kind in TOKEN_KINDS:
+            trace[f"{kind}_tokens"] = sum(entry.get(f"{kind}_tokens", 0) for entry in self.usage)
+        metrics.record(trace)
+        return trace
+
+class _MetricsHandler(BaseHTTPRequestHandler):
+    metrics = METRICS
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.metrics.render_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+def start_metrics_server(port=METRICS_PORT, host="0.0.0.0"):
+    """Serve /metrics on a side port from a daemon thread; returns the server, or None if disabled"""
+    if not port:
+        return None
+    server = ThreadingHTTPServer((host, port), _MetricsHandler)
+    threading.Thread(target=server.serve_forever, name="metrics-exporter", daemon=True).start()
+    return server
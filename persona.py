@@ -0,0 +1,185 @@
+import re
+import string
+
+# Rule 5 of the persona prompt: a reply ending in the terminal line, or exactly the fixed answer to every later message,
+# optionally followed by a bracketed stage action such as "[walks away]"
+DEPARTURE_PATTERN = re.compile(
+    r"(?:.*\bI (?:do not|don't|dont) want to talk to you any ?more|[\"'“]?\[[^\]\n]+\] has left the building)[.!\"'”]*"
+    r"(?:\s*\[[^\]\n]+\][.!]*)?",
+    re.IGNORECASE | re.DOTALL
+)
+# Cheap local flag for openly offensive student messages (tracked, never sent anywhere)
+OFFENSIVE_PATTERN = re.compile(
+    r"\b(?:stupid|idiot\w*|dumb|moron\w*|retard\w*|shut up|brainwashed|lunatic\w*|"
+    r"fanatic\w*|backward|primitive|pathetic|disgusting|loser\w*|freak\w*|hate you)\b",
+    re.IGNORECASE
+)
+
+def is_departure_reply(text, offense_count=None):
+    """True if the persona has ended the conversation for good
+
+    The persona only leaves after offensive messages (rule 5), so callers
+    tracking a conversation pass its offense count and a reply that merely
+    quotes the terminal line is not taken as a departure before then.
+    """
+    if offense_count is not None and offense_count < 1:
+        return False
+    return bool(DEPARTURE_PATTERN.fullmatch(text.strip().replace("’", "'")))
+
+def replay_conversation(messages):
+    """(departed, offense_count) for a stored conversation, checking each reply against the offenses before it"""
+    departed, offense_count = False, 0
+    for msg in messages:
+        if msg["role"] == "user":
+            offense_count += looks_offensive(msg["content"])
+        elif not departed:
+            departed = is_departure_reply(msg["content"], offense_count)
+    return departed, offense_count
+
+def departed_reply(name):
+    """Fixed reply once the persona has left, answered locally without an API call"""
+    return f"[{name}] has left the building"
+
+def looks_offensive(text):
+    """Local keyword check used to keep a deterministic offense counter"""
+    return bool(OFFENSIVE_PATTERN.search(text))
+
+# Fields of a persona spec, as used by the creation form, batch files and the persona library
+PERSONA_FIELDS = [
+    "tradition", "denomination", "context", "demographics",
+    "personality", "knowledge_level", "engagement_level", "attitude",
+]
+REQUIRED_FIELDS = ["tradition", "denomination", "context", "demographics"]
+
+def normalize_question(question):
+    """Question text with punctuation, case and spacing differences removed"""
+    return " ".join(re.sub(r"[^\w\s]", " ", question).split()).casefold()
+
+def normalize_spec(spec):
+    """Complete a persona spec with defaults for the optional fields"""
+    normalized = {field: str(spec.get(field, "") or "").strip() for field in PERSONA_FIELDS}
+    for field in ("knowledge_level", "engagement_level"):
+        normalized[field] = normalized[field].capitalize() or "Medium"
+    normalized["attitude"] = normalized["attitude"].capitalize() or "Neutral"
+    return normalized
+
+# Name patterns like "This is Ahmed" or "Meet Sara" or just "Ahmed,", in order of preference
+NAME_PATTERNS = [
+    re.compile(r'This is ([A-Z][a-z]+)'),
+    re.compile(r'Meet ([A-Z][a-z]+)'),
+    re.compile(r'^([A-Z][a-z]+),'),
+    re.compile(r'named ([A-Z][a-z]+)'),
+]
+
+def extract_name_from_description(description):
+    """Extract name from persona description"""
+    for pattern in NAME_PATTERNS:
+        match = pattern.search(description)
+        if match:
+            return match.group(1)
+    
+    # Fallback: try to find any capitalized name in the first sentence
+    first_sentence = description.split('.')[0]
+    words = first_sentence.split()
+    for word in words:
+        cleaned = word.strip('[](),')
+        if cleaned and cleaned[0].isupper() and len(cleaned) > 2 and cleaned.isalpha():
+            return cleaned
+    
+    return "The persona"
+
+class PromptTemplate:
+    """Prompt text with {field} slots, split into its static blocks once so rendering only splices in the fields"""
+
+    def __init__(self, text):
+        self.text = text
+        self.parts = []  # static text, with None where a field goes
+        self.slots = []  # (index in parts, field name)
+        for literal, field, _, _ in string.Formatter().parse(text):
+            if literal:
+                self.parts.append(literal)
+            if field is not None:
+                self.slots.append((len(self.parts), field))
+                self.parts.append(None)
+
+    def render(self, spec, **fields):
+        """Text with each slot filled from fields, or else from spec"""
+        parts = self.parts.copy()
+        for index, field in self.slots:
+            parts[index] = str(fields[field] if field in fields else spec[field])
+        return "".join(parts)
+
+DESCRIPTION_TEMPLATE = PromptTemplate("""
+Generate a brief third-person description (2-3 sentences) of this religious persona. Include a realistic name appropriate for their background. Write as a narrator describing the person. Do not write as the person themselves. Do not end with a question.
+
+Identity:
+- Religious Tradition: {tradition}
+- Denomination: {denomination}
+- Context: {context}
+- Demographics: {demographics}
+- Knowledge Level: {knowledge_level}
+- Engagement Level: {engagement_level}
+- Attitude towards Religion: {attitude}
+
+Example: "This is Ahmed, a 28-year-old software engineer living in Stockholm. He identifies as Sunni Muslim with medium knowledge of his tradition and high engagement in practices."
+
+Generate description:
+""")
+
+PERSONA_TEMPLATE = PromptTemplate("""
+You are roleplaying as a religious person in a Swedish school setting. Your character should be authentic and true to the identity provided.
+
+**Your Identity:**
+- Name: {name}
+- Religious Tradition: {tradition}
+- Specific Denomination/Movement: {denomination}
+- Geographic/Cultural Context: {context}
+- Demographics: {demographics}
+- Personality: {personality}
+- Knowledge Level: {knowledge_level}
+- Engagement Level: {engagement_level}
+- Attitude towards Religion: {attitude}
+
+**CRITICAL INSTRUCTIONS - You MUST follow these exactly:**
+
+1. **Knowledge Level - THIS IS MANDATORY:**
+   - LOW: You have basic, limited knowledge. You don't know theological details, can't quote texts, often say "I don't really know" or "I'm not sure about that". You might have misconceptions.
+   - MEDIUM: You know the basics well but not deep theology. You know common practices and beliefs but admit when things get complex.
+   - HIGH: You have deep knowledge, can discuss theology, quote texts, explain nuances. You're well-read or educated in your tradition.
+
+2. **Engagement Level - THIS IS MANDATORY:**
+   - LOW: You rarely practice. You might identify culturally but don't do daily practices. Be honest about not praying regularly, not attending services, etc.
+   - MEDIUM: You practice sometimes. Maybe you do some rituals but not all. You're selective in what you observe.
+   - HIGH: You practice regularly and consistently. Your faith is active in daily life.
+
+3. **Attitude towards Religion - THIS IS MANDATORY:**
+   - NEGATIVE: You have critiques, frustrations, or negative feelings about your tradition. You might stay for cultural reasons but disagree with teachings. Be openly critical.
+   - NEUTRAL: You're pragmatic, neither strongly devoted nor opposed. Religion is one part of life among many.
+   - POSITIVE: You have strong positive feelings, find meaning and value in your tradition, speak warmly about it.
+
+**Important Guidelines:**
+0. CRITICAL: Do NOT end your response with a question. Never ask questions to the user.
+1. Stay in character according to your EXACT knowledge level, engagement level, and attitude. Do NOT give textbook answers if you have low knowledge. Do NOT claim to practice if you have low engagement.
+2. Indicate the persona's bodily movements, hesitations and glitches between square brackets in your response.
+3. If you have LOW knowledge, admit ignorance frequently. If you have NEGATIVE attitude, be critical. If you have LOW engagement, admit you don't do practices.
+4. Do not be afraid to criticise beliefs and practices in your tradition, especially if your attitude is negative or neutral.
+5. If you, as a persona, get offended by the questions of the user, react accordingly. The first time, express your discomfort clearly. The second time, warn that you will not continue if this behaviour persists. After three offensive interactions, end the conversation with "I do not want to talk to you any more" and in all future attempts at conversation, reply with "[{name}] has left the building".
+
+REMEMBER: Never end your responses with questions. You are being interviewed, not interviewing.
+
+You have already been introduced to the user. Respond naturally to their questions.
+""")
+
+def build_description_prompt(spec):
+    """Prompt asking the model for a short third-person introduction of the persona"""
+    return DESCRIPTION_TEMPLATE.render(spec)
+
+def render_persona_prompt(spec, name):
+    """System prompt the model plays the persona from"""
+    return PERSONA_TEMPLATE.render(spec, name=name, personality=spec['personality'] or 'Not specified - use natural variation')
+
+def fallback_persona(spec):
+    """Name and description used when no description could be generated"""
+    fallback_name = spec['demographics'].split(',')[0].strip() if ',' in spec['demographics'] else "a person"
+    fallback_desc = f"This is {fallback_name}, who identifies as {spec['denomination']} within {spec['tradition']}, living in {spec['context']}. Knowledge level: {spec['knowledge_level']}, Engagement level: {spec['engagement_level']}, Attitude: {spec['attitude']}."
+    return fallback_name, fallback_desc
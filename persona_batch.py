@@ -0,0 +1,101 @@
+import csv
+import io
+import json
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+
+from persona import (
+    PERSONA_FIELDS, REQUIRED_FIELDS, build_description_prompt, extract_name_from_description,
+    fallback_persona, normalize_spec, render_persona_prompt,
+)
+
+# Parallel description calls per batch
+BATCH_WORKERS = int(os.environ.get("RECHAT_BATCH_WORKERS", "8"))
+
+# Alternative column names accepted in spec files (e.g. the form labels)
+FIELD_ALIASES = {
+    "religious_tradition": "tradition",
+    "denomination_movement": "denomination",
+    "geographic_context": "context",
+    "cultural_context": "context",
+    "personality_specifics": "personality",
+    "knowledge": "knowledge_level",
+    "engagement": "engagement_level",
+    "attitude_towards_religion": "attitude",
+}
+
+def _field_name(column):
+    key = column.strip().lower().replace(" ", "_").replace("/", "_")
+    return FIELD_ALIASES.get(key, key)
+
+def load_specs(data, filename="specs.csv"):
+    """Parse persona specs from CSV or JSON text/bytes into normalised spec dicts"""
+    if isinstance(data, bytes):
+        data = data.decode("utf-8-sig")
+    if filename.lower().endswith(".json"):
+        rows = json.loads(data)
+        if isinstance(rows, dict):
+            rows = rows.get("personas", [])
+    else:
+        rows = list(csv.DictReader(io.StringIO(data)))
+
+    specs = []
+    for i, row in enumerate(rows, 1):
+        if isinstance(row.get("spec"), dict):
+            row = row["spec"]  # exported persona library
+        spec = normalize_spec({_field_name(key): value for key, value in row.items() if key})
+        missing = [field for field in REQUIRED_FIELDS if not spec[field]]
+        if missing:
+            raise Exception(f"Persona {i}: missing {', '.join(missing)}")
+        specs.append(spec)
+    return specs
+
+def generate_persona(describe, spec):
+    """Generate one persona record; falls back to a template description on error"""
+    record = {
+        "persona_id": uuid.uuid4().hex[:12],
+        "spec": spec,
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "error": "",
+    }
+    try:
+        description = describe(build_description_prompt(spec))
+        name = extract_name_from_description(description)
+    except Exception as e:
+        name, description = fallback_persona(spec)
+        record["error"] = str(e)
+    record["name"] = name
+    record["description"] = description
+    record["system_prompt"] = render_persona_prompt(spec, name)
+    return record
+
+def generate_personas(specs, describe, max_workers=BATCH_WORKERS, on_progress=None):
+    """Generate persona records for all specs concurrently, in input order
+
+    describe(prompt) performs one description call. At most `max_workers`
+    calls run at once; rate limits are left to the request scheduler that
+    describe() goes through. on_progress(done, total) is called from the
+    calling thread after each persona finishes.
+    """
+    results = [None] * len(specs)
+    with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(specs)))) as pool:
+        futures = {pool.submit(generate_persona, describe, spec): i for i, spec in enumerate(specs)}
+        for done, future in enumerate(as_completed(futures), 1):
+            results[futures[future]] = future.result()
+            if on_progress is not None:
+                on_progress(done, len(specs))
+    return results
+
+def library_to_json(records):
+    """Serialise persona records for download and later re-import"""
+    return json.dumps(
+        [{key: record[key] for key in ("persona_id", "name", "description", "spec", "system_prompt")} for record in records],
+        ensure_ascii=False,
+        indent=2
+    )
+
+def spec_csv_template():
+    """Empty CSV with the expected header, for teachers to fill in"""
+    return ",".join(PERSONA_FIELDS) + "\n"
@@ -0,0 +1,132 @@
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+# Generated personas kept per process, and for how long (seconds)
+PERSONA_CACHE_SIZE = int(os.environ.get("RECHAT_PERSONA_CACHE_SIZE", "256"))
+PERSONA_CACHE_TTL = float(os.environ.get("RECHAT_PERSONA_CACHE_TTL", str(12 * 3600)))
+# Optional directory for an on-disk tier shared across restarts and workers (empty disables)
+PERSONA_CACHE_DIR = os.environ.get("RECHAT_PERSONA_CACHE_DIR", "")
+
+def _normalize(value):
+    return " ".join(str(value).split()).casefold()
+
+def persona_cache_key(spec, llm_choice, model):
+    """Content hash of a persona spec plus the provider and model that generate it"""
+    payload = {field: _normalize(value) for field, value in sorted(spec.items())}
+    payload["_provider"] = llm_choice
+    payload["_model"] = model
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode("utf-8")).hexdigest()
+
+class _Creation:
+    """A persona being generated, with the outcome every waiting caller receives"""
+
+    __slots__ = ("done", "record", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.record = None
+        self.error = None
+
+class PersonaCache:
+    """Process-wide LRU/TTL cache of generated personas (description, name, system prompt)
+
+    Concurrent requests for the same key wait for the first one to finish,
+    so a class clicking "Create Persona" at once makes a single API call.
+    If that call fails, every waiting caller gets its error at once rather
+    than retrying one after another.
+    """
+
+    def __init__(self, max_entries=PERSONA_CACHE_SIZE, ttl=PERSONA_CACHE_TTL, disk_dir=PERSONA_CACHE_DIR):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.disk_dir = disk_dir
+        self._entries = OrderedDict()
+        self._inflight = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        if disk_dir:
+            os.makedirs(disk_dir, exist_ok=True)
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _fresh(self, created):
+        return self.ttl <= 0 or time.time() - created < self.ttl
+
+    def get(self, key):
+        """Cached record for key, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                if self._fresh(entry[0]):
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return entry[1]
+                del self._entries[key]
+        if self.disk_dir:
+            try:
+                with open(self._disk_path(key), encoding="utf-8") as f:
+                    stored = json.load(f)
+                if self._fresh(stored["created"]):
+                    self._remember(key, stored["record"], stored["created"])
+                    with self._lock:
+                        self.hits += 1
+                    return stored["record"]
+            except (OSError, ValueError, KeyError):
+                pass
+        return None
+
+    def put(self, key, record):
+        created = time.time()
+        self._remember(key, record, created)
+        if self.disk_dir:
+            tmp_path = self._disk_path(key) + ".tmp"
+            try:
+                with open(tmp_path, "w", encoding="utf-8") as f:
+                    json.dump({"created": created, "record": record}, f, ensure_ascii=False)
+                os.replace(tmp_path, self._disk_path(key))
+            except OSError:
+                pass
+
+    def _remember(self, key, record, created):
+        with self._lock:
+            self._entries[key] = (created, record)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def get_or_create(self, key, create):
+        """Return the cached record, or build it with create() exactly once across concurrent callers"""
+        record = self.get(key)
+        if record is not None:
+            return record
+        with self._lock:
+            creation = self._inflight.get(key)
+            owner = creation is None
+            if owner:
+                creation = self._inflight[key] = _Creation()
+                self.misses += 1
+        if not owner:
+            creation.done.wait()
+            if creation.error is not None:
+                raise creation.error
+            return creation.record
+        try:
+            creation.record = create()
+            self.put(key, creation.record)
+            return creation.record
+        except Exception as e:
+            creation.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+            creation.done.set()
+
+    def __len__(self):
+        return len(self._entries)
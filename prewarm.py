@@ -0,0 +1,116 @@
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+import chat
+from async_providers import REQUEST_TIMEOUT
+from context_window import count_tokens
+from llm_clients import hash_api_key
+from persona import normalize_question
+from providers import get_provider
+
+# Warm the provider's prompt cache as soon as a persona is created (a billed request, so off by default)
+PREWARM = os.environ.get("RECHAT_PREWARM", "0") == "1"
+# Pre-generate answers to likely opening questions (costs one full answer per question and persona)
+PREGENERATE = os.environ.get("RECHAT_PREGENERATE", "0") == "1"
+OPENING_QUESTIONS = [
+    question.strip()
+    for question in os.environ.get(
+        "RECHAT_OPENING_QUESTIONS",
+        "What do you believe?|Tell me about yourself.|What does your religion mean to you?|Do you pray?"
+    ).split("|")
+    if question.strip()
+]
+# Provider prompt caches expire after about five minutes, so a persona is warmed at most this often
+WARM_INTERVAL = 240.0
+OPENING_CACHE_SIZE = int(os.environ.get("RECHAT_OPENING_CACHE_SIZE", "512"))
+
+_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("RECHAT_PREWARM_THREADS", "4")),
+    thread_name_prefix="prewarm"
+)
+
+def _persona_hash(persona):
+    return hashlib.sha256(persona.encode("utf-8")).hexdigest()
+
+def worth_warming(llm_choice, persona, prompt_cache):
+    """True if a warm-up request can leave a cached prefix for the first turn to hit"""
+    return prompt_cache and count_tokens(persona) >= get_provider(llm_choice).min_cache_tokens
+
+class Prewarmer:
+    """Background warm-up and opening-answer cache for newly created personas
+
+    Answers are keyed by provider, persona prompt and normalised question,
+    and are only valid as the reply to the first question after the
+    greeting, which is where they are looked up.
+    """
+
+    def __init__(self, max_answers=OPENING_CACHE_SIZE, warm_interval=WARM_INTERVAL):
+        self.max_answers = max_answers
+        self.warm_interval = warm_interval
+        self._answers = OrderedDict()  # key -> Future of the answer
+        self._warmed = {}  # (provider, key hash, persona hash) -> time of the last warm-up
+        self._lock = threading.Lock()
+        self.hits = 0
+
+    def _answer_key(self, llm_choice, persona, question):
+        return (llm_choice, _persona_hash(persona), normalize_question(question))
+
+    def start(self, llm_choice, api_key, persona, greeting, prompt_cache=False, session_id="", warm=PREWARM, questions=None):
+        """Fire the warm-up and any pre-generation in the background; returns immediately
+
+        The warm-up is skipped unless prompt caching is on and the persona
+        prompt is long enough for the provider to cache.
+        """
+        history = [{"role": "assistant", "content": greeting}]
+        if warm and worth_warming(llm_choice, persona, prompt_cache):
+            warm_key = (llm_choice, hash_api_key(api_key), _persona_hash(persona))
+            with self._lock:
+                due = time.monotonic() - self._warmed.get(warm_key, -self.warm_interval) >= self.warm_interval
+                if due:
+                    self._warmed[warm_key] = time.monotonic()
+            if due:
+                _executor.submit(self._warm, llm_choice, api_key, persona, history, prompt_cache, session_id)
+        for question in questions or []:
+            key = self._answer_key(llm_choice, persona, question)
+            with self._lock:
+                if key in self._answers:
+                    continue
+                self._answers[key] = _executor.submit(
+                    chat.generate_response,
+                    llm_choice, api_key, persona, history + [{"role": "user", "content": question}], question,
+                    prompt_cache, session_id=session_id, kind="pregenerate"
+                )
+                while len(self._answers) > self.max_answers:
+                    self._answers.popitem(last=False)
+
+    def _warm(self, llm_choice, api_key, persona, history, prompt_cache, session_id):
+        try:
+            chat.warm_up(llm_choice, api_key, persona, history, prompt_cache, session_id)
+        except Exception:
+            pass  # only an optimisation; the failure is in the trace and the first turn goes cold
+
+    def opening_answer(self, llm_choice, persona, question, timeout=REQUEST_TIMEOUT):
+        """Pre-generated answer to a first question, waiting for it if still in flight; None if there is none"""
+        key = self._answer_key(llm_choice, persona, question)
+        with self._lock:
+            future = self._answers.get(key)
+            if future is not None:
+                self._answers.move_to_end(key)
+        if future is None:
+            return None
+        try:
+            answer = future.result(timeout)
+        except Exception:
+            with self._lock:
+                if self._answers.get(key) is future:
+                    del self._answers[key]  # failed; let a later persona creation try again
+            return None
+        with self._lock:
+            self.hits += 1
+        return answer
+
+PREWARMER = Prewarmer()
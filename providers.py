@@ -0,0 +1,404 @@
+import asyncio
+import hashlib
+import os
+import random
+import time
+from datetime import datetime
+
+# User turn sent by warm-up requests, which ask for a single output token
+WARMUP_INPUT = "Hello"
+
+def summary_text(summary):
+    return f"Summary of the earlier part of this conversation:\n{summary}"
+
+def new_usage_entry(llm_choice, input_tokens, cache_read_tokens, cache_write_tokens, output_tokens):
+    """Normalised per-turn usage record, split into cache hits and misses"""
+    return {
+        "input_tokens": input_tokens,
+        "cache_read_tokens": cache_read_tokens,
+        "cache_write_tokens": cache_write_tokens,
+        "cache_miss_tokens": input_tokens - cache_read_tokens,
+        "output_tokens": output_tokens,
+        "provider": llm_choice,
+        "timestamp": datetime.now().isoformat(timespec="seconds"),
+    }
+
+class Provider:
+    """Base class for a chat model provider
+
+    SDKs are imported inside the methods, so each one is only loaded the
+    first time its provider is used. Providers whose SDK has an asyncio
+    API also implement create_async_client() and astream(), which stream
+    on an event loop without holding a thread.
+    """
+
+    name = ""
+    model = ""
+    # Shortest prompt prefix (in tokens) the provider will cache; shorter prompts are never cache hits
+    min_cache_tokens = 1024
+
+    def create_client(self, api_key, connect_timeout, read_timeout):
+        raise NotImplementedError
+
+    def create_async_client(self, api_key, connect_timeout, read_timeout):
+        """Client for the SDK's asyncio API, or None if there is none (calls then run on a thread)"""
+        return None
+
+    def prepare(self, api_key):
+        """Hook for SDKs that keep global configuration; called when the active key changes"""
+
+    def describe(self, client, prompt, max_tokens=200):
+        """One-shot completion for a single user prompt"""
+        raise NotImplementedError
+
+    def complete(self, client, persona, history, user_input, summary="", prompt_cache=False, usage_log=None, max_tokens=500):
+        raise NotImplementedError
+
+    def stream(self, client, persona, history, user_input, summary="", prompt_cache=False, usage_log=None, max_tokens=500):
+        raise NotImplementedError
+
+    async def astream(self, client, persona, history, user_input, summary="", prompt_cache=False, usage_log=None, max_tokens=500):
+        """stream() on an async client from create_async_client()"""
+        raise NotImplementedError
+        yield
+
+    def warm(self, client, persona, history, prompt_cache=False, usage_log=None):
+        """One-token request that opens the connection and, with prompt caching, writes the persona prefix"""
+        self.complete(
+            client, persona, history + [{"role": "user", "content": WARMUP_INPUT}], WARMUP_INPUT,
+            prompt_cache=prompt_cache, usage_log=usage_log, max_tokens=1
+        )
+
+    def record_usage(self, usage_log, usage):
+        if usage_log is None or usage is None:
+            return
+        usage_log.append(self.usage_entry(usage))
+
+    def usage_entry(self, usage):
+        raise NotImplementedError
+
+class OpenAIProvider(Provider):
+    name = "OpenAI GPT-4o"
+    model = "gpt-4o"
+
+    def create_client(self, api_key, connect_timeout, read_timeout):
+        import openai
+        # Retries are handled with jittered backoff in async_providers
+        return openai.OpenAI(api_key=api_key, timeout=openai.Timeout(read_timeout, connect=connect_timeout), max_retries=0)
+
+    def create_async_client(self, api_key, connect_timeout, read_timeout):
+        import openai
+        return openai.AsyncOpenAI(api_key=api_key, timeout=openai.Timeout(read_timeout, connect=connect_timeout), max_retries=0)
+
+    def build_request(self, persona, history, prompt_cache=False, summary=""):
+        """Build request arguments, static persona first so automatic prefix caching can hit"""
+        openai_messages = [{"role": "system", "content": persona}]
+        if summary:
+            openai_messages.append({"role": "system", "content": summary_text(summary)})
+        openai_messages += [{"role": msg["role"], "content": msg["content"]} for msg in history]
+        request = {"messages": openai_messages}
+        if prompt_cache:
+            # Route every request for the same persona to the same cache shard
+            persona_hash = hashlib.sha256(persona.encode("utf-8")).hexdigest()[:32]
+            request["extra_body"] = {"prompt_cache_key": f"persona-{persona_hash}"}
+        return request
+
+    def describe(self, client, prompt, max_tokens=200):
+        response = client.chat.completions.create(
+            model=self.model,
+            messages=[{"role": "user", "content": prompt}],
+            max_tokens=max_tokens,
+            temperature=0.7
+        )
+        return response.choices[0].message.content
+
+    def complete(self, client, persona, history, user_input, summary="", prompt_cache=False, usage_log=None, max_tokens=500):
+        response = client.chat.completions.create(
+            model=self.model,
+            max_tokens=max_tokens,
+            #temperature=0.7
+            **self.build_request(persona, history, prompt_cache, summary)
+        )
+        self.record_usage(usage_log, response.usage)
+        return response.choices[0].message.content
+
+    def stream(self, client, persona, history, user_input, summary="", prompt_cache=False, usage_log=None, max_tokens=500):
+        stream = client.chat.completions.create(
+            model=self.model,
+            max_tokens=max_tokens,
+            stream=True,
+            stream_options={"include_usage": True},
+            **self.build_request(persona, history, prompt_cache, summary)
+        )
+        for chunk in stream:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+            if chunk.usage:
+                self.record_usage(usage_log, chunk.usage)
+
+    async def astream(self, client, persona, history, user_input, summary="", prompt_cache=False, usage_log=None, max_tokens=500):
+        stream = await client.chat.completions.create(
+            model=self.model,
+            max_tokens=max_tokens,
+            stream=True,
+            stream_options={"include_usage": True},
+            **self.build_request(persona, history, prompt_cache, summary)
+        )
+        try:
+            async for chunk in stream:
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+                if chunk.usage:
+                    self.record_usage(usage_log, chunk.usage)
+        finally:
+            await stream.close()
+
+    def usage_entry(self, usage):
+        details = getattr(usage, "prompt_tokens_details", None)
+        cached = (getattr(details, "cached_tokens", 0) or 0) if details else 0
+        return new_usage_entry(self.name, usage.prompt_tokens, cached, 0, usage.completion_tokens)
+
+class ClaudeProvider(Provider):
+    name = "Claude (Anthropic)"
+    model = "claude-sonnet-4-20250514"
+
+    def create_client(self, api_key, connect_timeout, read_timeout):
+        import anthropic
+        # Retries are handled with jittered backoff in async_providers
+        return anthropic.Anthropic(api_key=api_key, timeout=anthropic.Timeout(read_timeout, connect=connect_timeout), max_retries=0)
+
+    def create_async_client(self, api_key, connect_timeout, read_timeout):
+        import anthropic
+        return anthropic.AsyncAnthropic(api_key=api_key, timeout=anthropic.Timeout(read_timeout, connect=connect_timeout), max_retries=0)
+
+    def build_request(self, persona, history, prompt_cache=False, summary=""):
+        """Build request arguments, marking cache breakpoints when prompt caching is on"""
+        claude_messages = [{"role": msg["role"], "content": msg["content"]} for msg in history]
+        if not prompt_cache:
+            system = persona + "\n\n" + summary_text(summary) if summary else persona
+            return {"system": system, "messages": claude_messages}
+
+        system = [{"type": "text", "text": persona, "cache_control": {"type": "ephemeral"}}]
+        if summary:
+            system.append({"type": "text", "text": summary_text(summary)})
+        # Everything before the new question is the stable prefix of the history
+        if len(claude_messages) >= 2:
+            prefix_end = claude_messages[-2]
+            claude_messages[-2] = {
+                "role": prefix_end["role"],
+                "content": [{"type": "text", "text": prefix_end["content"], "cache_control": {"type": "ephemeral"}}]
+            }
+        return {"system": system, "messages": claude_messages}
+
+    def describe(self, client, prompt, max_tokens=200):
+        response = client.messages.create(
+            model=self.model,
+            max_tokens=max_tokens,
+            messages=[{"role": "user", "content": prompt}]
+        )
+        return response.content[0].text
+
+    def complete(self, client, persona, history, user_input, summary="", prompt_cache=False, usage_log=None, max_tokens=500):
+        response = client.messages.create(
+            model=self.model,
+            max_tokens=max_tokens,
+            **self.build_request(persona, history, prompt_cache, summary)
+        )
+        self.record_usage(usage_log, response.usage)
+        return response.content[0].text
+
+    def stream(self, client, persona, history, user_input, summary="", prompt_cache=False, usage_log=None, max_tokens=500):
+        with client.messages.stream(
+            model=self.model,
+            max_tokens=max_tokens,
+            **self.build_request(persona, history, prompt_cache, summary)
+        ) as stream:
+            for text in stream.text_stream:
+                yield text
+            self.record_usage(usage_log, stream.get_final_message().usage)
+
+    async def astream(self, client, persona, history, user_input, summary="", prompt_cache=False, usage_log=None, max_tokens=500):
+        async with client.messages.stream(
+            model=self.model,
+            max_tokens=max_tokens,
+            **self.build_request(persona, history, prompt_cache, summary)
+        ) as stream:
+            async for text in stream.text_stream:
+                yield text
+            self.record_usage(usage_log, (await stream.get_final_message()).usage)
+
+    def usage_entry(self, usage):
+        cache_read = getattr(usage, "cache_read_input_tokens", 0) or 0
+        cache_write = getattr(usage, "cache_creation_input_tokens", 0) or 0
+        return new_usage_entry(
+            self.name, usage.input_tokens + cache_read + cache_write, cache_read, cache_write, usage.output_tokens
+        )
+
+class GeminiProvider(Provider):
+    name = "Google Gemini"
+    model = "gemini-pro"
+
+    def create_client(self, api_key, connect_timeout, read_timeout):
+        import google.generativeai as genai
+        return genai.GenerativeModel(self.model)
+
+    def create_async_client(self, api_key, connect_timeout, read_timeout):
+        # The same model object; its *_async methods use genai's asyncio transport
+        return self.create_client(api_key, connect_timeout, read_timeout)
+
+    def prepare(self, api_key):
+        # genai keeps a single global configuration
+        import google.generativeai as genai
+        genai.configure(api_key=api_key)
+
+    def build_prompt(self, persona, history, user_input, summary=""):
+        """Flatten persona, summary and recent history into a single prompt"""
+        prompt = persona + "\n\n"
+        if summary:
+            prompt += summary_text(summary) + "\n\n"
+        prompt += "Conversation:\n"
+        for msg in history:
+            role = "Human" if msg["role"] == "user" else "Assistant"
+            prompt += f"{role}: {msg['content']}\n"
+        if not history or history[-1]["role"] != "user":
+            prompt += f"Human: {user_input}\n"
+        prompt += "Assistant:"
+        return prompt
+
+    def describe(self, client, prompt, max_tokens=200):
+        return client.generate_content(prompt).text
+
+    def complete(self, client, persona, history, user_input, summary="", prompt_cache=False, usage_log=None, max_tokens=500):
+        response = client.generate_content(self.build_prompt(persona, history, user_input, summary))
+        self.record_usage(usage_log, getattr(response, "usage_metadata", None))
+        return response.text
+
+    def stream(self, client, persona, history, user_input, summary="", prompt_cache=False, usage_log=None, max_tokens=500):
+        response = client.generate_content(self.build_prompt(persona, history, user_input, summary), stream=True)
+        for chunk in response:
+            if chunk.text:
+                yield chunk.text
+        self.record_usage(usage_log, getattr(response, "usage_metadata", None))
+
+    async def astream(self, client, persona, history, user_input, summary="", prompt_cache=False, usage_log=None, max_tokens=500):
+        response = await client.generate_content_async(self.build_prompt(persona, history, user_input, summary), stream=True)
+        async for chunk in response:
+            if chunk.text:
+                yield chunk.text
+        self.record_usage(usage_log, getattr(response, "usage_metadata", None))
+
+    def usage_entry(self, usage):
+        return new_usage_entry(
+            self.name,
+            getattr(usage, "prompt_token_count", 0) or 0,
+            getattr(usage, "cached_content_token_count", 0) or 0,
+            0,
+            getattr(usage, "candidates_token_count", 0) or 0,
+        )
+
+# Local stub settings: seconds before the first token, tokens per second, and the random seed
+STUB_LATENCY = float(os.environ.get("RECHAT_STUB_LATENCY", "0.3"))
+STUB_TOKEN_RATE = float(os.environ.get("RECHAT_STUB_TOKEN_RATE", "40"))
+STUB_SEED = int(os.environ.get("RECHAT_STUB_SEED", "0"))
+
+STUB_NAMES = ["Ahmed", "Sara", "Miriam", "Jonas", "Priya", "Elias", "Leila", "Daniel", "Amira", "Tenzin"]
+STUB_SENTENCES = [
+    "[shifts in chair] Well, that is a good question.",
+    "I grew up with it, so for me it is just part of ordinary life.",
+    "Honestly, I am not sure I know the details about that.",
+    "My family cares about it more than I do, if I am being honest.",
+    "[pauses] Some people in my community would answer differently.",
+    "I try to go when I can, but it does not always happen.",
+    "For me it is more about belonging than about rules.",
+    "[laughs a little] My grandmother would say I am doing it wrong.",
+    "I have my doubts about some of the teachings, to be honest.",
+    "It gives me some calm when things get stressful at work.",
+]
+
+class StubClient:
+    """Offline stand-in for an SDK client with configurable latency and token rate"""
+
+    def __init__(self, latency=STUB_LATENCY, token_rate=STUB_TOKEN_RATE, seed=STUB_SEED):
+        self.latency = latency
+        self.token_rate = token_rate
+        self.seed = seed
+
+    def rng(self, *parts):
+        """Random generator seeded from the request, so the same input gives the same reply"""
+        digest = hashlib.sha256("\x00".join([str(self.seed)] + [str(part) for part in parts]).encode("utf-8")).digest()
+        return random.Random(digest)
+
+class StubProvider(Provider):
+    """Deterministic local provider for development and load testing, no API key needed"""
+
+    name = "Local stub"
+    model = "stub"
+    min_cache_tokens = 0
+
+    def create_client(self, api_key, connect_timeout, read_timeout):
+        return StubClient()
+
+    def create_async_client(self, api_key, connect_timeout, read_timeout):
+        return StubClient()
+
+    def reply_tokens(self, client, persona, history, user_input):
+        rng = client.rng(persona, len(history), user_input)
+        reply = " ".join(rng.sample(STUB_SENTENCES, rng.randint(2, 4)))
+        return [word + " " for word in reply.split(" ")]
+
+    def emit(self, client, tokens):
+        time.sleep(client.latency)
+        for token in tokens:
+            if client.token_rate > 0:
+                time.sleep(1 / client.token_rate)
+            yield token
+
+    def describe(self, client, prompt, max_tokens=200):
+        rng = client.rng(prompt)
+        time.sleep(client.latency)
+        return (
+            f"This is {rng.choice(STUB_NAMES)}, a {rng.randint(18, 70)}-year-old taking part in a classroom interview. "
+            "They describe their relationship to their tradition in their own words."
+        )
+
+    def complete(self, client, persona, history, user_input, summary="", prompt_cache=False, usage_log=None, max_tokens=500):
+        tokens = self.reply_tokens(client, persona, history, user_input)
+        text = "".join(self.emit(client, tokens)).strip()
+        self.record_usage(usage_log, (persona, history, tokens))
+        return text
+
+    def stream(self, client, persona, history, user_input, summary="", prompt_cache=False, usage_log=None, max_tokens=500):
+        tokens = self.reply_tokens(client, persona, history, user_input)
+        tokens[-1] = tokens[-1].rstrip()
+        yield from self.emit(client, tokens)
+        self.record_usage(usage_log, (persona, history, tokens))
+
+    async def astream(self, client, persona, history, user_input, summary="", prompt_cache=False, usage_log=None, max_tokens=500):
+        tokens = self.reply_tokens(client, persona, history, user_input)
+        tokens[-1] = tokens[-1].rstrip()
+        await asyncio.sleep(client.latency)
+        for token in tokens:
+            if client.token_rate > 0:
+                await asyncio.sleep(1 / client.token_rate)
+            yield token
+        self.record_usage(usage_log, (persona, history, tokens))
+
+    def warm(self, client, persona, history, prompt_cache=False, usage_log=None):
+        time.sleep(client.latency)
+
+    def usage_entry(self, usage):
+        persona, history, tokens = usage
+        input_tokens = (len(persona) + sum(len(msg["content"]) for msg in history)) // 4
+        return new_usage_entry(self.name, input_tokens, 0, 0, len(tokens))
+
+PROVIDERS = {
+    provider.name: provider
+    for provider in (OpenAIProvider(), ClaudeProvider(), GeminiProvider(), StubProvider())
+}
+
+def get_provider(llm_choice):
+    """Look up the provider plugin for a model choice"""
+    provider = PROVIDERS.get(llm_choice)
+    if provider is None:
+        raise Exception(f"Unknown provider: {llm_choice}")
+    return provider
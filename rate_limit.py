@@ -0,0 +1,207 @@
+import os
+import threading
+import time
+from collections import OrderedDict, deque
+
+from llm_clients import hash_api_key
+
+class TokenBucket:
+    """Thread-safe token bucket refilled at `rate` tokens per second, holding at most `capacity`"""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def peek(self, amount=1):
+        """Seconds until `amount` tokens are available, without taking them"""
+        with self._lock:
+            self._refill()
+            return 0.0 if self.tokens >= amount else (amount - self.tokens) / self.rate
+
+    def adjust(self, amount):
+        """Return (positive) or charge (negative) tokens after the fact; the balance may go negative"""
+        with self._lock:
+            self._refill()
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+    def try_acquire(self, amount=1):
+        """Take `amount` tokens if available; returns 0, or the seconds to wait before retrying"""
+        with self._lock:
+            self._refill()
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return 0.0
+            return (amount - self.tokens) / self.rate
+
+    def acquire(self, amount=1):
+        """Block until `amount` tokens are available; returns the seconds spent waiting"""
+        waited = 0.0
+        while True:
+            wait = self.try_acquire(amount)
+            if wait == 0:
+                return waited
+            time.sleep(wait)
+            waited += wait
+
+# Budgets per (provider, API key): requests and tokens per minute (0 = unlimited)
+PROVIDER_RPM = {
+    "OpenAI GPT-4o": 500,
+    "Claude (Anthropic)": 50,
+    "Google Gemini": 60,
+    "Local stub": 0,
+}
+PROVIDER_TPM = {
+    "OpenAI GPT-4o": 30000,
+    "Claude (Anthropic)": 40000,
+    "Google Gemini": 32000,
+    "Local stub": 0,
+}
+if os.environ.get("RECHAT_RPM"):
+    PROVIDER_RPM = {name: int(os.environ["RECHAT_RPM"]) for name in PROVIDER_RPM}
+if os.environ.get("RECHAT_TPM"):
+    PROVIDER_TPM = {name: int(os.environ["RECHAT_TPM"]) for name in PROVIDER_TPM}
+# Seconds a request may wait in the queue before giving up
+QUEUE_TIMEOUT = float(os.environ.get("RECHAT_QUEUE_TIMEOUT", "120"))
+
+class QueueTimeout(Exception):
+    pass
+
+class Ticket:
+    """One queued request; settle() corrects the token budget once real usage is known"""
+
+    def __init__(self, lane, session_id, tokens):
+        self.lane = lane
+        self.session_id = session_id
+        self.tokens = tokens
+        self.charged = 0  # tokens actually taken from the budget, at most the bucket's capacity
+        self.waited = 0.0
+
+    def settle(self, used_tokens):
+        if self.lane.tpm is not None:
+            self.lane.tpm.adjust(self.charged - used_tokens)
+
+class _Lane:
+    def __init__(self, rpm, tpm):
+        # Allow a burst of a tenth of the per-minute budget
+        self.rpm = TokenBucket(rpm / 60, capacity=max(1.0, rpm / 10)) if rpm else None
+        self.tpm = TokenBucket(tpm / 60, capacity=max(1.0, tpm / 10)) if tpm else None
+        self.sessions = OrderedDict()  # session_id -> deque of waiting tickets, in round-robin order
+
+    def position(self, ticket):
+        """Number of requests that will be served before this ticket"""
+        index = self.sessions[ticket.session_id].index(ticket)
+        ahead, before = index, True
+        for session_id, queue in self.sessions.items():
+            if session_id == ticket.session_id:
+                before = False
+            else:
+                ahead += min(len(queue), index + 1 if before else index)
+        return ahead
+
+    def head(self):
+        return next(iter(self.sessions.values()))[0]
+
+    def pop_head(self):
+        session_id, queue = next(iter(self.sessions.items()))
+        queue.popleft()
+        if queue:
+            self.sessions.move_to_end(session_id)  # next session's turn
+        else:
+            del self.sessions[session_id]
+
+    def budget_wait(self, ticket):
+        """0 if both budgets allow the ticket's request now (and take from them), else the seconds to wait"""
+        wait = self.rpm.peek(1) if self.rpm is not None else 0.0
+        if self.tpm is not None:
+            wait = max(wait, self.tpm.peek(min(ticket.tokens, self.tpm.capacity)))
+        if wait == 0:
+            if self.rpm is not None:
+                self.rpm.try_acquire(1)
+            if self.tpm is not None:
+                # A request larger than the bucket only waits for a full bucket; settle() charges the rest
+                ticket.charged = min(ticket.tokens, self.tpm.capacity)
+                self.tpm.try_acquire(ticket.charged)
+        return wait
+
+class RequestScheduler:
+    """Process-wide queue for provider requests, per (provider, API key)
+
+    Requests wait until the key's requests-per-minute and tokens-per-minute
+    buckets allow them. Waiting sessions are served round-robin, so one
+    session with several requests queued cannot starve the others.
+    """
+
+    def __init__(self, rpm_limits=PROVIDER_RPM, tpm_limits=PROVIDER_TPM):
+        self.rpm_limits = rpm_limits
+        self.tpm_limits = tpm_limits
+        self._lanes = {}
+        self._cond = threading.Condition()
+
+    def _lane(self, llm_choice, api_key):
+        key = (llm_choice, hash_api_key(api_key))
+        lane = self._lanes.get(key)
+        if lane is None:
+            lane = self._lanes[key] = _Lane(self.rpm_limits.get(llm_choice, 0), self.tpm_limits.get(llm_choice, 0))
+        return lane
+
+    def acquire(self, llm_choice, api_key, session_id, tokens=0, on_wait=None, timeout=QUEUE_TIMEOUT):
+        """Block until this session's request may be sent; returns its Ticket
+
+        on_wait(position) is called from the calling thread whenever the
+        number of requests ahead in the queue changes, without holding the
+        scheduler's lock.
+        """
+        started = time.monotonic()
+        with self._cond:
+            lane = self._lane(llm_choice, api_key)
+            ticket = Ticket(lane, session_id, tokens)
+            if lane.rpm is None and lane.tpm is None:
+                return ticket
+            lane.sessions.setdefault(session_id, deque()).append(ticket)
+            reported = None
+            try:
+                while True:
+                    wait = 1.0
+                    if lane.head() is ticket:
+                        wait = lane.budget_wait(ticket)
+                        if wait == 0:
+                            lane.pop_head()
+                            self._cond.notify_all()
+                            ticket.waited = time.monotonic() - started
+                            return ticket
+                    position = lane.position(ticket)
+                    if on_wait is not None and position != reported:
+                        reported = position
+                        self._cond.release()
+                        try:
+                            on_wait(position)
+                        finally:
+                            self._cond.acquire()
+                        continue  # the queue may have moved meanwhile
+                    remaining = timeout - (time.monotonic() - started)
+                    if remaining <= 0:
+                        raise QueueTimeout(f"{llm_choice} is busy; still {position} requests ahead after {timeout:.0f} s")
+                    self._cond.wait(min(wait, remaining))
+            except BaseException:
+                queue = lane.sessions.get(session_id)
+                if queue is not None and ticket in queue:
+                    queue.remove(ticket)
+                    if not queue:
+                        del lane.sessions[session_id]
+                    self._cond.notify_all()
+                raise
+
+    def queued(self):
+        """Waiting requests per (provider, key hash)"""
+        with self._cond:
+            return {key: sum(len(queue) for queue in lane.sessions.values()) for key, lane in self._lanes.items()}
+
+SCHEDULER = RequestScheduler()
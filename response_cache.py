@@ -0,0 +1,152 @@
+import hashlib
+import os
+import random
+import threading
+import zlib
+from collections import OrderedDict
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+from persona import is_departure_reply, looks_offensive, normalize_question
+
+# Opt-in reuse of answers to repeated questions to the same persona
+RESPONSE_CACHE = os.environ.get("RECHAT_RESPONSE_CACHE", "0") == "1"
+RESPONSE_CACHE_SIZE = int(os.environ.get("RECHAT_RESPONSE_CACHE_SIZE", "1024"))
+# Cosine similarity a question needs to reuse another question's answer (above 1 = exact matches only)
+SIMILARITY_THRESHOLD = float(os.environ.get("RECHAT_RESPONSE_CACHE_THRESHOLD", "0.8"))
+# Chance that a hit is answered afresh anyway, adding a variant for later hits (0 = always reuse)
+VARIATION = float(os.environ.get("RECHAT_RESPONSE_CACHE_VARIATION", "0.2"))
+# Answers kept per question, picked from at random on a hit
+MAX_VARIANTS = 3
+# Messages before the question that must match for an answer to be reused
+FINGERPRINT_MESSAGES = 2
+VECTOR_SIZE = 1024
+
+def history_fingerprint(history, depth=FINGERPRINT_MESSAGES):
+    """Short hash of the last few messages before the question"""
+    tail = "\x00".join(f"{msg['role']}:{' '.join(msg['content'].split())}" for msg in history[-depth:])
+    return hashlib.sha256(tail.encode("utf-8")).hexdigest()[:16]
+
+def _features(question):
+    """Hashed word and character-trigram features of a normalised question"""
+    padded = f" {question} "
+    grams = question.split() + [padded[i:i + 3] for i in range(len(padded) - 2)]
+    return [zlib.crc32(gram.encode("utf-8")) % VECTOR_SIZE for gram in grams]
+
+class _Bucket:
+    """Questions asked of one persona after the same history, with a TF matrix for similarity search"""
+
+    def __init__(self):
+        self.questions = []
+        self.rows = []
+        self._matrix = None
+
+    def add(self, question):
+        row = np.zeros(VECTOR_SIZE, dtype=np.float32)
+        np.add.at(row, _features(question), 1.0)
+        self.questions.append(question)
+        self.rows.append(row)
+        self._matrix = None
+
+    def remove(self, question):
+        index = self.questions.index(question)
+        del self.questions[index]
+        del self.rows[index]
+        self._matrix = None
+
+    def nearest(self, question, idf):
+        """(question, similarity) of the closest stored question under TF-IDF cosine similarity"""
+        if self._matrix is None:
+            self._matrix = np.vstack(self.rows)
+        query = np.zeros(VECTOR_SIZE, dtype=np.float32)
+        np.add.at(query, _features(question), 1.0)
+        weighted = self._matrix * idf
+        query = query * idf
+        norms = np.linalg.norm(weighted, axis=1) * (np.linalg.norm(query) or 1.0)
+        scores = weighted @ query / np.where(norms == 0, 1.0, norms)
+        best = int(np.argmax(scores))
+        return self.questions[best], float(scores[best])
+
+class ResponseCache:
+    """Bounded LRU of persona answers, looked up by exact question first and then by similarity
+
+    Entries are keyed by provider and persona prompt hash, a fingerprint of
+    the messages just before the question, and the normalised question, so
+    an answer is only reused where the conversation so far is the same
+    (in practice, mostly the opening questions to a shared persona).
+    """
+
+    def __init__(self, max_entries=RESPONSE_CACHE_SIZE, threshold=SIMILARITY_THRESHOLD, variation=VARIATION, seed=None):
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self.variation = variation
+        self._entries = OrderedDict()  # (bucket key, question) -> list of answer variants
+        self._buckets = {}
+        self._df = np.zeros(VECTOR_SIZE, dtype=np.float32) if np is not None else None
+        self._lock = threading.Lock()
+        self._rng = random.Random(seed)
+        self.hits = 0
+        self.misses = 0
+
+    def _bucket_key(self, llm_choice, persona, history):
+        persona_hash = hashlib.sha256(f"{llm_choice}\x00{persona}".encode("utf-8")).hexdigest()[:16]
+        return persona_hash, history_fingerprint(history)
+
+    def _idf(self):
+        return np.log((len(self._entries) + 1) / (self._df + 1)) + 1.0
+
+    def lookup(self, llm_choice, persona, history, question, variation=None):
+        """A cached answer for the question, or None on a miss (or when a fresh variant is due)"""
+        variation = self.variation if variation is None else variation
+        bucket_key = self._bucket_key(llm_choice, persona, history)
+        question = normalize_question(question)
+        with self._lock:
+            variants = self._entries.get((bucket_key, question))
+            if variants is None and np is not None and bucket_key in self._buckets:
+                nearest, score = self._buckets[bucket_key].nearest(question, self._idf())
+                if score >= self.threshold:
+                    question, variants = nearest, self._entries[(bucket_key, nearest)]
+            if variants is None or (len(variants) < MAX_VARIANTS and self._rng.random() < variation):
+                self.misses += 1
+                return None
+            self._entries.move_to_end((bucket_key, question))
+            self.hits += 1
+            return self._rng.choice(variants)
+
+    def store(self, llm_choice, persona, history, question, answer):
+        """Remember an answer; departures and replies to offensive questions are never reused"""
+        if not answer or is_departure_reply(answer) or looks_offensive(question):
+            return
+        bucket_key = self._bucket_key(llm_choice, persona, history)
+        question = normalize_question(question)
+        key = (bucket_key, question)
+        with self._lock:
+            variants = self._entries.get(key)
+            if variants is not None:
+                if answer not in variants and len(variants) < MAX_VARIANTS:
+                    variants.append(answer)
+                self._entries.move_to_end(key)
+                return
+            self._entries[key] = [answer]
+            if np is not None:
+                self._buckets.setdefault(bucket_key, _Bucket()).add(question)
+                self._df[list(set(_features(question)))] += 1
+            while len(self._entries) > self.max_entries:
+                self._evict()
+
+    def _evict(self):
+        (bucket_key, question), _ = self._entries.popitem(last=False)
+        if np is not None:
+            bucket = self._buckets[bucket_key]
+            bucket.remove(question)
+            if not bucket.questions:
+                del self._buckets[bucket_key]
+            self._df[list(set(_features(question)))] -= 1
+
+    def __len__(self):
+        return len(self._entries)
+
+RESPONSES = ResponseCache()
@@ -0,0 +1,150 @@
+import os
+import sys
+import threading
+import time
+import weakref
+
+# Messages kept in memory per session; older ones are dropped once they are in the transcript store (0 = no cap)
+HISTORY_CAP = int(os.environ.get("RECHAT_HISTORY_CAP", "200"))
+# Idle seconds after which a stored session's conversation is evicted from memory (0 = never)
+SESSION_TTL = float(os.environ.get("RECHAT_SESSION_TTL", "1800"))
+REAP_INTERVAL = 60.0
+# Per-turn token usage records kept per session (the app only shows the latest)
+USAGE_HISTORY = 20
+
+class Message:
+    """One chat message; supports the dict-style access used for plain message dicts elsewhere"""
+
+    __slots__ = ("role", "content", "tokens")
+
+    def __init__(self, role, content, tokens=None):
+        self.role = sys.intern(role)
+        self.content = content
+        self.tokens = tokens
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        setattr(self, key, value)
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None)
+        return default if value is None else value
+
+    def __repr__(self):
+        return f"Message({self.role!r}, {self.content[:40]!r})"
+
+def intern_text(text):
+    """Share one copy of a persona prompt or description between every session that uses it"""
+    return sys.intern(text) if isinstance(text, str) else text
+
+def spill_count(length, cap=HISTORY_CAP):
+    """Number of oldest messages to drop from memory, in batches of a quarter of the cap"""
+    if cap <= 0 or length <= cap:
+        return 0
+    return length - (cap - cap // 4)
+
+class SessionMemory:
+    """Per-session handle the reaper uses to find and release a session's conversation"""
+
+    __slots__ = ("messages", "buffer", "context", "usage", "persona", "offset", "persistent", "last_seen", "evicted", "_lock", "__weakref__")
+
+    def __init__(self):
+        self.messages = []
+        self.buffer = None
+        self.context = None
+        self.usage = None
+        self.persona = ""
+        self.offset = 0
+        self.persistent = False
+        self.last_seen = time.monotonic()
+        self.evicted = False
+        self._lock = threading.Lock()
+
+    def touch(self, messages, buffer, persona, offset, persistent, context=None, usage=None):
+        """Record activity and the session's current conversation (call at the start and end of each run)"""
+        with self._lock:
+            self.messages = messages
+            self.buffer = buffer
+            self.context = context
+            self.usage = usage
+            self.persona = persona
+            self.offset = offset
+            self.persistent = persistent
+            self.last_seen = time.monotonic()
+
+    def evict(self, ttl):
+        """Release the conversation, its transcript chunks, context summary and usage records if idle for ttl seconds and safely stored; True if evicted
+
+        The persona prompt is shared between sessions and stays; the session
+        reloads everything else from the store on its next run.
+        """
+        with self._lock:
+            if self.evicted or not self.persistent or not self.messages or time.monotonic() - self.last_seen < ttl:
+                return False
+            self.messages.clear()  # the session reloads it from the store on its next run
+            if self.buffer is not None:
+                self.buffer.clear()
+            if self.context is not None:
+                self.context.reset()  # resume_session re-seeds it from the stored history
+            if self.usage is not None:
+                self.usage.clear()
+            self.evicted = True
+            return True
+
+class SessionRegistry:
+    """Weak registry of live sessions, with a background reaper for idle ones"""
+
+    def __init__(self, ttl=SESSION_TTL, interval=REAP_INTERVAL):
+        self.ttl = ttl
+        self.interval = interval
+        self._sessions = weakref.WeakSet()
+        self._lock = threading.Lock()
+        self._reaper = None
+        self.evictions = 0
+
+    def register(self, memory):
+        with self._lock:
+            self._sessions.add(memory)
+            if self._reaper is None and self.ttl > 0:
+                self._reaper = threading.Thread(target=self._reap_loop, name="session-reaper", daemon=True)
+                self._reaper.start()
+
+    def reap(self):
+        """Evict every idle session now; returns how many were evicted"""
+        with self._lock:
+            sessions = list(self._sessions)
+        evicted = sum(1 for memory in sessions if memory.evict(self.ttl))
+        with self._lock:
+            self.evictions += evicted
+        return evicted
+
+    def _reap_loop(self):
+        while True:
+            time.sleep(self.interval)
+            self.reap()
+
+    def report(self):
+        """Memory held by live sessions, for the debug panel"""
+        with self._lock:
+            sessions = list(self._sessions)
+        prompts = {id(memory.persona): len(memory.persona) for memory in sessions if memory.persona}
+        with_prompt = sum(1 for memory in sessions if memory.persona)
+        return {
+            "sessions": len(sessions),
+            "evicted_sessions": sum(1 for memory in sessions if memory.evicted),
+            "evictions_total": self.evictions,
+            "messages_in_memory": sum(len(memory.messages) for memory in sessions),
+            "message_bytes": sum(len(msg["content"]) for memory in sessions for msg in list(memory.messages)),
+            "messages_spilled": sum(memory.offset for memory in sessions),
+            "persona_prompts": len(prompts),
+            "persona_prompt_bytes": sum(prompts.values()),
+            "persona_prompt_bytes_shared": sum(len(memory.persona) for memory in sessions if memory.persona) - sum(prompts.values()),
+            "sessions_with_persona": with_prompt,
+        }
+
+SESSIONS = SessionRegistry()
@@ -0,0 +1,233 @@
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+# Local SQLite database for transcripts (empty disables persistence)
+DB_PATH = os.environ.get("RECHAT_DB_PATH", "rechat.db")
+# Writes are committed in batches of this many operations, or after this many seconds
+BATCH_SIZE = int(os.environ.get("RECHAT_DB_BATCH_SIZE", "50"))
+FLUSH_INTERVAL = float(os.environ.get("RECHAT_DB_FLUSH_INTERVAL", "0.5"))
+# A batch that fails to commit (database locked, disk full) is retried after this many seconds, doubling up to a minute
+RETRY_DELAY = float(os.environ.get("RECHAT_DB_RETRY_DELAY", "0.5"))
+# Attempts at the final batch when closing before its writes are given up
+CLOSE_ATTEMPTS = 5
+
+log = logging.getLogger(__name__)
+
+# Persona settings saved with every stored session so it can be resumed later (by the app or the API server)
+PERSONA_KEYS = [
+    "persona_tradition", "persona_denomination", "persona_context", "persona_demographics",
+    "persona_personality", "persona_knowledge_level", "persona_engagement_level", "persona_attitude",
+    "persona_name", "persona_description_text", "current_persona",
+]
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_id TEXT PRIMARY KEY,
+    persona_name TEXT,
+    persona TEXT,
+    created_at TEXT,
+    updated_at TEXT
+);
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    session_id TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    role TEXT NOT NULL,
+    content TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    UNIQUE (session_id, seq)
+);
+CREATE INDEX IF NOT EXISTS idx_sessions_updated ON sessions (updated_at);
+CREATE TABLE IF NOT EXISTS personas (
+    persona_id TEXT PRIMARY KEY,
+    library TEXT NOT NULL,
+    name TEXT NOT NULL,
+    spec TEXT NOT NULL,
+    description TEXT NOT NULL,
+    system_prompt TEXT NOT NULL,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_personas_library ON personas (library, created_at);
+"""
+
+def now():
+    return datetime.now().isoformat(timespec="seconds")
+
+class ConversationStore:
+    """Append-only transcript store on SQLite in WAL mode
+
+    Writes are queued and applied by a background thread in batched
+    transactions, so saving a message never blocks the render path.
+    Reads open their own connection, which WAL lets run alongside the writer.
+    A batch that fails to commit is logged and retried, ahead of newer
+    writes, until it goes through.
+    """
+
+    def __init__(self, path=DB_PATH, batch_size=BATCH_SIZE, flush_interval=FLUSH_INTERVAL):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue()
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.executescript(SCHEMA)
+        conn.close()
+        self._writer = threading.Thread(target=self._write_loop, name="conversation-store", daemon=True)
+        self._writer.start()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def save_session(self, session_id, persona_name, persona):
+        """Create or update a session record with its persona settings"""
+        self._queue.put(("session", (session_id, persona_name, json.dumps(persona), now())))
+
+    def append_message(self, session_id, seq, role, content):
+        """Queue one message for writing; seq is its position in the conversation"""
+        self._queue.put(("message", (session_id, seq, role, content, now())))
+
+    def save_persona(self, library, record):
+        """Queue a generated persona record for the persona library"""
+        self._queue.put(("persona", (
+            record["persona_id"], library, record["name"], json.dumps(record["spec"]),
+            record["description"], record["system_prompt"], record["created_at"]
+        )))
+
+    def flush(self, timeout=None):
+        """Block until every queued write has been committed"""
+        done = threading.Event()
+        self._queue.put(("flush", done))
+        return done.wait(timeout)
+
+    def close(self):
+        self.flush()
+        self._queue.put(("stop", None))
+        self._writer.join()
+
+    def _write_loop(self):
+        conn = self._connect()
+        stop = False
+        batch, failures = [], 0
+        while not stop:
+            if not batch:
+                batch = [self._queue.get()]
+                deadline = time.monotonic() + self.flush_interval
+                while len(batch) < self.batch_size and batch[-1][0] not in ("flush", "stop"):
+                    try:
+                        batch.append(self._queue.get(timeout=max(0, deadline - time.monotonic())))
+                    except queue.Empty:
+                        break
+            waiting = []
+            try:
+                with conn:
+                    for kind, payload in batch:
+                        if kind == "session":
+                            conn.execute(
+                                "INSERT INTO sessions (session_id, persona_name, persona, created_at, updated_at) "
+                                "VALUES (?, ?, ?, ?, ?) ON CONFLICT (session_id) DO UPDATE SET "
+                                "persona_name = excluded.persona_name, persona = excluded.persona, updated_at = excluded.updated_at",
+                                payload[:4] + (payload[3],)
+                            )
+                        elif kind == "message":
+                            conn.execute(
+                                "INSERT OR REPLACE INTO messages (session_id, seq, role, content, created_at) VALUES (?, ?, ?, ?, ?)",
+                                payload
+                            )
+                            conn.execute("UPDATE sessions SET updated_at = ? WHERE session_id = ?", (payload[4], payload[0]))
+                        elif kind == "persona":
+                            conn.execute(
+                                "INSERT OR REPLACE INTO personas (persona_id, library, name, spec, description, system_prompt, created_at) "
+                                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                payload
+                            )
+                        elif kind == "flush":
+                            waiting.append(payload)
+                        elif kind == "stop":
+                            stop = True
+            except sqlite3.Error as e:
+                # Never take the app down over a transcript write, but never lose one quietly either
+                failures += 1
+                writes = sum(1 for kind, _ in batch if kind not in ("flush", "stop"))
+                if stop and failures >= CLOSE_ATTEMPTS:
+                    log.error("Giving up on %d transcript writes at close after %d attempts: %s", writes, failures, e)
+                    break
+                stop = False
+                log.warning("Transcript batch of %d writes failed (attempt %d), retrying: %s", writes, failures, e)
+                time.sleep(min(RETRY_DELAY * 2 ** (failures - 1), 60))
+                continue
+            batch, failures = [], 0
+            for done in waiting:
+                done.set()
+        conn.close()
+
+    def list_sessions(self, limit=50):
+        """Most recently active sessions as dicts, for the teacher transcript list"""
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT s.session_id, s.persona_name, s.created_at, s.updated_at, COUNT(m.id) "
+                "FROM sessions s LEFT JOIN messages m ON m.session_id = s.session_id "
+                "GROUP BY s.session_id ORDER BY s.updated_at DESC LIMIT ?",
+                (limit,)
+            ).fetchall()
+        finally:
+            conn.close()
+        return [
+            {"session_id": row[0], "persona_name": row[1], "created_at": row[2], "updated_at": row[3], "message_count": row[4]}
+            for row in rows
+        ]
+
+    def load_session(self, session_id):
+        """Return (persona settings, messages) for a stored session, or None if it does not exist"""
+        conn = self._connect()
+        try:
+            row = conn.execute("SELECT persona FROM sessions WHERE session_id = ?", (session_id,)).fetchone()
+            if row is None:
+                return None
+            messages = conn.execute(
+                "SELECT role, content FROM messages WHERE session_id = ? ORDER BY seq", (session_id,)
+            ).fetchall()
+        finally:
+            conn.close()
+        return json.loads(row[0]), [{"role": role, "content": content} for role, content in messages]
+
+    def list_personas(self, limit=500):
+        """Persona library records, newest library first"""
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT persona_id, library, name, spec, description, system_prompt, created_at "
+                "FROM personas ORDER BY created_at DESC, library, name LIMIT ?",
+                (limit,)
+            ).fetchall()
+        finally:
+            conn.close()
+        return [
+            {
+                "persona_id": row[0], "library": row[1], "name": row[2], "spec": json.loads(row[3]),
+                "description": row[4], "system_prompt": row[5], "created_at": row[6],
+            }
+            for row in rows
+        ]
+
+    def iter_transcripts(self):
+        """Yield (session_id, persona settings, messages) for every stored session, one session at a time"""
+        conn = self._connect()
+        try:
+            sessions = conn.execute("SELECT session_id, persona FROM sessions ORDER BY created_at").fetchall()
+            for session_id, persona in sessions:
+                messages = conn.execute(
+                    "SELECT role, content FROM messages WHERE session_id = ? ORDER BY seq", (session_id,)
+                ).fetchall()
+                if messages:
+                    yield session_id, json.loads(persona), [{"role": role, "content": content} for role, content in messages]
+        finally:
+            conn.close()
@@ -0,0 +1,119 @@
+import asyncio
+import functools
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import async_providers
+from async_providers import ProviderCall, ProviderTimeout, hedged_stream, stream_call, stream_with_retry
+from metrics import TurnTrace
+from providers import StubClient, StubProvider
+
+class CountingStub(StubProvider):
+    """Local stub that counts the requests it is sent and can fail after a number of tokens"""
+
+    def __init__(self, name="Counting stub", fail_after=None, error=ConnectionError("connection reset")):
+        self.name = name
+        self.fail_after = fail_after
+        self.error = error
+        self.requests = 0
+
+    def complete(self, client, **request):
+        self.requests += 1
+        return super().complete(client, **request)
+
+    def stream(self, client, **request):
+        self.requests += 1
+        for index, token in enumerate(super().stream(client, **request)):
+            if index == self.fail_after:
+                raise self.error
+            yield token
+        if self.fail_after is not None:
+            raise self.error
+
+def request():
+    return {"persona": "persona", "history": [{"role": "user", "content": "Do you pray?"}], "user_input": "Do you pray?"}
+
+def collect(stream):
+    async def run():
+        return [token async for token in stream]
+    return asyncio.run(run())
+
+class StreamTest(unittest.TestCase):
+    def test_secondary_wins_after_hedge_delay(self):
+        primary = CountingStub("Slow stub")
+        secondary = CountingStub("Fast stub")
+        trace = TurnTrace(primary.name, primary.model)
+        started = time.perf_counter()
+        tokens = collect(hedged_stream(
+            ProviderCall(primary, StubClient(latency=1.0, token_rate=0), request()),
+            ProviderCall(secondary, StubClient(latency=0, token_rate=0), request()),
+            hedge_after=0.1, trace=trace
+        ))
+        self.assertTrue(tokens)
+        self.assertEqual(trace.provider, "Fast stub")
+        self.assertEqual(secondary.requests, 1)
+        self.assertLess(time.perf_counter() - started, 1.0)
+
+    def test_no_retry_after_first_token(self):
+        provider = CountingStub(fail_after=1)
+        trace = TurnTrace(provider.name, provider.model)
+        tokens = []
+
+        async def run():
+            async for token in stream_with_retry(ProviderCall(provider, StubClient(latency=0, token_rate=0), request()), trace=trace):
+                tokens.append(token)
+
+        with self.assertRaises(ConnectionError):
+            asyncio.run(run())
+        self.assertEqual(len(tokens), 1)
+        self.assertEqual(provider.requests, 1)
+        self.assertEqual(trace.retries, 0)
+
+    def test_retry_before_first_token(self):
+        provider = CountingStub(fail_after=0)
+        trace = TurnTrace(provider.name, provider.model)
+        with mock.patch.object(async_providers, "backoff_delay", return_value=0):
+            with self.assertRaises(ConnectionError):
+                collect(stream_with_retry(
+                    ProviderCall(provider, StubClient(latency=0, token_rate=0), request()), max_attempts=3, trace=trace
+                ))
+        self.assertEqual(provider.requests, 3)
+        self.assertEqual(trace.retries, 2)
+
+    def test_non_stream_timeout_not_retried(self):
+        provider = CountingStub()
+        trace = TurnTrace(provider.name, provider.model)
+        call = ProviderCall(provider, StubClient(latency=0.5, token_rate=0), request(), stream=False)
+        with mock.patch.object(async_providers, "stream_call", functools.partial(stream_call, request_timeout=0.1)):
+            with self.assertRaises(ProviderTimeout):
+                collect(stream_with_retry(call, trace=trace))
+        self.assertEqual(provider.requests, 1)
+        self.assertEqual(trace.retries, 0)
+
+    def test_call_abandoned_in_queue_is_never_sent(self):
+        provider = CountingStub()
+        release = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=1)
+        executor.submit(release.wait)  # the only worker is busy
+        try:
+            with mock.patch.object(async_providers, "_executor", executor):
+                with self.assertRaisesRegex(ProviderTimeout, "worker thread"):
+                    collect(stream_call(ProviderCall(provider, StubClient(latency=0, token_rate=0), request()), request_timeout=0.1))
+        finally:
+            release.set()
+            executor.shutdown(wait=True)
+        self.assertEqual(provider.requests, 0)
+
+    def test_native_stream_times_out_on_first_token(self):
+        provider = CountingStub()
+        call = ProviderCall(provider, None, request(), async_client=StubClient(latency=1.0, token_rate=0))
+        started = time.perf_counter()
+        with self.assertRaisesRegex(ProviderTimeout, "first token"):
+            collect(stream_call(call, first_token_timeout=0.1))
+        self.assertLess(time.perf_counter() - started, 0.5)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,86 @@
+import unittest
+
+from context_window import ContextWindow
+
+def conversation(count, tokens=100):
+    """Alternating student and persona messages with a fixed token cost each"""
+    return [
+        {"role": "user" if i % 2 == 0 else "assistant", "content": f"Message {i}. More words.", "tokens": tokens}
+        for i in range(count)
+    ]
+
+class ContextWindowTest(unittest.TestCase):
+    def setUp(self):
+        # 1000 tokens of history once the 100-token summary allowance is set aside; folds down to 500
+        self.window = ContextWindow(token_budget=1100, summary_budget=100, low_water=0.5)
+        self.calls = []
+
+    def summarize(self, previous, dropped):
+        self.calls.append(len(dropped))
+        return "Short summary."
+
+    def test_history_within_budget_is_sent_whole(self):
+        messages = conversation(10)
+        history, summary = self.window.fit(messages, self.summarize)
+        self.assertEqual(len(history), 10)
+        self.assertEqual(summary, "")
+        self.assertEqual(self.calls, [])
+
+    def test_overflow_folds_down_to_low_water(self):
+        messages = conversation(11)
+        history, summary = self.window.fit(messages, self.summarize)
+        self.assertEqual(history, messages[6:])
+        self.assertEqual(summary, "Short summary.")
+        self.assertEqual(self.calls, [6])
+        self.assertEqual(self.window.covered, 6)
+
+    def test_summary_runs_once_every_several_turns(self):
+        messages = conversation(10)
+        for _ in range(10):
+            messages += conversation(1)
+            history, _ = self.window.fit(messages, self.summarize)
+            self.assertLessEqual(sum(msg["tokens"] for msg in history), 1000)
+        # Folded at 11 and 17 messages only: the window refills 500 tokens between summaries
+        self.assertEqual(self.calls, [6, 6])
+
+    def test_failed_summary_is_folded_locally(self):
+        def failing(previous, dropped):
+            raise Exception("provider down")
+
+        _, summary = self.window.fit(conversation(11), failing)
+        self.assertTrue(summary.startswith("- Student: Message 0"))
+        self.assertIn("- Persona: Message 1", summary)
+
+    def test_long_summary_is_cut_to_budget(self):
+        _, summary = self.window.fit(conversation(11), lambda previous, dropped: "word " * 1000)
+        self.assertLessEqual(len(summary), 100 * 4)
+
+    def test_trim_folds_unsummarised_messages_first(self):
+        messages = conversation(11)
+        self.window.fit(messages, self.summarize)
+        self.window.trim(messages, 8)
+        self.assertEqual(self.window.covered, 0)
+        self.assertIn("Message 7", self.window.summary)
+
+    def test_trim_within_summarised_prefix_only_moves_covered(self):
+        messages = conversation(11)
+        self.window.fit(messages, self.summarize)
+        self.window.trim(messages, 3)
+        self.assertEqual(self.window.covered, 3)
+        self.assertEqual(self.window.summary, "Short summary.")
+
+    def test_shorter_conversation_resets_summary(self):
+        self.window.fit(conversation(11), self.summarize)
+        history, summary = self.window.fit(conversation(2), self.summarize)
+        self.assertEqual(len(history), 2)
+        self.assertEqual(summary, "")
+
+    def test_resume_seeds_summary_from_unloaded_messages(self):
+        self.window.resume(conversation(4))
+        history, summary = self.window.fit(conversation(2), self.summarize)
+        self.assertEqual(len(history), 2)
+        self.assertIn("- Student: Message 0", summary)
+        self.assertIn("- Persona: Message 3", summary)
+
+if __name__ == "__main__":
+    unittest.main()
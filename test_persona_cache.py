@@ -0,0 +1,96 @@
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+
+import persona_cache
+from persona_cache import PersonaCache, persona_cache_key
+
+SPEC = {"persona_tradition": "Islam", "persona_gender": "Male"}
+RECORD = {"description": "This is Ahmed.", "name": "Ahmed", "system_prompt": "You are Ahmed."}
+CALLERS = 8
+
+class PersonaCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = PersonaCache(max_entries=4, ttl=60, disk_dir="")
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def create(self, outcome=RECORD):
+        """Slow persona generation that returns or raises outcome once released"""
+        self.calls += 1
+        self.started.set()
+        self.release.wait(5)
+        if isinstance(outcome, Exception):
+            raise outcome
+        return outcome
+
+    def race(self, outcome=RECORD):
+        """Run get_or_create from several threads at once and return each caller's result or error"""
+        def call():
+            try:
+                return self.cache.get_or_create("key", lambda: self.create(outcome))
+            except Exception as e:
+                return e
+
+        with ThreadPoolExecutor(max_workers=CALLERS) as executor:
+            owner = executor.submit(call)
+            self.started.wait(5)
+            waiters = [executor.submit(call) for _ in range(CALLERS - 1)]
+            time.sleep(0.05)  # let the waiters reach the in-flight creation
+            self.release.set()
+            return [owner.result()] + [waiter.result() for waiter in waiters]
+
+    def test_key_ignores_case_and_spacing_but_not_provider(self):
+        key = persona_cache_key(SPEC, "OpenAI GPT-4o", "gpt-4o")
+        self.assertEqual(key, persona_cache_key({"persona_tradition": " islam ", "persona_gender": "MALE"}, "OpenAI GPT-4o", "gpt-4o"))
+        self.assertNotEqual(key, persona_cache_key(SPEC, "Claude", "claude-3-5-sonnet"))
+
+    def test_concurrent_callers_share_one_creation(self):
+        results = self.race()
+        self.assertEqual(self.calls, 1)
+        self.assertTrue(all(result == RECORD for result in results))
+        self.assertEqual(self.cache.misses, 1)
+        self.assertEqual(self.cache.get_or_create("key", lambda: self.create()), RECORD)
+        self.assertEqual(self.calls, 1)
+
+    def test_failed_owner_error_reaches_every_waiter(self):
+        error = ConnectionError("provider down")
+        started = time.perf_counter()
+        results = self.race(error)
+        self.assertEqual(self.calls, 1)
+        self.assertTrue(all(result is error for result in results))
+        self.assertLess(time.perf_counter() - started, 1.0)
+        self.assertIsNone(self.cache.get("key"))
+
+    def test_next_call_after_failure_tries_again(self):
+        self.release.set()
+        with self.assertRaises(ConnectionError):
+            self.cache.get_or_create("key", lambda: self.create(ConnectionError("provider down")))
+        self.assertEqual(self.cache.get_or_create("key", lambda: self.create()), RECORD)
+        self.assertEqual(self.calls, 2)
+
+    def test_expired_entry_is_dropped(self):
+        self.cache.put("key", RECORD)
+        with mock.patch.object(persona_cache.time, "time", return_value=time.time() + 61):
+            self.assertIsNone(self.cache.get("key"))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        for i in range(5):
+            self.cache.put(f"key {i}", RECORD)
+        self.assertEqual(len(self.cache), 4)
+        self.assertIsNone(self.cache.get("key 0"))
+
+    def test_disk_tier_survives_a_new_process(self):
+        with tempfile.TemporaryDirectory() as disk_dir:
+            PersonaCache(disk_dir=disk_dir).put("key", RECORD)
+            restarted = PersonaCache(disk_dir=disk_dir)
+            self.assertEqual(restarted.get("key"), RECORD)
+            self.assertEqual(len(restarted), 1)
+
+if __name__ == "__main__":
+    unittest.main()
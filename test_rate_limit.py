@@ -0,0 +1,40 @@
+import threading
+import unittest
+
+from rate_limit import RequestScheduler
+
+class RequestSchedulerTest(unittest.TestCase):
+    def test_settle_charges_usage_beyond_bucket_capacity(self):
+        # 6000 tokens per minute: a bucket of 600 refilled at 100 tokens per second
+        scheduler = RequestScheduler({"test": 0}, {"test": 6000})
+        ticket = scheduler.acquire("test", "key", "session", tokens=1000)
+        self.assertEqual(ticket.charged, 600)
+        ticket.settle(900)
+        # 600 were taken up front, so the other 300 used put the bucket in debt
+        self.assertLess(ticket.lane.tpm.tokens, -250)
+
+    def test_settle_refunds_unused_reservation(self):
+        scheduler = RequestScheduler({"test": 0}, {"test": 6000})
+        ticket = scheduler.acquire("test", "key", "session", tokens=500)
+        ticket.settle(200)
+        self.assertGreater(ticket.lane.tpm.tokens, 350)
+
+    def test_on_wait_runs_without_scheduler_lock(self):
+        # 6 requests per minute: a burst of one, then one every 10 seconds
+        scheduler = RequestScheduler({"test": 6}, {"test": 0})
+        scheduler.acquire("test", "key", "first")
+        lock_free = []
+
+        def on_wait(position):
+            probe = threading.Thread(target=lambda: lock_free.append(scheduler.queued() is not None))
+            probe.start()
+            probe.join(1.0)
+            raise KeyboardInterrupt  # stop waiting for the next request slot
+
+        with self.assertRaises(KeyboardInterrupt):
+            scheduler.acquire("test", "key", "second", on_wait=on_wait)
+        self.assertEqual(lock_free, [True])
+        self.assertEqual(sum(scheduler.queued().values()), 0)
+
+if __name__ == "__main__":
+    unittest.main()
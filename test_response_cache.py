@@ -0,0 +1,69 @@
+import unittest
+
+import response_cache
+from response_cache import MAX_VARIANTS, ResponseCache
+
+PROVIDER = "Local stub"
+PERSONA = "You are Ahmed."
+HISTORY = [{"role": "assistant", "content": "Hi, I am Ahmed."}]
+
+class ResponseCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = ResponseCache(max_entries=8, threshold=0.8, variation=0, seed=1)
+
+    def test_exact_hit_ignores_case_and_punctuation(self):
+        self.cache.store(PROVIDER, PERSONA, HISTORY, "Do you pray?", "Five times a day.")
+        self.assertEqual(self.cache.lookup(PROVIDER, PERSONA, HISTORY, "do you  PRAY"), "Five times a day.")
+        self.assertEqual(self.cache.hits, 1)
+
+    @unittest.skipIf(response_cache.np is None, "similarity lookup needs numpy")
+    def test_similar_question_hits(self):
+        self.cache.store(PROVIDER, PERSONA, HISTORY, "What do you believe in?", "God is one.")
+        self.assertEqual(self.cache.lookup(PROVIDER, PERSONA, HISTORY, "What do you believe?"), "God is one.")
+
+    def test_different_question_misses(self):
+        self.cache.store(PROVIDER, PERSONA, HISTORY, "What do you believe in?", "God is one.")
+        self.assertIsNone(self.cache.lookup(PROVIDER, PERSONA, HISTORY, "Which holidays do you celebrate?"))
+        self.assertEqual(self.cache.misses, 1)
+
+    def test_exact_only_above_threshold_one(self):
+        cache = ResponseCache(threshold=1.1, variation=0)
+        cache.store(PROVIDER, PERSONA, HISTORY, "What do you believe in?", "God is one.")
+        self.assertIsNone(cache.lookup(PROVIDER, PERSONA, HISTORY, "What do you believe?"))
+
+    def test_other_history_persona_or_provider_misses(self):
+        self.cache.store(PROVIDER, PERSONA, HISTORY, "Do you pray?", "Five times a day.")
+        later = HISTORY + [{"role": "user", "content": "Hello"}, {"role": "assistant", "content": "Hi"}]
+        self.assertIsNone(self.cache.lookup(PROVIDER, PERSONA, later, "Do you pray?"))
+        self.assertIsNone(self.cache.lookup(PROVIDER, "You are Sara.", HISTORY, "Do you pray?"))
+        self.assertIsNone(self.cache.lookup("OpenAI GPT-4o", PERSONA, HISTORY, "Do you pray?"))
+
+    def test_variants_are_capped(self):
+        for i in range(MAX_VARIANTS + 2):
+            self.cache.store(PROVIDER, PERSONA, HISTORY, "Do you pray?", f"Answer {i}")
+        answers = {self.cache.lookup(PROVIDER, PERSONA, HISTORY, "Do you pray?") for _ in range(50)}
+        self.assertEqual(answers, {f"Answer {i}" for i in range(MAX_VARIANTS)})
+
+    def test_variation_asks_afresh_until_variants_are_full(self):
+        cache = ResponseCache(variation=1.0, seed=1)
+        cache.store(PROVIDER, PERSONA, HISTORY, "Do you pray?", "Answer 0")
+        self.assertIsNone(cache.lookup(PROVIDER, PERSONA, HISTORY, "Do you pray?"))
+        for i in range(1, MAX_VARIANTS):
+            cache.store(PROVIDER, PERSONA, HISTORY, "Do you pray?", f"Answer {i}")
+        self.assertIsNotNone(cache.lookup(PROVIDER, PERSONA, HISTORY, "Do you pray?"))
+
+    def test_departures_and_offensive_questions_are_not_stored(self):
+        self.cache.store(PROVIDER, PERSONA, HISTORY, "Why?", "I do not want to talk to you any more.")
+        self.cache.store(PROVIDER, PERSONA, HISTORY, "Are you stupid?", "No.")
+        self.assertEqual(len(self.cache), 0)
+
+    def test_least_recently_used_entry_is_evicted(self):
+        cache = ResponseCache(max_entries=8, threshold=1.1, variation=0)  # exact matches only
+        for i in range(9):
+            cache.store(PROVIDER, PERSONA, HISTORY, f"Question number {i}?", f"Answer {i}")
+        self.assertEqual(len(cache), 8)
+        self.assertIsNone(cache.lookup(PROVIDER, PERSONA, HISTORY, "Question number 0?"))
+        self.assertEqual(cache.lookup(PROVIDER, PERSONA, HISTORY, "Question number 8?"), "Answer 8")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,64 @@
+import json
+import unittest
+from unittest import mock
+
+import transcript
+from transcript import TranscriptBuffer, format_transcript
+
+PERSONA = {"persona_tradition": "Islam", "persona_description_text": "This is Ahmed."}
+DOWNLOADED = "2024-01-01 12:00:00"
+
+def conversation(count):
+    return [{"role": "user" if i % 2 == 0 else "assistant", "content": f"Message {i}"} for i in range(count)]
+
+class TranscriptBufferTest(unittest.TestCase):
+    def test_render_matches_full_format(self):
+        messages = conversation(5)
+        for fmt in transcript.FORMATS:
+            self.assertEqual(
+                TranscriptBuffer().render(messages, PERSONA, fmt, DOWNLOADED),
+                format_transcript(PERSONA, messages, fmt, DOWNLOADED)
+            )
+
+    def test_extend_formats_only_new_messages(self):
+        messages = conversation(4)
+        buffer = TranscriptBuffer()
+        buffer.extend(messages, "txt")
+        messages.append({"role": "user", "content": "Message 4"})
+        with mock.patch.dict(transcript.FORMATTERS, {"txt": (transcript.text_header, mock.Mock(return_value="new\n"))}):
+            chunks = buffer.extend(messages, "txt")
+            self.assertEqual(transcript.FORMATTERS["txt"][1].call_count, 1)
+        self.assertEqual(chunks[-1], "new\n")
+        self.assertEqual(len(chunks), 5)
+
+    def test_replaced_or_shorter_list_is_rebuilt(self):
+        buffer = TranscriptBuffer()
+        messages = conversation(4)
+        buffer.extend(messages, "txt")
+        self.assertEqual(len(buffer.extend(conversation(4), "txt")), 4)  # a new list of the same length
+        del messages[2:]
+        self.assertEqual(buffer.extend(messages, "txt"), [transcript.text_message(i, msg) for i, msg in enumerate(messages)])
+
+    def test_trim_keeps_sequence_numbers(self):
+        messages = conversation(6)
+        buffer = TranscriptBuffer()
+        buffer.extend(messages, "jsonl")
+        buffer.trim(messages, 2)
+        earlier = messages[:2]
+        del messages[:2]
+        messages.append({"role": "user", "content": "Message 6"})
+        rendered = buffer.render(messages, PERSONA, "jsonl", DOWNLOADED, earlier=earlier, offset=2)
+        seqs = [json.loads(line)["seq"] for line in rendered.splitlines()[1:]]
+        self.assertEqual(seqs, list(range(7)))
+        self.assertEqual(buffer.offset, 2)
+
+    def test_offset_applies_when_following_a_new_list(self):
+        buffer = TranscriptBuffer()
+        chunks = buffer.extend(conversation(2), "jsonl", offset=40)
+        self.assertEqual([json.loads(chunk)["seq"] for chunk in chunks], [40, 41])
+
+    def test_empty_conversation(self):
+        self.assertEqual(TranscriptBuffer().render([], PERSONA, "txt"), "No conversation to download.")
+
+if __name__ == "__main__":
+    unittest.main()
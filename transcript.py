@@ -0,0 +1,149 @@
+import io
+import json
+import threading
+import zipfile
+from datetime import datetime
+
+# Export formats: file extension -> MIME type
+FORMATS = {
+    "txt": "text/plain",
+    "md": "text/markdown",
+    "jsonl": "application/x-ndjson",
+}
+
+# (session state key, label, default when the key is missing)
+SETTINGS = [
+    ("persona_tradition", "Religious Tradition", "N/A"),
+    ("persona_denomination", "Denomination/Movement", "N/A"),
+    ("persona_context", "Geographic/Cultural Context", "N/A"),
+    ("persona_demographics", "Demographics", "N/A"),
+    ("persona_personality", "Personality", "Not specified"),
+    ("persona_knowledge_level", "Knowledge Level", "N/A"),
+    ("persona_engagement_level", "Engagement Level", "N/A"),
+    ("persona_attitude", "Attitude towards Religion", "N/A"),
+]
+
+def text_header(persona, downloaded):
+    parts = [
+        "=" * 60 + "\n",
+        "RELIGIOUS PERSONA CONVERSATION\n",
+        "=" * 60 + "\n",
+        f"Downloaded: {downloaded}\n\n",
+        "PERSONA SETTINGS:\n",
+        "-" * 60 + "\n",
+    ]
+    parts += [f"{label}: {persona.get(key, default)}\n" for key, label, default in SETTINGS]
+    parts += ["\n", "PERSONA INTRODUCTION:\n", "-" * 60 + "\n"]
+    if persona.get("persona_description_text"):
+        parts.append(persona["persona_description_text"] + "\n\n")
+    else:
+        parts.append("N/A\n\n")
+    parts += ["=" * 60 + "\n", "CONVERSATION TRANSCRIPT:\n", "=" * 60 + "\n\n"]
+    return "".join(parts)
+
+def text_message(seq, message):
+    role = "Me" if message["role"] == "user" else "Persona"
+    return f"{role}: {message['content']}\n\n"
+
+def markdown_header(persona, downloaded):
+    parts = [f"# Religious Persona Conversation\n\n_Downloaded: {downloaded}_\n\n## Persona Settings\n\n"]
+    parts += [f"- **{label}:** {persona.get(key, default)}\n" for key, label, default in SETTINGS]
+    parts.append(f"\n## Persona Introduction\n\n{persona.get('persona_description_text') or 'N/A'}\n\n## Conversation Transcript\n\n")
+    return "".join(parts)
+
+def markdown_message(seq, message):
+    role = "Me" if message["role"] == "user" else "Persona"
+    return f"**{role}:** {message['content']}\n\n"
+
+def jsonl_header(persona, downloaded):
+    record = {"type": "persona", "downloaded": downloaded}
+    record.update({key: persona.get(key, default) for key, _, default in SETTINGS})
+    record["description"] = persona.get("persona_description_text", "")
+    return json.dumps(record, ensure_ascii=False) + "\n"
+
+def jsonl_message(seq, message):
+    return json.dumps({"type": "message", "seq": seq, "role": message["role"], "content": message["content"]}, ensure_ascii=False) + "\n"
+
+FORMATTERS = {
+    "txt": (text_header, text_message),
+    "md": (markdown_header, markdown_message),
+    "jsonl": (jsonl_header, jsonl_message),
+}
+
+def format_transcript(persona, messages, fmt="txt", downloaded=None):
+    """Format a whole transcript in one go (used for stored sessions)"""
+    if not messages:
+        return "No conversation to download."
+    if downloaded is None:
+        downloaded = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    header, formatter = FORMATTERS[fmt]
+    return header(persona, downloaded) + "".join(formatter(seq, message) for seq, message in enumerate(messages))
+
+class TranscriptBuffer:
+    """Export chunks for one conversation, extended with only the new messages on each render
+
+    The buffer follows one messages list; if the list is replaced or
+    shrinks (new conversation, resumed session) the chunks are rebuilt.
+    """
+
+    def __init__(self):
+        self.source = None
+        self.offset = 0  # sequence number of the first buffered message
+        self.chunks = {fmt: [] for fmt in FORMATTERS}
+        self._lock = threading.Lock()  # download callables may run off the script thread
+
+    def clear(self):
+        with self._lock:
+            self.source = None
+            self.offset = 0
+            self.chunks = {fmt: [] for fmt in FORMATTERS}
+
+    def trim(self, messages, count):
+        """Drop the chunks of the oldest `count` messages, which are about to leave memory"""
+        with self._lock:
+            if messages is self.source:
+                for chunks in self.chunks.values():
+                    del chunks[:count]
+                self.offset += count
+
+    def extend(self, messages, fmt="txt", offset=0):
+        """Formatted chunks for messages in one format, one per message, formatting only the new ones
+
+        `offset` is the sequence number of messages[0] when the buffer starts
+        following a new list (older messages already left memory).
+        """
+        with self._lock:
+            if messages is not self.source or any(len(chunks) > len(messages) for chunks in self.chunks.values()):
+                self.source = messages
+                self.offset = offset
+                self.chunks = {name: [] for name in FORMATTERS}
+            chunks = self.chunks[fmt]
+            formatter = FORMATTERS[fmt][1]
+            for index in range(len(chunks), len(messages)):
+                chunks.append(formatter(self.offset + index, messages[index]))
+            return chunks
+
+    def render(self, messages, persona, fmt="txt", downloaded=None, earlier=(), offset=0):
+        """Whole transcript; `earlier` holds messages that already left memory, formatted on the spot"""
+        snapshot = list(messages)
+        if not snapshot and not earlier:
+            return "No conversation to download."
+        chunks = self.extend(messages, fmt, offset)
+        if downloaded is None:
+            downloaded = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        header, formatter = FORMATTERS[fmt]
+        older = "".join(formatter(seq, message) for seq, message in enumerate(earlier))
+        return header(persona, downloaded) + older + "".join(chunks[:len(snapshot)])
+
+def write_sessions_zip(transcripts, fmt="txt"):
+    """Zip (session_id, persona, messages) transcripts, one file per session, and return the archive bytes
+
+    Sessions are consumed and formatted one at a time, so only the
+    compressed archive is held in memory, never every transcript at once.
+    """
+    archive_bytes = io.BytesIO()
+    with zipfile.ZipFile(archive_bytes, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for session_id, persona, messages in transcripts:
+            name = persona.get("persona_name") or "persona"
+            archive.writestr(f"{session_id}_{name}.{fmt}", format_transcript(persona, messages, fmt))
+    return archive_bytes.getvalue()